@@ -6,29 +6,38 @@ osjoin = os.path.join # an alias for convenient
 
 import time 
 import numpy as np
-import pandas as pd
 from scipy import sparse
-from scipy.interpolate import make_interp_spline
-
-from sklearn import manifold
-from sklearn.cluster import (DBSCAN, OPTICS, SpectralClustering, 
-                             AgglomerativeClustering)
+from scipy.spatial import cKDTree
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
 
+# sklearn, pandas and matplotlib are imported where needed, such that the 
+# simulations do not pay for loading them.
 
 from brian2.units import second
 
-import matplotlib.pyplot as plt
-from matplotlib.colors import Normalize
-from  matplotlib.cm import ScalarMappable
 #import seaborn as sns
 
-from anisonet.utils import aggregate_mons, idx2coords
+from anisonet.utils import aggregate_mons, iter_mons, idx2coords
+from anisonet.utils import load_connectivity
 from anisonet.utils import plane2torus, torus2plane, balance_dist
 # from anisonet.viz import plot_3d_clusters, plot_spline_trace
 
 from pdb import set_trace
 
 
+def get_cluster_alg(cluster_alg):
+    """Returns the sklearn clustering class of the given name."""
+    from sklearn.cluster import DBSCAN, OPTICS, SpectralClustering
+    
+    if cluster_alg=='dbscan':
+        return DBSCAN
+    elif cluster_alg =='optics':
+        return OPTICS
+    elif cluster_alg =='spectral':
+        return SpectralClustering
+    raise NotImplementedError('Clustering {} is not recognized.'.format(cluster_alg))
+
 def warped_clusters(xyt, gs, cluster_alg, cluster_kw={}, n_iter=1):
     """
     The idea is to find cluster twice. Once for the given sequence, and once 
@@ -45,12 +54,7 @@ def warped_clusters(xyt, gs, cluster_alg, cluster_kw={}, n_iter=1):
     xyt_c = np.copy(xyt)
     xyt_c[:,:2] = (xyt_c[:,:2] + gs//2) % gs # shifted to the center
     
-    if cluster_alg=='dbscan':
-        cluster = DBSCAN
-    elif cluster_alg =='optics':
-        cluster = OPTICS
-    elif cluster_alg =='spectral':
-        cluster = SpectralClustering
+    cluster = get_cluster_alg(cluster_alg)
         
     bumps = cluster(**cluster_kw).fit(xyt)
     bumps_c =  cluster(**cluster_kw).fit(xyt_c) 
@@ -120,12 +124,7 @@ def warped_clusters_torus(xyt, gs, cluster_alg, cluster_kw={}):
     for i in range(5):
         print("{} is between {}, {}".format(i, scsct[:,i].min(), scsct[:,i].max() ))
     
-    if cluster_alg=='dbscan':
-        cluster = DBSCAN
-    elif cluster_alg =='optics':
-        cluster = OPTICS
-    elif cluster_alg =='spectral':
-        cluster = SpectralClustering
+    cluster = get_cluster_alg(cluster_alg)
     
     # fig = plt.figure()
     # ax = fig.gca()
@@ -138,8 +137,136 @@ def warped_clusters_torus(xyt, gs, cluster_alg, cluster_kw={}):
     return len(set(bumps.labels_)), bumps.labels_, scsct
     
    
-def find_bumps(sim, plot=True):
+def _slab_pairs(pts, gs, eps, chunk_size, before=True, after=True):
+    """
+    Yields the pairs of points closer than ``eps`` slab by slab. ``pts`` must
+    be sorted by time (last column). Each slab of ``chunk_size`` points is 
+    searched together with the points within ``eps`` before and/or after it,
+    and the pairs are given as global indices along with the slab's range.
+    """
+    for start in range(0, len(pts), chunk_size):
+        stop = min(start + chunk_size, len(pts))
+        lo = np.searchsorted(pts[:,2], pts[start,2] - eps) if before else start
+        hi = np.searchsorted(pts[:,2], pts[stop-1,2] + eps, 'right') if after else stop
+        
+        local = pts[lo:hi] - [0, 0, pts[lo,2]]
+        tree = cKDTree(local, boxsize=[gs, gs, local[-1,2] + 2*eps + 1])
+        pairs = tree.query_pairs(eps, output_type='ndarray')
+        yield start, stop, lo, pairs + lo
+    
+
+def periodic_dbscan(xyt, gs, eps=3., min_samples=10, t_scale=1e2, 
+                    chunk_size=50000):
+    """
+    DBSCAN clustering of the spatiotemporal spiking events on a periodic grid. 
+    Neighbors are found with a KD-tree with periodic boundaries in ``x`` and
+    ``y`` (``scipy.spatial.cKDTree`` with ``boxsize``), so the wraparound of 
+    the grid is handled exactly, without embedding the coordinates on a torus.
+    
+    Core points are those with at least ``min_samples`` neighbors (including 
+    themselves) within ``eps``. Clusters are the connected components of the
+    graph of core points which are closer than ``eps``. Other points join the
+    cluster of their nearest core point within ``eps``, or are labeled as 
+    noise (-1).
+    
+    Since time is not periodic, the events are processed in temporal slabs of
+    ``chunk_size`` events, and each slab is reduced to a spanning forest right
+    away. Thus, the memory is not dominated by the number of neighboring 
+    pairs, and the cost grows linearly with the duration of the recording.
+    
+    :param xyt: coordinates and times of the spikes with shape (n, 3)
+    :type xyt: array
+    :param gs: grid size
+    :type gs: int
+    :param eps: neighborhood radius in grid units, defaults to 3.
+    :type eps: float, optional
+    :param min_samples: minimum number of neighbors of core points, 
+        defaults to 10
+    :type min_samples: int, optional
+    :param t_scale: grid units per unit of time, i.e., for times in seconds, 
+        the default 1e2 makes 10 ms equivalent to the distance of neighboring 
+        neurons (roughly the pace of the bumps), defaults to 1e2
+    :type t_scale: float, optional
+    :param chunk_size: number of events per slab, defaults to 50000
+    :type chunk_size: int, optional
+    :return: number of clusters (excluding noise) and the labels
+    :rtype: (int, array of ints)
+    """
+    xyt = np.asarray(xyt, dtype=float)
+    order = np.argsort(xyt[:,2], kind='stable')
+    pts = np.stack((xyt[order,0] % gs, xyt[order,1] % gs, 
+                    (xyt[order,2] - xyt[order[0],2]) * t_scale)).T
+    
+    # counting the neighbors of each point (pairs are counted in the slab of 
+    # the point, which is searched along with its neighbors on both sides)
+    counts = np.ones(len(pts), dtype=int)
+    for start, stop, lo, pairs in _slab_pairs(pts, gs, eps, chunk_size):
+        idxs = pairs.ravel()
+        idxs = idxs[(idxs >= start) & (idxs < stop)]
+        counts[start:stop] += np.bincount(idxs - start, minlength=stop - start)
+    
+    is_core = counts >= min_samples
+    core = np.flatnonzero(is_core)
+    labels = -np.ones(len(pts), dtype=int)
+    if len(core)==0:
+        return 0, labels
+    
+    # linking core points; each slab only looks back in time
+    rows, cols = [], []
+    core_pts = pts[core]
+    for start, stop, lo, pairs in _slab_pairs(core_pts, gs, eps, chunk_size, 
+                                             after=False):
+        nlocal = stop - lo
+        graph = sparse.coo_matrix((np.ones(len(pairs), dtype=bool), 
+                                   (pairs[:,0] - lo, pairs[:,1] - lo)), 
+                                  shape=(nlocal, nlocal))
+        
+        # reducing the slab to edges between each node and the first node of
+        # its component
+        _, comp = connected_components(graph, directed=False)
+        _, first = np.unique(comp, return_index=True)
+        rep = first[comp]
+        linked = rep != np.arange(nlocal)
+        rows.append(np.flatnonzero(linked) + lo)
+        cols.append(rep[linked] + lo)
+        del pairs, graph
+    
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    graph = sparse.coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), 
+                              shape=(len(core), len(core)))
+    nclusters, core_labels = connected_components(graph, directed=False)
+    labels[core] = core_labels
+    
+    # border points join their nearest core point
+    border = np.flatnonzero(~is_core)
+    if len(border):
+        core_tree = cKDTree(core_pts, 
+                            boxsize=[gs, gs, pts[-1,2] + 2*eps + 1])
+        dist, nearest = core_tree.query(pts[border], k=1, 
+                                        distance_upper_bound=eps*(1+1e-9))
+        reached = np.isfinite(dist)
+        labels[border[reached]] = core_labels[nearest[reached]]
+    
+    # back to the original order
+    labels[order] = labels.copy()
+    return nclusters, labels
+
+
+def find_bumps(sim, plot=True, backend='kdtree', cluster_kw={}):
+    """
+    Clusters the spiking events of each population into bumps.
     
+    :param backend: either ``'kdtree'`` which clusters the spikes with a 
+        periodic DBSCAN (c.f. ``periodic_dbscan``), or ``'torus'`` which embeds
+        the grid on a torus and uses the DBSCAN of sklearn (c.f. 
+        ``warped_clusters_torus``), defaults to 'kdtree'
+    :type backend: str, optional
+    :param cluster_kw: keyword arguments of the clustering backend, defaults
+        to {}
+    :type cluster_kw: dict, optional
+    :return: dictionary of population names to arrays of (x, y, t, label)
+    :rtype: dict
+    """
     pop_mons = sim.get_pop_mons()
     bumps = {}
     for id_, mon in enumerate(pop_mons):
@@ -179,21 +306,26 @@ def find_bumps(sim, plot=True):
         optics_kw = dict(min_samples=10, max_eps=40, )
         spectral_kw = dict(n_clusters=8,)
         
-        w_name = sim.name+'_w_'+2*mon.source.name
-        w = sparse.load_npz(osjoin(sim.data_path, w_name+'.npz'))
-        aggl_kw = dict(n_cluster=8, connectivity = w) 
+        # w_name = sim.name+'_w_'+2*mon.source.name
+        # w = sparse.load_npz(osjoin(sim.data_path, w_name+'.npz'))
+        # aggl_kw = dict(n_cluster=8, connectivity = w) 
         # nbumps, labels = warped_clusters(xyt, gs, 
         #                                  cluster_alg = 'dbscan', 
         #                                  cluster_kw = dbscan_kw 
         #                                  )
         
-        nbumps, labels, scsct = warped_clusters_torus(xyt, gs, 
-                                         cluster_alg = 'dbscan', 
-                                         cluster_kw = dbscan_kw 
-                                         )
+        if backend=='kdtree':
+            nbumps, labels = periodic_dbscan(xyt, gs, **cluster_kw)
+        elif backend=='torus':
+            nbumps, labels, scsct = warped_clusters_torus(xyt, gs, 
+                                             cluster_alg = 'dbscan', 
+                                             cluster_kw = cluster_kw or dbscan_kw 
+                                             )
+        else:
+            raise NotImplementedError('Backend {} is not recognized.'.format(backend))
         
         #bumps = DBSCAN(eps=1.23, min_samples=100).fit(xyt); 
-        print('Number of clusters found: {}'.format(len(set(labels))))
+        print('Number of clusters found: {}'.format(len(set(labels) - {-1})))
         
         # if plot:
         #     plot_3d_clusters(sim, xyt, labels, mon.name)
@@ -204,147 +336,491 @@ def find_bumps(sim, plot=True):
         
     return bumps
         
-def compute_speed(sim, plot=True):
+class BumpTracker(object):
+    """
+    Incremental tracker of the bumps of activity. Spikes are fed 
+    chronologically in chunks (e.g., batch by batch or file by file) via 
+    ``update``. They are processed in overlapping windows of length 
+    ``window`` sliding by ``step``: the spikes of each window are clustered 
+    (c.f. ``periodic_dbscan``) and the centroid of each cluster is computed by
+    a circular mean on the periodic grid. Centroids are then linked to the 
+    active tracks by a Hungarian matching (``linear_sum_assignment``) on the 
+    periodic distance, and matches farther than ``max_dist`` are rejected. 
     
-    bumps = find_bumps(sim, plot)
+    Only the spikes of the current window and the track table are kept, so 
+    the memory is bounded by the window size.
+    """
     
-    # def warp(df):
-    #     grouped = df.groupby('label')
-    #     gs = int(max(df.x.max(),df.y.max()))+1 
-        
-    #     for name, group in grouped:
-    #         if group.x.mean() > gs/2.:
-    #             group.x 
-            
-            
-        
-    for pop in bumps.keys():
-        
-        df = pd.DataFrame( bumps[pop], columns=['x','y','t','label'])
-        df = df[df.label>=0].reset_index(drop=True)
-        
-        # TODO: Here the issu is that because of the periodic boundary condition average
-        # might endup in the middle. We should have a metric to flag whoever passes
-        # the border.
-        
-        df1 = df.groupby(['label', 't']).agg('mean').reset_index() # find centroids
-        df1['t0'] = df1.groupby('label')['t'].transform(lambda x: x-x.min()).reset_index().t   # time from emergence of cluster
-        set_trace()
-        # xytl = bumps[pop]
-        # xytl = xytl[xytl[:,-1]>-1]
-        
-        ts = []
-        ts0 = []
-        spls = [] 
-        spls0 = []
-        
-        #set_trace()
-        for label in range(len(df.label.unique())):
-            x,y,t,t0 = df[df.label==1][['x','y','t','t0']].values.T
-            
-            ts.append(t)
-            ts0.append(t0)
-            spls.append(make_interp_spline(t, np.c_[x, y]))
-            spls0.append(make_interp_spline(t0, np.c_[x, y]))
-        
-        # if plot:
-        #     t_range = np.linspace(0,4, 201)
-            
-        #     plot_spline_trace(sim, spls, ts, t_range, 
-        #                           name='_bump_trajectory_'+pop)
-            
-        #     plot_spline_trace(sim, spls0, [t_-t_.min() for t_ in ts], t_range, 
-        #                           name='_bump_trajectory_reset_'+pop)
-            
-            
-        # df = pd.DataFrame( bumps[pop], columns=['x','y','t','label'])
-        # df = df[df.label>=0].reset_index(drop=True)
-        
-        
-        # find centroids
-        # centroids = df.groupby(['label', 't']).agg('mean').reset_index()
-        
-        # # time from emergence of cluster
-        # centroids.t = centroids.groupby(['label'])['t'].transform(lambda x: x-x.min()).reset_index().t
-        
-        # # computing velocity
-        # disp = centroids.set_index('label').groupby(level=0)[['t','x','y']].diff()
-        # disp = disp.rename(columns={'x':'dx', 'y':'dy', 't':'dt'}).reset_index()
-        # disp['v'] = np.sqrt(disp.dx**2 + disp.dy**2) / (disp.dt + 1e-12)
-        
-        # # adding time to displacement dataframe
-        # disp['t'] = centroids.groupby(['label'])['t'].transform(lambda x: x-x.min()).reset_index().t
-        # disp['t'] = disp['t']#/(disp['t'].max())
-           
-            #viz.plot_bump_speed(sim, disp, mon.name)
-        
-        
-        # CLUSTERS
-        # norm = Normalize(vmin= bumps.labels_.min(), vmax= bumps.labels_.max())
-        # smap = ScalarMappable(norm=norm, cmap='coolwarm') #tab20
-        # colors = smap.to_rgba(bumps.labels_)
-        
-        # fig = plt.figure()
-        # ax = fig.add_subplot(projection='3d')
-        # is_member = bumps.labels_>=0
-        # ax.scatter(xyt[is_member,0], xyt[is_member,1], xyt[is_member,2], 
-        #            color=colors[is_member], marker='.',s=1)
-        # ax.set_xlabel('x')
-        # ax.set_ylabel('y')  
-        # ax.set_zlabel('time')
+    def __init__(self, gs, window=20e-3, step=10e-3, max_dist=5., max_gap=1,
+                 cluster_kw={}):
+        """
+        :param gs: grid size
+        :type gs: int
+        :param window: window length in seconds, defaults to 20e-3
+        :type window: float, optional
+        :param step: sliding step of the windows in seconds, defaults to 10e-3
+        :type step: float, optional
+        :param max_dist: maximum displacement (in grid units) of a bump 
+            between consecutive windows, defaults to 5.
+        :type max_dist: float, optional
+        :param max_gap: number of windows a track may miss before it is 
+            closed, defaults to 1
+        :type max_gap: int, optional
+        :param cluster_kw: keyword arguments of ``periodic_dbscan``, 
+            defaults to {}
+        :type cluster_kw: dict, optional
+        """
+        self.gs = gs
+        self.window = window
+        self.step = step
+        self.max_dist = max_dist
+        self.max_gap = max_gap
+        self.cluster_kw = cluster_kw
+        
+        self.buffer = np.zeros((0, 3))
+        self.t0 = None # start of the next window
+        self.t_max = -np.inf
+        self.n_window = 0
+        
+        self.active = {} # track id -> (x, y, t, window number)
+        self.n_tracks = 0
+        self.rows = [] # track, t, x, y, nspikes
+    
+    def periodic_diff(self, a, b):
+        """Displacement from ``b`` to ``a`` on the periodic grid."""
+        return (a - b + self.gs/2) % self.gs - self.gs/2
+    
+    def centroids(self, xyt):
+        """Clusters the spikes of a window and returns their centroids."""
+        if len(xyt)==0:
+            return np.zeros((0, 4))
+        
+        nclusters, labels = periodic_dbscan(xyt, self.gs, **self.cluster_kw)
+        member = labels >= 0
+        labels, xyt = labels[member], xyt[member]
+        
+        # circular mean of the coordinates
+        ang = 2*np.pi*xyt[:,:2]/self.gs
+        nspikes = np.bincount(labels, minlength=nclusters)
+        cos = np.stack([np.bincount(labels, np.cos(ang[:,i]), nclusters) for i in range(2)]).T
+        sin = np.stack([np.bincount(labels, np.sin(ang[:,i]), nclusters) for i in range(2)]).T
+        xy = (np.arctan2(sin, cos) % (2*np.pi)) * self.gs/(2*np.pi)
+        t = np.bincount(labels, xyt[:,2], nclusters)/np.maximum(nspikes, 1)
+        
+        return np.column_stack((xy, t, nspikes))[nspikes > 0]
+    
+    def link(self, cents):
+        """Links the centroids of a window to the active tracks."""
+        ids = list(self.active.keys())
+        assigned = -np.ones(len(cents), dtype=int)
+        
+        if len(ids) and len(cents):
+            last = np.array([self.active[id_][:2] for id_ in ids])
+            d = self.periodic_diff(cents[:,None,:2], last[None,:,:])
+            cost = np.sqrt((d**2).sum(-1))
+            rows, cols = linear_sum_assignment(cost)
+            ok = cost[rows, cols] <= self.max_dist
+            assigned[rows[ok]] = np.array(ids)[cols[ok]]
+        
+        for cent, id_ in zip(cents, assigned):
+            if id_ < 0:
+                id_ = self.n_tracks
+                self.n_tracks += 1
+            self.active[id_] = (cent[0], cent[1], cent[2], self.n_window)
+            self.rows.append((id_, cent[2], cent[0], cent[1], int(cent[3])))
+        
+        # closing the tracks which were missed for too long
+        for id_ in ids:
+            if self.n_window - self.active[id_][3] > self.max_gap:
+                del self.active[id_]
+    
+    def process_window(self):
+        t1 = self.t0 + self.window
+        inside = (self.buffer[:,2] >= self.t0) & (self.buffer[:,2] < t1)
+        self.link(self.centroids(self.buffer[inside]))
+        
+        self.n_window += 1
+        self.t0 += self.step
+        self.buffer = self.buffer[self.buffer[:,2] >= self.t0]
+    
+    def update(self, xy, ts):
+        """
+        Feeds a chunk of spikes. All spikes must be later than (or at the same
+        time as) the spikes of the previous chunks.
+        
+        :param xy: coordinates of the spiking neurons with shape (n, 2)
+        :type xy: array
+        :param ts: spike times in seconds
+        :type ts: array
+        :return: number of windows processed
+        :rtype: int
+        """
+        ts = np.asarray(ts, dtype=float)
+        if len(ts)==0:
+            return 0
+        if self.t0 is None:
+            self.t0 = ts.min()
+        
+        self.buffer = np.r_[self.buffer, np.column_stack((xy, ts))]
+        self.t_max = max(self.t_max, ts.max())
+        
+        n = 0
+        while self.t0 + self.window <= self.t_max:
+            self.process_window()
+            n += 1
+        return n
+    
+    def finalize(self):
+        """Processes the remaining (partially covered) windows."""
+        while (self.t0 is not None) and (self.t0 <= self.t_max):
+            self.process_window()
+        return self.trajectories()
+    
+    def trajectories(self):
+        """
+        The table of trajectories with one row per bump and window; its 
+        columns are the track id, time, centroid coordinates, number of spikes,
+        velocity components (grid units per second) and speed. Velocities are
+        computed with respect to the previous point of the same track, and are
+        NaN for the first point of each track.
+        
+        :rtype: pandas.DataFrame
+        """
+        import pandas as pd
+        
+        df = pd.DataFrame(self.rows, columns=['track', 't', 'x', 'y', 'nspikes'])
+        df = df.sort_values(['track', 't'], kind='stable').reset_index(drop=True)
+        
+        first = df.track.ne(df.track.shift())
+        dt = df.t.diff()
+        for c in ['x', 'y']:
+            df['v'+c] = self.periodic_diff(df[c], df[c].shift()) / dt
+            df.loc[first, 'v'+c] = np.nan
+        df['speed'] = np.sqrt(df.vx**2 + df.vy**2)
+        return df
+    
+
+def track_bumps(sim, **kwargs):
+    """
+    Tracks the bumps of each population by walking through the spike archive 
+    on disk file by file (c.f. ``BumpTracker``). 
+    
+    :param kwargs: keyword arguments of ``BumpTracker``
+    :return: dictionary of population names to trajectory tables
+    :rtype: dict
+    """
+    trajs = {}
+    for mon in sim.get_pop_mons():
+        tracker = BumpTracker(mon.source.gs, **kwargs)
         
+        for data in iter_mons(sim, mon.name):
+            tracker.update(idx2coords(data['i'], mon.source), data['t'])
+            del data
         
-        # SPEED
-        # fig = plt.figure()
-        # ax = fig.add_subplot()
-        # sns.scatterplot(data=disp[disp.index>-1], x='t', y='v', hue='label', ax=ax)
+        trajs[mon.source.name] = tracker.finalize()
+    return trajs
+
+
+def compute_speed(sim, plot=True, **kwargs):
+    """
+    Computes the trajectories and velocities of the bumps (c.f. 
+    ``track_bumps``), saves them as csv files in the results folder and 
+    optionally plots the distribution of speeds.
+    
+    :return: dictionary of population names to trajectory tables
+    :rtype: dict
+    """
+    from anisonet import viz
+    
+    trajs = track_bumps(sim, **kwargs)
+    for pop, df in trajs.items():
+        df.to_csv(osjoin(sim.res_path, 'bump_trajectories_'+pop+'.csv'), 
+                  index=False)
+        print('Population {}: {} bump tracks, median speed {:.1f} grid/s'.format(
+              pop, df.track.nunique(), df.speed.median()))
+        
+        if plot:
+            viz.plot_bump_speed(sim, df, pop)
+    
+    return trajs
         
-def connectivity_manifold(w, ncomp=2):
-    spectral = manifold.SpectralEmbedding(n_components = ncomp, 
-                                          affinity='precomputed')
-    return spectral.fit_transform(w)  
+def realized_landscape(pres, posts, gs_s, gs_t, weights=None, 
+                       chunk_size=2**22):
+    """
+    Computes the realized anisotropy of a pathway from its flat synapse 
+    arrays. For every synapse, the location of the post-synapse relative to 
+    its pre-synapse is computed on the target grid (periodic, c.f. 
+    ``utils.get_post_rel_locs``), and these offsets (optionally weighted) are
+    averaged per pre-synapse with ``np.bincount``. The realized 
+    :math:`\\phi` is the angle and :math:`r` the length of the mean offset. 
+    Pre-synapses without any post-synapse get zero for both.
     
+    Synapses are processed in chunks of ``chunk_size`` to bound the memory of
+    the intermediate arrays, which makes a single pass over tens of millions 
+    of synapses feasible.
     
-def find_manifold(sim, plot=True):
-    from scipy.ndimage import gaussian_filter
+    :param pres: pre-synaptic indices (``syn.i``)
+    :type pres: array
+    :param posts: post-synaptic indices (``syn.j``)
+    :type posts: array
+    :param gs_s: grid size of the source population
+    :type gs_s: int
+    :param gs_t: grid size of the target population
+    :type gs_t: int
+    :param weights: per-synapse weights of the offsets (a scalar is 
+        broadcast), defaults to None (unweighted)
+    :type weights: array or float, optional
+    :param chunk_size: number of synapses processed at once, defaults to 2**22
+    :type chunk_size: int, optional
+    :return: realized phi and r, each of length ``gs_s**2``
+    :rtype: tuple of arrays
+    """
+    pres = np.asarray(pres)
+    posts = np.asarray(posts)
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), pres.shape)
     
-    pop_mons = sim.get_pop_mons()
+    N = gs_s**2
+    counts = np.zeros(N)
+    mx = np.zeros(N)
+    my = np.zeros(N)
+    for start in range(0, len(pres), chunk_size):
+        sl = slice(start, start+chunk_size)
+        i = pres[sl]
+        
+        # pre-synapse locations mapped onto the target grid
+        s_y, s_x = np.divmod(i, gs_s)
+        s_x = np.round(s_x*gs_t/gs_s*1.)
+        s_y = np.round(s_y*gs_t/gs_s*1.)
+        t_y, t_x = np.divmod(posts[sl], gs_t)
+        
+        dx = (t_x - s_x + gs_t/2) % gs_t - gs_t/2
+        dy = (t_y - s_y + gs_t/2) % gs_t - gs_t/2
+        if weights is not None:
+            dx *= weights[sl]
+            dy *= weights[sl]
+        
+        counts += np.bincount(i, minlength=N)
+        mx += np.bincount(i, weights=dx, minlength=N)
+        my += np.bincount(i, weights=dy, minlength=N)
     
-    for id_, mon in enumerate(pop_mons):
-        mon_dict = aggregate_mons(sim, mon.name, SI=True)
-        idxs, ts = mon_dict['i'], mon_dict['t']
-        coords = idx2coords(idxs, mon.source)
-        xyt = np.stack((*coords.T, ts)).T
-        
-        i = idxs
-        j = (ts/(sim.dt/second)).astype(int)
-        j -= j.min()
-        
-        Ni = mon.source.N
-        Nj = max(j)+1
-        set_trace()
-        
-        print(f'I want to make a sparse matrix, make it dense, and load onnectivity at {time.ctime()}')
-        X = sparse.coo_matrix((np.ones_like(i), (i,j)), shape = (Ni, Nj))
-        X = X.toarray()
-        w = sparse.load_npz(osjoin(sim.data_path, 
-                                   sim.name + '_w_'+ 2 * mon.source.name+'.npz'))
-        print(f'Now I want to start fitting at {time.ctime()}')
-        ward = AgglomerativeClustering(n_clusters=6, 
-                                       connectivity=w, 
-                                       linkage="ward").fit(X)
-        print(f'Done at {time.ctime()}')
-        
-        labels = ward.labels_
-        #bumps = DBSCAN(eps=1.23, min_samples=100).fit(xyt); 
-        print('Number of clusters found: {}'.format(len(set(labels))))
+    mx /= np.maximum(counts, 1)
+    my /= np.maximum(counts, 1)
+    
+    phi = np.arctan2(my, mx)
+    r = np.sqrt(mx**2 + my**2)
+    phi[counts==0] = 0
+    return phi, r
+
+def aniso_weights(syn, weight='J', chunk_size=2**22):
+    """
+    The effective anisotropy of a pathway given its current synaptic state. 
+    Like ``realized_landscape``, but each offset is weighted by ``weight``, 
+    which is either the name of a synaptic variable (e.g., ``'J'`` or 
+    ``'w'``; its unitless value is used), a callable that returns the weights
+    of the synapses (e.g., ``lambda syn: syn.u_[:]*syn.x_[:]``), or an array 
+    of weights. It can be called between the batches of a simulation to track
+    how the effective anisotropy evolves with training.
+    
+    :param syn: synapse object
+    :type syn: Brian's Synapses object
+    :param weight: synaptic weights, defaults to 'J'
+    :type weight: str, callable or array, optional
+    :param chunk_size: c.f. ``realized_landscape``, defaults to 2**22
+    :type chunk_size: int, optional
+    :return: effective phi and r, each of length of the source population
+    :rtype: tuple of arrays
+    """
+    if type(weight)==str:
+        if weight not in syn.variables:
+            raise KeyError('Synapse {} does not have the variable {}.'.format(
+                syn.name, weight))
+        weights = getattr(syn, weight+'_')[:]
+    elif callable(weight):
+        weights = weight(syn)
+    else:
+        weights = weight
+    
+    return realized_landscape(syn.i.__array__(), syn.j.__array__(), 
+                              syn.source.gs, syn.target.gs, weights, 
+                              chunk_size)
+    
+def connectivity_manifold(w, ncomp=2, solver='arpack', cache_dir=None, 
+                          seed=0):
+    """
+    Spectral embedding of the neurons based on their connectivity. The 
+    connectivity matrix is symmetrized (:math:`A = (W + W^T)/2`, without 
+    self-links), and the eigenvectors of the normalized Laplacian 
+    :math:`L = I - D^{-1/2} A D^{-1/2}` with the smallest eigenvalues are 
+    computed sparsely. These are the eigenvectors of 
+    :math:`M = D^{-1/2} A D^{-1/2}` with the largest eigenvalues, which 
+    converge fast with matrix-vector products only (no factorization), either
+    by:
+        
+        * ``'arpack'``: ARPACK's Lanczos iterations, or
+        * ``'lobpcg'``: LOBPCG, initialized with the (known) trivial 
+          eigenvector :math:`\\sqrt{D}` and random vectors.
+    
+    The trivial eigenvector is dropped, and the rest are scaled by 
+    :math:`D^{-1/2}` and their signs are fixed, like sklearn's 
+    ``SpectralEmbedding``. If ``cache_dir`` is given, the embedding is cached
+    there per connectivity fingerprint, and computed only once.
+    
+    :param w: connectivity matrix
+    :type w: scipy sparse matrix
+    :param ncomp: number of dimensions, defaults to 2
+    :type ncomp: int, optional
+    :param solver: ``'arpack'`` or ``'lobpcg'``, defaults to 'arpack'
+    :type solver: str, optional
+    :param cache_dir: folder for caching the embeddings, defaults to None
+    :type cache_dir: str, optional
+    :param seed: seed of the initial guess, defaults to 0
+    :type seed: int, optional
+    :return: embedding with shape (number of neurons, ncomp)
+    :rtype: array
+    """
+    from scipy.sparse.linalg import eigsh, lobpcg
+    from anisonet.utils import fingerprint
+    
+    # the eigenvalues of periodic grids are degenerate, and Lanczos finds all
+    # copies of a multiple eigenvalue only at machine precision
+    tol = 0 if solver=='arpack' else 1e-6
+    
+    w = sparse.csr_matrix(w, dtype=float)
+    if cache_dir is not None:
+        w.sort_indices()
+        key = fingerprint(w.shape, w.indptr, w.indices, w.data, ncomp, solver, 
+                          tol)
+        path = osjoin(cache_dir, 'manifold_{}.npy'.format(key))
+        if os.path.exists(path):
+            print('\tLoading the cached connectivity embedding {}'.format(key))
+            return np.load(path)
+    
+    A = (w + w.T)/2.
+    A.setdiag(0)
+    A.eliminate_zeros()
+    deg = np.asarray(A.sum(axis=1)).ravel()
+    dd = 1./np.sqrt(np.maximum(deg, 1e-12))
+    Dn = sparse.diags(dd)
+    M = (Dn @ A @ Dn).tocsr()
+    
+    rng = np.random.RandomState(seed)
+    k = ncomp + 1
+    if solver=='lobpcg':
+        X0 = rng.uniform(-1, 1, (A.shape[0], k))
+        X0[:,0] = np.sqrt(deg)
+        vals, vecs = lobpcg(M, X0, largest=True, tol=tol, maxiter=500)
+    elif solver=='arpack':
+        v0 = rng.uniform(-1, 1, A.shape[0])
+        vals, vecs = eigsh(M, k=k, which='LA', tol=tol, v0=v0)
+    else:
+        raise NotImplementedError('Solver {} is not recognized.'.format(solver))
+    
+    # from the largest eigenvalue of M (i.e., the smallest of L) on
+    vecs = vecs[:, np.argsort(vals)[::-1]]
+    embedding = vecs[:, 1:k] * dd[:,None]
+    
+    # deterministic signs: the largest entry of each vector is positive
+    signs = np.sign(embedding[np.abs(embedding).argmax(axis=0), range(ncomp)])
+    embedding *= signs
+    
+    if cache_dir is not None:
+        np.save(path, embedding)
+    return embedding
+    
+    
+def find_manifold(sim, plot=True, bin_width=10e-3, sigma=None, ncomp=10, 
+                  n_clusters=6, mem_budget=1024):
+    """
+    Clusters the neurons by their activity, using the connectivity as 
+    structure. The spike trains are binned coarsely into a sparse raster (c.f.
+    ``utils.make_full_train``), reduced to ``ncomp`` dimensions with a 
+    randomized truncated SVD (which works on the sparse raster directly), and
+    the neurons are clustered in the reduced space by a Ward agglomerative 
+    clustering constrained by the connectivity matrix.
+    
+    If the raster and the SVD would need more than ``mem_budget`` MB, the 
+    bins are widened until they fit, as estimated before the raster is built.
+    If even a single bin does not fit, a ``MemoryError`` is raised. The 
+    timing of each step is recorded in ``sim.timer``.
+    
+    :param bin_width: bin width in seconds, defaults to 10e-3
+    :type bin_width: float, optional
+    :param sigma: width of the Gaussian smoothing in seconds, defaults to None
+    :type sigma: float, optional
+    :param ncomp: number of SVD components, defaults to 10
+    :type ncomp: int, optional
+    :param n_clusters: number of clusters, defaults to 6
+    :type n_clusters: int, optional
+    :param mem_budget: memory budget in MB, defaults to 1024
+    :type mem_budget: float, optional
+    :return: dictionary of population names to (embedding, labels)
+    :rtype: dict
+    """
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.cluster import AgglomerativeClustering
+    from anisonet.utils import make_full_train, spike_summary
+    from anisonet import viz
+    
+    def get_nbins(span, bw):
+        return max(int(np.ceil(span/bw - 1e-9)), 1) # as in make_full_train
+    
+    def estimate_mem(N, nspikes, span, bw):
+        # raster (CSR of float32) + randomized SVD's working matrices, in MB
+        nbins = get_nbins(span, bw)
+        spread = 1 if sigma is None else 2*int(np.ceil(4*sigma/bw)) + 1
+        nnz = min(nspikes*spread, N*nbins)
+        k = ncomp + 10 # with the default oversampling
+        return (8*nnz + 4*(N + 1) + 8*k*(N + nbins))/1024.**2
+    
+    res = {}
+    for mon in sim.get_pop_mons():
+        name = mon.source.name
+        
+        with sim.timer.phase('manifold '+name, 
+                             'Finding the activity manifold of '+name):
+            with sim.timer.phase('raster'):
+                N = len(mon.source)
+                nspikes, t_min, t_max = spike_summary(sim, mon.name)
+                span = t_max - t_min
+                
+                bw = bin_width
+                mem = estimate_mem(N, nspikes, span, bw)
+                while mem > mem_budget:
+                    if get_nbins(span, bw)==1:
+                        raise MemoryError(
+                            'The activity manifold of {} needs {:.1f} MB even with a '
+                            'single bin, more than the budget of {} MB.'.format(
+                            name, mem, mem_budget))
+                    bw *= 2
+                    new_mem = estimate_mem(N, nspikes, span, bw)
+                    print('\tRaster needs {:.1f} MB; widening the bins to {} s ({:.1f} MB).'.format(
+                          mem, bw, new_mem))
+                    mem = new_mem
+                
+                X, edges = make_full_train(sim, mon.name, bin_width=bw, 
+                                           sigma=sigma)
+            
+            with sim.timer.phase('svd', 'Reducing a {}x{} raster to {} components.'.format(
+                    *X.shape, ncomp)):
+                svd = TruncatedSVD(n_components=ncomp, algorithm='randomized',
+                                   random_state=sim.seed)
+                Y = svd.fit_transform(X)
+            
+            with sim.timer.phase('clustering', 'Clustering the neurons.'):
+                w = load_connectivity(sim, 2*name)
+                w = sparse.coo_matrix((w.data, (w.row, w.col)), 
+                                      shape=(X.shape[0], X.shape[0]))
+                ward = AgglomerativeClustering(n_clusters=n_clusters, 
+                                               connectivity=w, 
+                                               linkage="ward").fit(Y)
+            
+            labels = ward.labels_
+            print('Number of clusters found: {}'.format(len(set(labels) - {-1})))
         
-        #if plot:
-        #    plot_3d_clusters(sim, xyt, labels, mon.name)
-            #viz.plot_3d_clusters(sim, scsct[:,[0,2,-1]], labels, mon.name)
-            # viz.plot_3d_clusters(sim, scsct[:,[1,3,-1]], labels, mon.name)
+        if plot:
+            viz.plot_activity_manifold(sim, Y, labels, name)
         
-    #     bumps[mon.source.name] = np.stack((*coords.T, ts, labels)).T
+        res[name] = (Y, labels)
         
-    return ward
-    
+    return res
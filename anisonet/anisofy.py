@@ -564,6 +564,8 @@ def make_anisotropic_syn(s_loc, t_locs, gs, anisotropy, method):
             aniso_var = var_min + var_amp * (1+transform(phis))/2.
             
             syn_pars[var+'s'] = aniso_var        
+    elif method==None:
+        pass # isotropic synapses
     else:
         raise NotImplementedError('The anisotropic method is not recognized.')
     
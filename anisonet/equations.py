@@ -192,6 +192,13 @@ def get_nrn_eqs(pop_name, pops_cfg):
     NEST and the paper are using a "current-alpha", as opposed to "voltage-" or
     "conductance-". Look at `source code`_ for more details.
     
+    Neurons are stimulated by a constant ``I_stim`` plus a time-varying 
+    stimulus read from the 2D ``TimedArray`` called ``stim_<pop_name>`` at
+    the column ``stim_idx`` (c.f. ``Simulate.set_protocol``). The table 
+    starts at the network time ``stim_t0``, and the stimulus is zero before
+    it. The ``TimedArray`` must be provided in the namespace of the 
+    population.
+    
     :param pop_name: population name
     :type pop_name: str
     :param pops_cfg: population configuration
@@ -209,6 +216,9 @@ def get_nrn_eqs(pop_name, pops_cfg):
         sigma: amp (shared)
         noise_pop = mu + sigma*sqrt(noise_dt)*xi_pop: amp
         I_stim: amp
+        stim_idx: integer (constant)
+        stim_t0: second (shared, constant)
+        I_stim_tot = I_stim + int(t >= stim_t0)*stim_pop(t - stim_t0, stim_idx): amp
         '''
         
     noise_dt = pops_cfg[pop_name]['noise']['noise_dt']
@@ -217,7 +227,7 @@ def get_nrn_eqs(pop_name, pops_cfg):
     model = pops_cfg[pop_name]['input_model']
     
     if model in ['conductance', 'current']:
-        eqs_str= tmp + '''dv/dt = (E-v)/tau + (noise_pop + I_syn + I_stim)/C : volt (unless refractory)\n'''
+        eqs_str= tmp + '''dv/dt = (E-v)/tau + (noise_pop + I_syn + I_stim_tot)/C : volt (unless refractory)\n'''
         I_syn_components = []
         for src_name in pops_cfg.keys():
             eqs_str+= '''I_syn_{}: amp \n'''.format(src_name)
@@ -225,7 +235,7 @@ def get_nrn_eqs(pop_name, pops_cfg):
         eqs_str+= 'I_syn = '+ '+'.join(I_syn_components) +': amp \n'''
         
     else:
-        eqs_str= tmp + '''dv/dt = (E-v)/tau + (noise_pop + I_stim)/C : volt (unless refractory)\n'''
+        eqs_str= tmp + '''dv/dt = (E-v)/tau + (noise_pop + I_stim_tot)/C : volt (unless refractory)\n'''
         
     eqs_str = eqs_str.replace('_pop', '_'+pop_name)
     eqs = b2.Equations(eqs_str, 
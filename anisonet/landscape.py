@@ -11,7 +11,7 @@ The following landscape types are supported:
     
     #. **None**: a uniformly random landscape
     #. **constant**: a homogenous landscape
-    #. **Perlin-noise**: a landscape based on perlin distribution
+    #. **Perlin-noise**: a landscape based on (periodic) Perlin noise
     #. **numpy**: a landscape based on supported distribution by `[numpy]`_
 
 Examples below illustrate valid landscape configurations and their structures:
@@ -22,6 +22,7 @@ Examples below illustrate valid landscape configurations and their structures:
     None, # a uniformly random landscape between (0,1)
     .314,  # a homogenous landscape between of value 0.314
     {'type': 'perlin', 'args': {'scale': ...} }, # Perlin-based
+    {'type': 'perlin', 'args': {'scale': ..., 'octaves': ..., 'seed': ...} }
     {'type': 'beta', 'args': {'a': ..., 'b': ...} }, # numpy beta
     {'type': 'binomial', 'args': {'n': ..., 'p': ...} }, # numpy binomial
     {'type': 'logistic', 'args': {'loc': ..., 'scale': ...} }, # numpy logisitc
@@ -30,18 +31,123 @@ Examples below illustrate valid landscape configurations and their structures:
     {'type': 'poisson', 'args': {'lam': ...} }, # numpy poissonian
     ... # other numpy distributions
 
+Landscapes of a network are held in a ``LandscapeRegistry`` which generates
+each field once per (source population, parameter, configuration, seed) and
+shares it among all pathways requesting the same one. A configuration 
+dictionary may carry its own ``'seed'`` to decouple otherwise identical 
+fields. Perlin fields are seeded from the same key, unless a seed is given 
+in their ``'args'``.
 
 .. _[numpy]: https://numpy.org/doc/stable/reference/random/generator.html#distributions
 
 """
 
+import os
 import numpy as np
-from noise import pnoise2 as perlin    
 from pdb import set_trace
 #TODO: emphasize in the docs that lanscape is reserved for anisotropy
 
+# Ken Perlin's reference permutation
+_perm = np.array([
+    151, 160, 137,  91,  90,  15, 131,  13, 201,  95,  96,  53, 194, 233,   7, 225,
+    140,  36, 103,  30,  69, 142,   8,  99,  37, 240,  21,  10,  23, 190,   6, 148,
+    247, 120, 234,  75,   0,  26, 197,  62,  94, 252, 219, 203, 117,  35,  11,  32,
+     57, 177,  33,  88, 237, 149,  56,  87, 174,  20, 125, 136, 171, 168,  68, 175,
+     74, 165,  71, 134, 139,  48,  27, 166,  77, 146, 158, 231,  83, 111, 229, 122,
+     60, 211, 133, 230, 220, 105,  92,  41,  55,  46, 245,  40, 244, 102, 143,  54,
+     65,  25,  63, 161,   1, 216,  80,  73, 209,  76, 132, 187, 208,  89,  18, 169,
+    200, 196, 135, 130, 116, 188, 159,  86, 164, 100, 109, 198, 173, 186,   3,  64,
+     52, 217, 226, 250, 124, 123,   5, 202,  38, 147, 118, 126, 255,  82,  85, 212,
+    207, 206,  59, 227,  47,  16,  58,  17, 182, 189,  28,  42, 223, 183, 170, 213,
+    119, 248, 152,   2,  44, 154, 163,  70, 221, 153, 101, 155, 167,  43, 172,   9,
+    129,  22,  39, 253,  19,  98, 108, 110,  79, 113, 224, 232, 178, 185, 112, 104,
+    218, 246,  97, 228, 251,  34, 242, 193, 238, 210, 144,  12, 191, 179, 162, 241,
+     81,  51, 145, 235, 249,  14, 239, 107,  49, 192, 214,  31, 181, 199, 106, 157,
+    184,  84, 204, 176, 115, 121,  50,  45, 127,   4, 150, 254, 138, 236, 205,  93,
+    222, 114,  67,  29,  24,  72, 243, 141, 128, 195,  78,  66, 215,  61, 156, 180,
+    ])
+
+# gradients of the improved noise (only x and y components are used in 2D)
+_grad = np.array([[ 1, 1], [-1, 1], [ 1,-1], [-1,-1], 
+                  [ 1, 0], [-1, 0], [ 1, 0], [-1, 0], 
+                  [ 0, 1], [ 0,-1], [ 0, 1], [ 0,-1],
+                  [ 1, 0], [-1, 0], [ 0,-1], [ 0, 1]], dtype=float)
+
+def _noise2(x, y, repeatx, repeaty, perm):
+    """A single octave of the 2D improved Perlin noise, on arrays."""
+    i = np.floor(np.fmod(x, repeatx)).astype(int)
+    j = np.floor(np.fmod(y, repeaty)).astype(int)
+    ii = np.fmod(i + 1, repeatx).astype(int) & 255
+    jj = np.fmod(j + 1, repeaty).astype(int) & 255
+    i &= 255
+    j &= 255
+    
+    x = x - np.floor(x)
+    y = y - np.floor(y)
+    fx = x**3 * (x * (x * 6 - 15) + 10)
+    fy = y**3 * (y * (y * 6 - 15) + 10)
+    
+    A, B = perm[i], perm[ii]
+    AA, AB, BA, BB = perm[A + j], perm[A + jj], perm[B + j], perm[B + jj]
+    
+    def grad(h, x, y):
+        g = _grad[perm[h] & 15]
+        return x*g[..., 0] + y*g[..., 1]
+    
+    def lerp(t, a, b):
+        return a + t*(b - a)
+    
+    return lerp(fy, lerp(fx, grad(AA, x, y), grad(BA, x-1, y)),
+                    lerp(fx, grad(AB, x, y-1), grad(BB, x-1, y-1)))
+
+def perlin(x, y, repeatx=1024, repeaty=1024, octaves=1, persistence=0.5, 
+           lacunarity=2., seed=None):
+    """
+    Vectorized 2D Perlin (improved gradient) noise, evaluated at all points 
+    of ``x`` and ``y`` at once. The noise is periodic with periods 
+    ``repeatx`` and ``repeaty``, and with the default arguments it is the 
+    same as ``pnoise2`` of the ``noise`` package.
+    
+    :param x: x-coordinates
+    :type x: array
+    :param y: y-coordinates (broadcastable with ``x``)
+    :type y: array
+    :param repeatx: period along x, defaults to 1024
+    :type repeatx: float, optional
+    :param repeaty: period along y, defaults to 1024
+    :type repeaty: float, optional
+    :param octaves: number of octaves, defaults to 1
+    :type octaves: int, optional
+    :param persistence: amplitude ratio of successive octaves, defaults to 
+        0.5
+    :type persistence: float, optional
+    :param lacunarity: frequency ratio of successive octaves, defaults to 2.
+    :type lacunarity: float, optional
+    :param seed: seed of the permutation table, defaults to None (Perlin's 
+        reference table)
+    :type seed: int, optional
+    :return: noise values, roughly within (-1, 1)
+    :rtype: array
+    """
+    perm = _perm if seed is None else np.random.default_rng(seed).permutation(256)
+    perm = np.tile(perm, 2)
+    
+    # single precision as in the reference implementation
+    x = np.asarray(x, dtype=np.float32).astype(float)
+    y = np.asarray(y, dtype=np.float32).astype(float)
+    
+    total, norm = 0., 0.
+    freq, amp = 1., 1.
+    for _ in range(octaves):
+        total = total + amp*_noise2(x*freq, y*freq, repeatx*freq, 
+                                    repeaty*freq, perm)
+        norm += amp
+        freq *= lacunarity
+        amp *= persistence
+    return total/norm
+
 def make_landscape(gs, lscp_cfg, vmin=-np.pi, vmax=np.pi, balance=False,
-                   n_levels =None):
+                   n_levels =None, rng=None):
     """
     Makes a landscape according for a square grid of size ``gs`` using the 
     landscape configuration ``lscp_cfg`` which be either a constant (float) or
@@ -59,6 +165,9 @@ def make_landscape(gs, lscp_cfg, vmin=-np.pi, vmax=np.pi, balance=False,
     :type vmin: float, optional
     :param vmax: maximum value in the landscape, float, defaults to -np.pi
     :type vmax: float, optional
+    :param rng: random generator of the random landscapes, defaults to None
+        (numpy's global random state)
+    :type rng: np.random.Generator, optional
     
     :return: flattened array
     :rtype: np.array of float
@@ -75,15 +184,19 @@ def make_landscape(gs, lscp_cfg, vmin=-np.pi, vmax=np.pi, balance=False,
         
         
         if lscp_cfg['type'] == 'random':
-            lscp = np.random.uniform(vmin, vmax, size=gs**2)
+            if rng==None:
+                lscp = np.random.uniform(vmin, vmax, size=gs**2)
+            else:
+                lscp = rng.uniform(vmin, vmax, size=gs**2)
         
         elif lscp_cfg['type'] =='perlin':
             assert 'scale' in lscp_cfg['args'],"scale value is needed for perlin landscape"
             
-            s = lscp_cfg['args']['scale']
+            args = dict(lscp_cfg['args'])
+            s = args.pop('scale')
             x = y = np.linspace(0, s, gs)
-            lscp = [[perlin(i, j, repeatx=s, repeaty=s) for j in y] for i in x]
-            lscp = np.concatenate(lscp)
+            x, y = np.meshgrid(x, y, indexing='ij')
+            lscp = perlin(x, y, repeatx=s, repeaty=s, **args).ravel()
             
             # normalize to the range and balance the histogram
             lscp = balance_landscape(lscp)
@@ -93,7 +206,10 @@ def make_landscape(gs, lscp_cfg, vmin=-np.pi, vmax=np.pi, balance=False,
 #            set_trace()
 
         else:
-            distro = eval('np.'+lscp_cfg['type'])
+            if rng==None:
+                distro = eval('np.'+lscp_cfg['type'])
+            else:
+                distro = getattr(rng, lscp_cfg['type'])
             lscp = distro(**lscp_cfg['args'], size=gs**2)
         
             
@@ -103,117 +219,87 @@ def make_landscape(gs, lscp_cfg, vmin=-np.pi, vmax=np.pi, balance=False,
         
     return lscp
 
-    # lscp = {}
+
+class LandscapeRegistry(object):
+    """
+    Generates and holds the landscapes of a network. Each field is keyed by 
+    its source population, parameter, configuration and seed, and is made 
+    only once; pathways requesting the same key share the same array. The
+    random draws of every field (including the permutation of Perlin fields,
+    unless their ``'args'`` carry a seed) come from a generator seeded by the
+    key, such that a field does not depend on which other fields were made 
+    before it. Only the fields requested from the registry (``used``) are 
+    saved.
+    """
     
-    # if lscp_cfg == None:
-    #     return lscp
+    def __init__(self, seed=None):
+        """
+        :param seed: default seed of the fields, defaults to None
+        :type seed: int, optional
+        """
+        self.seed = seed
+        self.fields = {}
+        self.used = set()
     
-    # else:
-    #     for key, key_cfg in lscp_cfg['params'].items():
-    #         if type(key_cfg) != type({}): # a single value (equivalent to homogeneous)
-    #             lscp[key] = np.ones(gs**2) * key_cfg
-            
-    #         elif key_cfg['type']=='homogeneous':
-    #             lscp[key] = np.ones(gs**2) * key_cfg['value']
-            
-    #         else:
-    #             assert key!='r', "I don't know how to intialized r randomly for now."
-    #             # TODO: Needs clarification of what does random or perlin mean for r
-    #             # here the assumption is only phi is provided as random
-                
-    #             if key_cfg['type']=='random':
-    #                 phis = np.random.uniform(-np.pi, np.pi, size=gs**2)
-                    
-    #             elif key_cfg['type']=='perlin':
-    #                 assert 'scale' in key_cfg.keys(),"scale value is needed for perlin landscape"
-    #                 scale = key_cfg['scale']
-    #                 x = y = np.linspace(0, scale, gs)
-    #                 phis = [[perlin(i, j, repeatx=scale, repeaty=scale) 
-    #                          for j in y] for i in x]
-    #                 phis = np.concatenate(phis)
-                    
-    #                 # to flatten the histogram of phis, one has to adjust the phi values
-    #                 sorted_idx = np.argsort(phis)
-    #                 max_val = gs * 2
-    #                 idx = len(phis) // max_val
-    #                 for ii, val in enumerate(range(max_val)):
-    #                     phis[sorted_idx[ii * idx:(ii + 1) * idx]] = val
-    #                 phis = (phis - gs) / gs
-                    
-    #                 # to push between -pi and pi
-    #                 phis -= np.min(phis)
-    #                 phis *= 2*np.pi/(np.max(phis)+1e-12)
-    #                 phis -= np.pi
-                
-    #             lscp[key] = phis
+    def get_key(self, src, gs, param, lscp_cfg):
+        from anisonet.utils import fingerprint
         
-    #     return lscp
+        seed = self.seed
+        if type(lscp_cfg) == type({}):
+            seed = lscp_cfg.get('seed', seed)
+        return '{}_{}_{}'.format(src, param, 
+                                 fingerprint(src, gs, param, lscp_cfg, seed))
     
-    #     phis = bins[np.digitize(phis, bins, True)]
+    def get(self, src, gs, param, lscp_cfg):
+        """
+        Returns the landscape of parameter ``param`` of the source population
+        ``src`` (of grid size ``gs``), and makes it if it does not exist.
         
-    
-    # if config==None:
-    # 	ls_type = 'iso'
-    # else:	
-    #     ls_type = config['type']
-    #     ls_params = config['params']
-    
-    # if ls_type=='homogeneous':
-    #     assert 'phi' in ls_params.keys(), "phi value is needed for landscape "+ls_type
-    #     assert 'r' in ls_params.keys(), "r value is needed for landscape "+ls_type
+        :return: flattened array
+        :rtype: np.array of float
+        """
+        key = self.get_key(src, gs, param, lscp_cfg)
+        if key not in self.fields:
+            seed = int(key.rsplit('_', 1)[-1], 16)
+            if type(lscp_cfg) == type({}) and lscp_cfg['type'] == 'perlin' \
+                and ('seed' not in lscp_cfg['args']):
+                lscp_cfg = dict(lscp_cfg, args=dict(lscp_cfg['args'], seed=seed))
+            rng = np.random.default_rng(seed)
+            self.fields[key] = make_landscape(gs, lscp_cfg, rng=rng)
         
-    #     phis = np.ones(gs**2, dtype=float)*ls_params['phi']
-    #     rs = np.ones(gs**2, dtype=int)*ls_params['r']
+        self.used.add(key)
+        return self.fields[key]
     
-    # elif ls_type=='perlin':
-    #     assert 'scale' in ls_params.keys(),"scale value is needed for landscape "+ls_type
-    #     assert 'r' in ls_params.keys(), "r value is needed for landscape "+ls_type
-        
-    #     x = y = np.linspace(0, ls_params['scale'], gs)
-    #     phis = [[perlin(i, j, repeatx=ls_params['scale'], repeaty=ls_params['scale']) 
-    #              for j in y] for i in x]
-    #     phis = np.concatenate(phis)
-        
-    #     # to flatten the histogram of phis, one has to adjust the 
-    #     # phi values
-    #     sorted_idx = np.argsort(phis)
-    #     max_val = gs * 2
-    #     idx = len(phis) // max_val
-    #     for ii, val in enumerate(range(max_val)):
-    #         phis[sorted_idx[ii * idx:(ii + 1) * idx]] = val
-    #     phis = (phis - gs) / gs
-        
-    #     # to push between -pi and pi
-    #     phis -= np.min(phis)
-    #     phis *= 2*np.pi/(np.max(phis)+1e-12)
-    #     phis -= np.pi
-        
-    #     rs = np.ones(gs**2, dtype=int)*ls_params['r']
-   
-    # elif ls_type=='random':
-    #     phis = np.random.uniform(-np.pi, np.pi, size=gs**2)
-    #     rs = np.ones(gs**2, dtype=int)*ls_params['r']
-   
-    # elif ls_type=='iso':
-    #     phis = np.random.uniform(-np.pi, np.pi, size=gs**2)
-    #     rs = np.zeros(gs**2, dtype=int)
-        
-    # else:
-    #     raise 'Landscape type not recognized!'
+    def save(self, path):
+        np.savez(path, **{key: self.fields[key] for key in sorted(self.used)})
     
-    # if digitize:
-    #     _, bins = np.histogram(phis, bins=8)
-    #     phis = bins[np.digitize(phis, bins, True)]
-        
-    # return rs, phis
+    def load(self, path):
+        """
+        Adds the fields stored in ``path`` (c.f. ``save``) to the registry. 
+        Returns whether the file existed.
+        """
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            for key in data.files:
+                self.fields[key] = data[key]
+        return True
+
 
 def balance_landscape(array):
+    """
+    Flattens the histogram of a landscape of ``gs**2`` values by replacing 
+    them with their rank level out of ``2*gs`` equally populated levels, 
+    mapped to [-1, 1). Modifies ``array`` in-place.
+    """
     sorted_idx = np.argsort(array)
     gs = int(np.sqrt(len(array)))
     max_val = gs * 2
     idx = len(array) // max_val
-    for i, val in enumerate(range(max_val)):
-        array[sorted_idx[i * idx:(i + 1) * idx]] = val
+    
+    levels = np.arange(len(array)) // idx
+    leveled = levels < max_val # the remainder (if any) is left untouched
+    array[sorted_idx[leveled]] = levels[leveled]
     
     return (array- gs) / gs
     
\ No newline at end of file
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Post-processing as a small task graph. Each task (a plot or an analysis) 
+declares the inputs it depends on, e.g., the recorded monitors or the 
+connectivity matrices. Running the graph:
+
+    #. skips the tasks whose inputs (and parameters) did not change since 
+       their last successful run, as recorded in ``postprocess.json`` in the 
+       results folder, and whose output files still exist,
+    #. loads the inputs needed by the remaining tasks only once, in the main 
+       process (c.f. ``utils.memoizing``). Monitors are not loaded as a 
+       whole; only their (small) reductions are shared, such as the spike 
+       counts, while each task streams the archive itself,
+    #. runs the parallel tasks concurrently in forked worker processes which
+       share the loaded inputs, and the serial ones (e.g., those which use 
+       several processes themselves) in the main process.
+
+.. code-block:: python
+
+    sim.post_process()                          # only what changed
+    sim.post_process(tasks=['animation'])       # a subset of tasks
+    sim.post_process(force=True, n_jobs=1)      # everything, sequentially
+
+Forking is not available on Windows, where all tasks run sequentially.
+"""
+
+import os
+import glob
+import json
+import time
+import traceback
+import multiprocessing as mp
+osjoin = os.path.join # an alias for convenient
+
+import numpy as np
+
+import anisonet.utils as utils
+from anisonet.analyze import realized_landscape
+
+
+class Task(object):
+    """
+    A post-processing step: calls ``func(sim, **params)``.
+    """
+    
+    def __init__(self, name, func, inputs=(), params=None, parallel=True,
+                 outputs=()):
+        """
+        :param name: unique name of the task
+        :type name: str
+        :param func: function of the ``simulate`` object
+        :type func: callable
+        :param inputs: names of the inputs the task depends on (c.f. 
+            ``inputs``), defaults to ()
+        :type inputs: iterable of str, optional
+        :param params: keyword arguments of ``func``, defaults to None
+        :type params: dict, optional
+        :param parallel: whether the task can run in a worker process, 
+            defaults to True
+        :type parallel: bool, optional
+        :param outputs: files written by the task, relative to the results
+            folder (glob patterns are allowed). The task is run again if any 
+            of them is missing, defaults to ()
+        :type outputs: iterable of str, optional
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.parallel = parallel
+        self.outputs = list(outputs)
+    
+    def has_outputs(self, sim):
+        return all(len(glob.glob(osjoin(sim.res_path, pattern))) 
+                   for pattern in self.outputs)
+    
+    def signature(self, input_sigs):
+        return utils.fingerprint(self.name, self.func.__module__, 
+                                 self.func.__name__, sorted(self.params.items()),
+                                 [input_sigs[name] for name in self.inputs])
+
+
+# ----------------------------------------------------------------------------
+# Inputs: each one has a signature which changes with its content, a loader 
+# which loads it into the memo, and the inputs it is derived from.
+# ----------------------------------------------------------------------------
+def _mon_files(sim):
+    return glob.glob(osjoin(sim.data_path, sim.name+'_mon_*.dat'))
+
+def _w_files(sim):
+    return glob.glob(osjoin(sim.data_path, sim.name+'_w_*.npz'))
+
+def _load_monitors(sim):
+    for mon in sim.get_pop_mons():
+        utils.spike_summary(sim, mon.name)
+        utils.spike_counts(sim, mon.name)
+
+def _load_connectivity(sim):
+    for pathway in sim.conn_cfg.keys():
+        utils.load_connectivity(sim, pathway)
+
+def _load_realized(sim):
+    for key, syn in sim.syns.items():
+        utils.memoize(sim, ('realized', key), 
+            lambda: realized_landscape(syn.i.__array__(), syn.j.__array__(), 
+                                       syn.source.gs, syn.target.gs))
+
+def _landscape_sig(sim):
+    return utils.fingerprint(*[(key, param, sim.lscp[key][param]) 
+                               for key in sorted(sim.lscp) 
+                               for param in sorted(sim.lscp[key])])
+
+def _synapses_sig(sim):
+    items = []
+    for key in sorted(sim.syns):
+        syn = sim.syns[key]
+        items += [key, syn.i.__array__(), syn.j.__array__()]
+        for var in ['J', 'w', 'U']:
+            if var in syn.variables:
+                items.append(np.asarray(getattr(syn, var+'_')[:]))
+    return utils.fingerprint(*items)
+
+inputs = {
+    'monitors': dict(signature=lambda sim: utils.files_signature(_mon_files(sim)),
+                     load=_load_monitors, deps=[]),
+    'connectivity': dict(signature=lambda sim: utils.files_signature(_w_files(sim)),
+                         load=_load_connectivity, deps=[]),
+    'realized': dict(signature=lambda sim: '', load=_load_realized,
+                     deps=['connectivity']),
+    'landscape': dict(signature=_landscape_sig, load=None, deps=[]),
+    'synapses': dict(signature=_synapses_sig, load=None, deps=[]),
+    }
+
+def get_input_sigs(sim, names):
+    """
+    Computes the signatures of the given inputs and of those they depend on.
+    The signature of a derived input includes the signatures of its 
+    dependencies.
+    """
+    sigs = {}
+    def visit(name):
+        if name not in sigs:
+            deps = [visit(dep) for dep in inputs[name]['deps']]
+            sigs[name] = utils.fingerprint(inputs[name]['signature'](sim), deps)
+        return sigs[name]
+    
+    for name in names:
+        visit(name)
+    return sigs
+
+def load_inputs(sim, names):
+    """Loads the inputs (after their dependencies) into the memo of ``sim``."""
+    done = set()
+    def visit(name):
+        if name in done:
+            return
+        for dep in inputs[name]['deps']:
+            visit(dep)
+        if inputs[name]['load'] is not None:
+            with sim.timer.phase(name):
+                inputs[name]['load'](sim)
+        done.add(name)
+    
+    for name in names:
+        visit(name)
+
+
+# ----------------------------------------------------------------------------
+# Running
+# ----------------------------------------------------------------------------
+_job = {} # the simulation and tasks, inherited by the forked workers
+
+def _run_task(name):
+    """Runs a task and returns (name, wall, cpu, error)."""
+    task = _job['tasks'][name]
+    t0, c0 = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        task.func(_job['sim'], **task.params)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        import matplotlib.pyplot as plt
+        plt.close('all')
+    return name, time.perf_counter() - t0, time.process_time() - c0, error
+
+def _get_pool(n_jobs):
+    if n_jobs==1:
+        return None
+    try:
+        ctx = mp.get_context('fork')
+    except ValueError: # e.g., on Windows
+        print('\tWarning: forking is not available. Running sequentially.')
+        return None
+    return ctx.Pool(n_jobs)
+
+def load_manifest(sim):
+    path = osjoin(sim.res_path, 'postprocess.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(sim, manifest):
+    with open(osjoin(sim.res_path, 'postprocess.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+def run_tasks(sim, tasks, only=None, n_jobs=None, force=False):
+    """
+    Runs the post-processing tasks of a simulation (c.f. module's 
+    description). Failing tasks are reported but do not stop the others, and
+    they are run again the next time.
+    
+    :param sim: ``simulate`` object
+    :type sim: object
+    :param tasks: post-processing tasks
+    :type tasks: list of ``Task``
+    :param only: names of the tasks to consider, defaults to None (all)
+    :type only: list of str, optional
+    :param n_jobs: number of worker processes, defaults to None (as many as 
+        CPUs)
+    :type n_jobs: int, optional
+    :param force: runs the tasks even if they are up to date, defaults to 
+        False
+    :type force: bool, optional
+    :return: names of the failed tasks
+    :rtype: list
+    """
+    if only is not None:
+        unknown = set(only) - set(task.name for task in tasks)
+        if len(unknown):
+            raise KeyError('Unknown task(s): {}'.format(', '.join(sorted(unknown))))
+        tasks = [task for task in tasks if task.name in only]
+    
+    manifest = load_manifest(sim)
+    input_sigs = get_input_sigs(sim, set(n for task in tasks for n in task.inputs))
+    sigs = {task.name: task.signature(input_sigs) for task in tasks}
+    
+    todo = []
+    for task in tasks:
+        if (not force) and manifest.get(task.name)==sigs[task.name] and \
+            task.has_outputs(sim):
+            print('\tSkipping {} (up to date).'.format(task.name))
+        else:
+            todo.append(task)
+    if len(todo)==0:
+        return []
+    
+    failed = []
+    def collect(result):
+        name, wall, cpu, error = result
+        sim.timer.add(name, wall, cpu)
+        if error is None:
+            manifest[name] = sigs[name]
+        else:
+            print('\tWarning: post-processing task {} failed:\n{}'.format(name, error))
+            manifest.pop(name, None)
+            failed.append(name)
+    
+    with utils.memoizing(sim):
+        with sim.timer.phase('inputs', 'Loading the shared inputs.'):
+            load_inputs(sim, set(n for task in todo for n in task.inputs))
+        
+        _job.update(sim=sim, tasks={task.name: task for task in todo})
+        try:
+            parallel = [task.name for task in todo if task.parallel]
+            serial = [task.name for task in todo if not task.parallel]
+            
+            msg = 'Running {} post-processing task(s).'.format(len(todo))
+            with sim.timer.phase('tasks', msg):
+                pool = None
+                if len(parallel)>1:
+                    pool = _get_pool(min(n_jobs or os.cpu_count(), len(parallel)))
+                if pool is None:
+                    serial = parallel + serial
+                else:
+                    with pool:
+                        pending = [pool.apply_async(_run_task, (name,)) 
+                                   for name in parallel]
+                        for name in serial: # meanwhile, in the main process
+                            collect(_run_task(name))
+                        serial = []
+                        for result in pending:
+                            collect(result.get())
+            
+                for name in serial:
+                    collect(_run_task(name))
+        finally:
+            _job.clear()
+    
+    save_manifest(sim, manifest)
+    return failed
@@ -19,14 +19,13 @@ sim.setup_net(init_cell='ss', init_syn='het')
 #             restore=False, profile=False, plot_snapshots=True)
 # sim.post_process(overlay=True)
 
-# #
-# for n in range(6):
-#     sim.pops['I'].I_stim = 0*b2.nA
-#     sim.start(duration=500*b2.ms, batch_dur=500*b2.ms, 
-#             restore=False, profile=False, plot_snapshots=True)
-#     sim.set_protocol()
-#     sim.start(duration=500*b2.ms, batch_dur=500*b2.ms, 
-#             restore=False, profile=False, plot_snapshots=True)
+# # six on/off cycles of the configured stimuli, run in one go
+# stim_cfgs = {stim_id: dict(stim_cfg, type='windows', 
+#                            windows=[(1000*n+500, 1000*n+1000) for n in range(6)])
+#              for stim_id, stim_cfg in sim.stim_cfgs.items()}
+# sim.set_protocol(stim_cfgs)
+# sim.start(duration=6000*b2.ms, batch_dur=500*b2.ms, 
+#         restore=False, profile=False, plot_snapshots=True)
 
 sim.warmup()
 sim.start(duration=5000*b2.ms, batch_dur=500*b2.ms, 
@@ -13,6 +13,7 @@ import logging
 osjoin = os.path.join # an alias for convenient
 from copy import deepcopy
 
+import json
 import pickle
 import numpy as np
 import brian2 as b2
@@ -21,20 +22,120 @@ from scipy import sparse
 
 import time
 
-import anisonet.viz as viz
 import anisonet.utils as utils 
 import anisonet.configs as configs # default configurations
-import anisonet.analyze as analyze
 import anisonet.equations as eq
-from anisonet.landscape import make_landscape
+from anisonet.timing import Timer, timed
+from anisonet.landscape import LandscapeRegistry
 from anisonet.anisofy import draw_posts
 
 from pdb import set_trace
 
-b2.seed(81)
+_seed = 81
+b2.seed(_seed)
 
 _plastic_models = ['tsodyks-markram']
 
+_cache_env = 'ANISONET_CACHE_DIR' # environment variable of the code cache
+
+
+def set_cache_dir(cache_dir=None):
+    """
+    Sets the persistent cache of Brian's compiled code (Cython runtime). 
+    Compiled extensions are keyed by their code, so a cache can be shared by
+    several jobs (e.g., on a shared file system of a cluster) and is safe to
+    be used concurrently. If not given, the ``ANISONET_CACHE_DIR`` environment
+    variable is used, if set, otherwise Brian's default is kept.
+    
+    :param cache_dir: folder of the cache, defaults to None
+    :type cache_dir: str, optional
+    :return: the folder of the cache in use
+    :rtype: str
+    """
+    from brian2.codegen.runtime.cython_rt.extension_manager import get_cython_cache_dir
+    
+    if cache_dir is None:
+        cache_dir = os.environ.get(_cache_env)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        b2.prefs.codegen.runtime.cython.cache_dir = cache_dir
+        b2.prefs.codegen.runtime.cython.multiprocess_safe = True
+    return os.path.expanduser(get_cython_cache_dir())
+
+
+def prepare_cache(net_names, scalar=4, cache_dir=None, result_path=None):
+    """
+    Warms up the cache of compiled code for the given configurations, such 
+    that later runs (of any size) do not pay for code generation and 
+    compilation. Since the generated code does not depend on the size of the 
+    network, downsized networks (``scalar``) are compiled. Both the first run
+    and the run after resetting the monitors (as between batches) are 
+    compiled.
+    
+    .. code-block:: python
+        
+        prepare_cache(['I_net', 'EI_net'], cache_dir='/shared/brian_cache')
+    
+    :param net_names: configuration names
+    :type net_names: list of str
+    :param scalar: downsizing factor of the compiled networks, defaults to 4
+    :type scalar: int, optional
+    :param cache_dir: folder of the cache (c.f. ``set_cache_dir``), defaults 
+        to None
+    :type cache_dir: str, optional
+    :param result_path: where the temporary data of the compiled networks 
+        is written, defaults to None (a temporary folder, removed afterwards)
+    :type result_path: str, optional
+    :return: hits and misses of the code cache, and the wall time of the
+        preparation per configuration
+    :rtype: dict
+    """
+    import shutil
+    import tempfile
+    
+    root = result_path or tempfile.mkdtemp(prefix='anisonet_prepare_')
+    stats = {}
+    try:
+        for net_name in net_names:
+            sim = Simulate(net_name, scalar=scalar, load_connectivity=False, 
+                           result_path=root, cache_dir=cache_dir)
+            msg = 'Preparing the code cache for {}'.format(net_name)
+            with sim.timer.phase('prepare_cache', msg) as record:
+                sim.setup_net()
+                hits, misses = sim.compile()
+                sim.reset_monitors()
+                h, m = sim.compile()
+            if hits!=None: # unknown outside of the Cython runtime
+                hits, misses = hits + h, misses + m
+            stats[net_name] = {'hits': hits, 'misses': misses, 'wall': record['wall']}
+    finally:
+        if result_path is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return stats
+
+
+class ProtocolGuard(b2.BrianObject):
+    """
+    Checks before every run that the stimulus column of every neuron 
+    (``stim_idx``) exists in the ``TimedArray`` of its population. The two may
+    diverge if a state is restored without its protocol, in which case the 
+    neurons would silently read NaN.
+    """
+    add_to_magic_network = False
+    
+    def __init__(self, pops):
+        super().__init__(name='protocol_guard')
+        self.pops = pops
+        
+    def before_run(self, run_namespace):
+        for pop_name, pop in self.pops.items():
+            ncols = pop.namespace['stim_'+pop_name].values.shape[1]
+            if pop.stim_idx_[:].max() >= ncols:
+                raise ValueError('The stimulus columns of {} do not match its '
+                                 'protocol ({} columns). Re-apply the protocol '
+                                 'that belongs to the restored state.'.format(
+                                     pop_name, ncols))
+
 
 class Simulate(object):
     """
@@ -42,7 +143,8 @@ class Simulate(object):
     """
     
     def __init__(self, net_name='I_net', load_connectivity=True,  scalar=1,
-                 result_path=None, to_event_driven = True,):
+                 result_path=None, to_event_driven = True, seed=None,
+                 cache_dir=None):
         """
         Initializes the simulator object for the given network configuration. 
         By default, tries to load the connectivity matrix from disk, otherwise
@@ -61,7 +163,21 @@ class Simulate(object):
         :type net_name: str, optional
         :param scalar: A scaling factor for downsizing the network, defaults to 1
         :type scalar: int, optional    
+        :param seed: seed of the random number generators. If not given, the 
+            module-level seed is kept, defaults to None
+        :type seed: int, optional
+        :param cache_dir: folder of the persistent cache of the compiled code
+            (c.f. ``set_cache_dir``), defaults to None
+        :type cache_dir: str, optional
         """
+        self.timer = Timer()
+        self.cache_dir = set_cache_dir(cache_dir)
+        
+        if seed==None:
+            seed = _seed
+        else:
+            b2.seed(seed)
+        self.seed = seed
         
         if result_path==None:
             result_path = os.getcwd()
@@ -466,6 +582,7 @@ class Simulate(object):
                         self.pops_cfg[pop]['input_model'] = model
             
             
+    @timed('setup_net', 'Setting up the network.')
     def setup_net(self, init_cell='ss', init_syn='rand'):
         """
         Sets up a network by the following steps:
@@ -480,7 +597,6 @@ class Simulate(object):
         
         b2.start_scope()
         
-        print('Net setup started.')
         self.setup_pops()
         self.setup_landscape()
         self.setup_syns()
@@ -491,9 +607,11 @@ class Simulate(object):
         self.net.add(self.pops.values())
         self.net.add(self.syns.values())
         self.net.add(self.mons)
+        self.net.add(ProtocolGuard(self.pops))
         print('Net set up.')
         
     
+    @timed('setup_pops', 'Setting up populations.')
     def setup_pops(self):
         """
         Each population is set up from the ``pops_cfg`` which is a nested 
@@ -510,9 +628,8 @@ class Simulate(object):
             mathes the one of images.
         
         """
-        print('{} -- Setting up populations.'.format(time.ctime()))
-        
         self.pops = {}
+        self.protocol = {}
         for pop_name in self.pops_cfg.keys():
             gs = self.pops_cfg[pop_name]['gs'] # grid size
             cell_cfg = self.pops_cfg[pop_name]['cell']
@@ -526,7 +643,8 @@ class Simulate(object):
                                  refractory = cell_cfg['ref'], #2*b2.ms, 
                                  threshold='v > {}*mV'.format(cell_cfg['thr']/b2.mV),
                                  reset='v={}*mV'.format(cell_cfg['rest']/b2.mV),
-                                 method='euler'
+                                 method='euler',
+                                 namespace = {'stim_'+pop_name: self.get_null_stim()},
                                  )
             # pop.mu = noise_cfg['mu']
             # pop.sigma = noise_cfg['sigma']
@@ -593,6 +711,7 @@ class Simulate(object):
             
             # 
             
+    @timed('setup_landscape', 'Setting up landscapes.')
     def setup_landscape(self):
         """
         Generates the requested landscape: A dictionary keyed by ``phi`` and 
@@ -600,10 +719,19 @@ class Simulate(object):
         radial displacement for every neuron in form of flat arrays.
         
         Landscapes are accessible via the `lscp` attribute of the ``Simulate``
-        object, in form of a dictionary keyed by the population's name.
+        object, in form of a dictionary keyed by the pathway's name. Fields 
+        are taken from a ``LandscapeRegistry`` (the ``landscapes`` attribute),
+        such that pathways of the same source population requesting the same
+        landscape share it. The registry is saved along with the connectivity
+        and is reloaded whenever the connectivity is.
         """
-        print('{} -- Setting up ladscapes.'.format(time.ctime()))
-
+        self.landscapes = LandscapeRegistry(seed=self.seed)
+        lscp_path = osjoin(self.data_path, self.name+'_landscapes.npz')
+        if self.load_connectivity:
+            if self.landscapes.load(lscp_path):
+                print('\tLoading landscapes: {}'.format(self.name+'_landscapes'))
+        stored = set(self.landscapes.fields)
+        
         self.lscp = {}
         for conn_name in self.conn_cfg.keys():
             src, trg = conn_name
@@ -611,18 +739,17 @@ class Simulate(object):
             lscp_cfg = self.conn_cfg[conn_name]['anisotropy']
             gs = self.pops_cfg[src]['gs'] # grid size
             
-            # this might be inefficient for constant values
-            # rs, phis = make_landscape(gs=gs, aniso=anisotropy)
-            # self.lscp[conn_name] = {'phi' : phis, 'r' :rs}
             self.lscp[conn_name] = {}
             for param, cfg in lscp_cfg['params'].items():
-                #set_trace()
-                
-                self.lscp[conn_name][param] = make_landscape(gs, cfg)
+                self.lscp[conn_name][param] = self.landscapes.get(src, gs, 
+                                                                  param, cfg)
         
-        # del rs, phis, gs, lscp_cfg, src, trg
+        # new fields were made, or stored ones are not used anymore
+        if self.landscapes.used != stored:
+            self.landscapes.save(lscp_path)
         
         
+    @timed('setup_syns', 'Setting up synapses ...')
     def setup_syns(self, visualize=False, init='rand'):
         """
         Sets up the synapses of all pathways (keys) in ``conns_cfg``; a nested 
@@ -639,117 +766,119 @@ class Simulate(object):
         .. _[1]: https://doi.org/10.1371/journal.pcbi.1007432
 
         """
-        print('{} -- Setting up synapses ...'.format(time.ctime()))
-        
         self.syns = {}
         for key in sorted(self.conn_cfg.keys()):
             src, trg = key
-            
-            eqs, on_pre, on_post, namespace = eq.get_syn_eqs(key, self.conn_cfg)
-            ncons = self.conn_cfg[key]['ncons']
-            spop = self.pops[src]
-            tpop = self.pops[trg]
-            
-            
-            syn = b2.Synapses(spop, tpop, 
-                              model=eqs, 
-                              on_pre=on_pre,
-                              on_post=on_post,
-                              namespace = namespace,
-                              method='exact',
-                              name = 'syn_'+key
-                              )
-            # load or save connectivity 
-            w_name = self.name+'_w_'+key
-            if self.load_connectivity:
-                try:
-                    print('\tLoading connectivity matrix: {}'.format(w_name))
-                    w = sparse.load_npz(osjoin(self.data_path, w_name+'.npz'))
-                    delays = np.load(osjoin(self.data_path, 'delays.npy'))
-                except Exception as e: 
-                    print(e)
-                    print('\tWarning: Connecitivy file {} was not found.'.format(w_name))                    
-                    print('\tWarning: Computing connectivity from scratch.')                    
-                    self.load_connectivity = False
-                    
-            # computing anisotropic post-synapses
-            syn_params = {}
-            for s_idx in range(len(spop)):
+            with self.timer.phase('pathway '+key):
+            
+                eqs, on_pre, on_post, namespace = eq.get_syn_eqs(key, self.conn_cfg)
+                ncons = self.conn_cfg[key]['ncons']
+                spop = self.pops[src]
+                tpop = self.pops[trg]
+            
+            
+                syn = b2.Synapses(spop, tpop, 
+                                  model=eqs, 
+                                  on_pre=on_pre,
+                                  on_post=on_post,
+                                  namespace = namespace,
+                                  method='exact',
+                                  name = 'syn_'+key
+                                  )
+                # load or save connectivity 
+                w_name = self.name+'_w_'+key
                 if self.load_connectivity:
-                    t_idxs = w.col[w.row==s_idx]
-                    # TODO: add a function that computes delays
-                else:
-                    kws = dict(s_coord = spop.coord[s_idx],
-                               ncons = ncons,
-                               srow = spop.gs,
-                               scol = spop.gs,
-                               trow = tpop.gs,
-                               tcol = tpop.gs,
-                               profile = self.conn_cfg[key]['profile'],
-                               self_link = self.conn_cfg[key]['self_link'],
-                               recurrent = trg==src,
-                               )
+                    try:
+                        print('\tLoading connectivity matrix: {}'.format(w_name))
+                        w = sparse.load_npz(osjoin(self.data_path, w_name+'.npz'))
+                        w_index = utils.SynapseIndex(w.row, w.col, len(spop), len(tpop))
+                        delays = np.load(osjoin(self.data_path, 'delays.npy'))
+                    except Exception as e: 
+                        print(e)
+                        print('\tWarning: Connecitivy file {} was not found.'.format(w_name))                    
+                        print('\tWarning: Computing connectivity from scratch.')                    
+                        self.load_connectivity = False
+                    
+                # computing anisotropic post-synapses
+                syn_params = {}
+                for s_idx in range(len(spop)):
+                    if self.load_connectivity:
+                        t_idxs = w_index.posts(s_idx)
+                        # TODO: add a function that computes delays
+                    else:
+                        kws = dict(s_coord = spop.coord[s_idx],
+                                   ncons = ncons,
+                                   srow = spop.gs,
+                                   scol = spop.gs,
+                                   trow = tpop.gs,
+                                   tcol = tpop.gs,
+                                   profile = self.conn_cfg[key]['profile'],
+                                   self_link = self.conn_cfg[key]['self_link'],
+                                   recurrent = trg==src,
+                                   )
                     
-                    # TODO: anisotopy should be able to pass local 
-                    # or global (constant) anisotopic value for s_idx
-                    anisotropy = {k:v[s_idx] for k,v in self.lscp[key].items()}
-                    anisotropy['vars'] = self.conn_cfg[key]['anisotropy']['vars'] # TODO: THIS IS A PATCH!
-                    kws['anisotropy'] = anisotropy
-                    # landscape = {'phi': self.lscp[key]['phi'][s_idx], 
-                    #               'r' : self.lscp[key]['r'][s_idx]},
+                        # TODO: anisotopy should be able to pass local 
+                        # or global (constant) anisotopic value for s_idx
+                        anisotropy = {k:v[s_idx] for k,v in self.lscp[key].items()}
+                        anisotropy['vars'] = self.conn_cfg[key]['anisotropy'].get('vars', {}) # TODO: THIS IS A PATCH!
+                        kws['anisotropy'] = anisotropy
+                        # landscape = {'phi': self.lscp[key]['phi'][s_idx], 
+                        #               'r' : self.lscp[key]['r'][s_idx]},
                     
                                 
-                    # adding the methods
-                    aniso_methods = deepcopy(self.conn_cfg[key]['anisotropy'])
-                    aniso_methods.pop('params')
-                    kws['aniso_methods'] = aniso_methods
+                        # adding the methods
+                        aniso_methods = deepcopy(self.conn_cfg[key]['anisotropy'])
+                        aniso_methods.pop('params')
+                        kws['aniso_methods'] = aniso_methods
                     
-                    #set_trace()
-                    s_coord, t_coords, syn_param = draw_posts(**kws) # projects s_coord
-                    t_idxs = utils.coord2idx(t_coords, tpop)
+                        #set_trace()
+                        s_coord, t_coords, syn_param = draw_posts(**kws) # projects s_coord
+                        t_idxs = utils.coord2idx(t_coords, tpop)
                     
-                    for k,v in syn_param.items():
-                        if k in syn_params:
-                            syn_params[k] = np.concatenate([syn_params[k],v]) # TODO: should add as list and then reshape
-                        else:
-                            syn_params[k] = v
+                        for k,v in syn_param.items():
+                            if k in syn_params:
+                                syn_params[k] = np.concatenate([syn_params[k],v]) # TODO: should add as list and then reshape
+                            else:
+                                syn_params[k] = v
                     
-                syn.connect(i = s_idx, j = t_idxs)
+                    syn.connect(i = s_idx, j = t_idxs)
                 
-            # Setting up delays
-            # syn.J = self.conn_cfg[key]['synapse']['params']['J']
-            # syn.delay = np.array(delays).ravel()*b2.ms
-            #syn.delay = np.random.uniform(0.5, 2.5, len(syn.delay))*b2.ms
-            
-            #self.state_initializer(syn, self.conn_cfg[key], mode='rand')
-            syn.add_attribute('is_plastic')
-            syn.is_plastic = False
-            for plastic_model in _plastic_models:
-                if plastic_model in self.conn_cfg[key]['synapse']['type']:
-                    syn.is_plastic = True 
-            
-            
-            # append to the class
-            self.syns[key] = syn
-            #set_trace()
-            
-            # save if not saved
-            if not self.load_connectivity:
-                row_idx = np.array(syn.i) # pre
-                col_idx = np.array(syn.j) # post
-                data = np.ones_like(row_idx)
-                w = sparse.coo_matrix((data, (row_idx, col_idx)))
-                sparse.save_npz(osjoin(self.data_path, w_name+'.npz'), w)
+                # Setting up delays
+                # syn.J = self.conn_cfg[key]['synapse']['params']['J']
+                # syn.delay = np.array(delays).ravel()*b2.ms
+                #syn.delay = np.random.uniform(0.5, 2.5, len(syn.delay))*b2.ms
+            
+                #self.state_initializer(syn, self.conn_cfg[key], mode='rand')
+                syn.add_attribute('is_plastic')
+                syn.is_plastic = False
+                for plastic_model in _plastic_models:
+                    if plastic_model in self.conn_cfg[key]['synapse']['type']:
+                        syn.is_plastic = True 
+            
+            
+                # append to the class
+                self.syns[key] = syn
+                #set_trace()
+            
+                # save if not saved
+                if not self.load_connectivity:
+                    row_idx = np.array(syn.i) # pre
+                    col_idx = np.array(syn.j) # post
+                    data = np.ones_like(row_idx)
+                    w = sparse.coo_matrix((data, (row_idx, col_idx)))
+                    sparse.save_npz(osjoin(self.data_path, w_name+'.npz'), w)
                 
-                for k,v in syn_params.items():
-                    np.save(osjoin(self.data_path, k), v)
+                    for k,v in syn_params.items():
+                        np.save(osjoin(self.data_path, k), v)
                     
                     
-                del t_coords, s_coord, kws, row_idx, col_idx, data
+                    del t_coords, s_coord, kws, row_idx, col_idx, data
+            
         del src, trg, eqs, on_pre, on_post, ncons 
         del spop, tpop, syn, t_idxs, w
     
         
+    @timed('configure_monitors', 'Configuring monitors')
     def configure_monitors(self):
         """
         Defines a list of spike monitor called ``mon_<population_name>`` for 
@@ -762,8 +891,6 @@ class Simulate(object):
         :rtype: TYPE
 
         """
-        print('{} -- Configuring monitors'.format(time.ctime()))
-        
         # this is necessary to delete mons. Otherwise it won't work
         if hasattr(self, 'mons'):
             del self.mons
@@ -785,7 +912,62 @@ class Simulate(object):
             #self.mons.append(b2.StateMonitor(self.syns[0], variables=['x','u','g','g_tmp'], record=True, name='syn_'+pop_name))
             #self.mons.append(b2.StateMonitor(self.pops['I'], variables=['I_syn_I'], record=True, name='pop_'+pop_name))
     
-    def warmup(self):
+    def get_warmup_key(self):
+        """
+        Computes the key under which the warmed-up state is cached. The key is
+        a hash of the population and pathway configurations, the seed, the
+        warm-up noise and duration, and the realized connectivity of every
+        pathway. Stimulation settings are left out on purpose, so that one 
+        warmed-up state can be shared by all stimulation protocols of the same
+        network.
+        
+        :return: warm-up key
+        :rtype: str
+        """
+        pops_cfg = {pop: {k: v for k, v in cfg.items() if k!='stim'} 
+                    for pop, cfg in self.pops_cfg.items()}
+        
+        conn_fps = [utils.fingerprint(np.asarray(syn.i), np.asarray(syn.j))
+                    for _, syn in sorted(self.syns.items())]
+        
+        return utils.fingerprint(pops_cfg, self.conn_cfg, self.seed, 
+                                 self.warmup_std, self.warmup_dur, *conn_fps)
+    
+    def get_warmup_path(self, key):
+        return osjoin(self.data_path, self.name+'_'+key+'.wup')
+    
+    def restore_warmup(self):
+        """
+        Restores the warmed-up state that matches the current network. States
+        warmed up with other configurations, seeds, warm-up parameters or 
+        connectivities are never restored. A warmed-up state is shared by all
+        stimulation protocols, so the current protocol is re-applied on top 
+        of it (c.f. ``apply_protocol``).
+        
+        :return: whether or not a matching state was restored
+        :rtype: bool
+        """
+        key = self.get_warmup_key()
+        path = self.get_warmup_path(key)
+        
+        if not os.path.exists(path):
+            print('Warning: No warm-up state matches the network (key: {}).'.format(key))
+            return False
+        
+        try:
+            self.net.restore(name = key, filename = path)
+            self.apply_protocol(self.protocol)
+            print('Restored warm-up state: {}'.format(os.path.basename(path)))
+            return True
+        
+        except Exception as e: 
+            print(str(e))
+            print('Warning: Could not restore state from: {}.'.format(path))
+            return False
+        
+        
+    @timed('warmup', 'Starting warm-up ...')
+    def warmup(self, use_cache=True):
         """
         Warms up the neurons for 500 ms. In the first half neurons receive no
         input rather than a 500 pA (std) white noise. In the second half the
@@ -793,13 +975,18 @@ class Simulate(object):
         values.
         
         After the each warm-up, the states is saved on the disk for restoration
-        for later simulations. 
-        
-        
-        .. note::
-            Previous warm-up states will be overwritten by the freshest 
-            execution.
+        for later simulations. The state is keyed by ``get_warmup_key``, thus
+        warm-ups of different networks do not overwrite each other, and the 
+        warm-up is paid only once per distinct network.
+        
+        :param use_cache: whether or not restore a previously stored warm-up 
+            state of the same network instead of running it again, defaults to
+            True
+        :type use_cache: bool, optional
         """
+        if use_cache and os.path.exists(self.get_warmup_path(self.get_warmup_key())):
+            if self.restore_warmup():
+                return
         
         # resetting the time
         self.net.t_ = 0
@@ -817,8 +1004,6 @@ class Simulate(object):
             pop.mu = 0*b2.pA # turning background off
             pop.sigma = self.warmup_std # warm up noise
             
-        print('{} -- Starting warm-up ...'.format(time.ctime()))
-        
         self.net.run(self.warmup_dur/2)
         for pop in self.pops.values():
             pop.mu = mus[pop.name]*b2.pA
@@ -826,8 +1011,8 @@ class Simulate(object):
         self.net.run(self.warmup_dur/2)
         print('Finished warm up. Storing results.')
         
-        self.net.store(name= self.name, 
-                       filename= osjoin(self.data_path, self.name+'.wup'))
+        key = self.get_warmup_key()
+        self.net.store(name= key, filename= self.get_warmup_path(key))
         
         # switch on monitors        
         # for mon in self.mons:
@@ -838,7 +1023,8 @@ class Simulate(object):
         
     def start(self, duration=2000*b2.ms, batch_dur=1000*b2.ms, 
               restore=True, profile=False, plot_snapshots=True,
-              warmup=False):
+              warmup=False, checkpoint_every=None, track_sync=False,
+              track_bumps=False):
         """
         Starts a long simulation by breaking it down to several batches. After
         each ``batch_dur``, the monitors will be saved on disk, and simulation
@@ -850,7 +1036,8 @@ class Simulate(object):
         :param batch_dur: duration of simulation batches, defaults to 200*b2.ms
         :type batch_dur: Time quantitiy, optional
         :param restore: whether or not restore the warmed-up stete from disk,
-            defaults to True
+            defaults to True. Only a state warmed up with the very same network 
+            is restored (c.f. ``get_warmup_key``).
         :type restore: bool, optional
         :param profile: whether or not profile the simulation (useful for 
             performance analysis), defaults to False
@@ -858,19 +1045,24 @@ class Simulate(object):
         :param plot_snapshots: whether or not plot the firing rate at the end of 
             each batch, defaults to True
         :type plot_snapshots: bool, optional
+        :param checkpoint_every: if given, the network state is checkpointed 
+            every ``checkpoint_every`` batches, such that an interrupted run 
+            can be continued with ``resume``, defaults to None
+        :type checkpoint_every: int, optional
+        :param track_sync: whether or not compute the order parameter of the 
+            populations online and log it after each batch (c.f. 
+            ``utils.OrderParameter``), defaults to False
+        :type track_sync: bool, optional
+        :param track_bumps: whether or not track the bumps online and log 
+            their speed after each batch (c.f. ``analyze.BumpTracker``). The 
+            trajectories are saved in the results folder at the end of the 
+            run, defaults to False
+        :type track_bumps: bool, optional
         """
         
         # we try to restore state if requested, but throw a warning if couldn't
         if restore:
-            try:
-                self.net.restore(name = self.name, 
-                                 filename= osjoin(self.data_path, self.name+'.wup'))
-                print('Restored state from state: {}'.format(self.name+'.wup'))
-            
-            except Exception as e: 
-                print(str(e))
-                print('Warning: Could not restore state from: {}.'.format(self.name+'.wup'))
-                restore = False
+            restore = self.restore_warmup()
                 
         # we proceed with the requested warmup only if nothing is restored
         if (warmup) and (not restore):
@@ -883,22 +1075,236 @@ class Simulate(object):
         
         # fmt = '{:0>%d}'%(np.log10(nbatch)+1) #suffix_format
         
-        for n in range(nbatch):
-            self.reset_monitors()
-            
-            dur = min(batch_dur, duration-n*batch_dur)
-            print('{} -- Starting simulation part {}/{}'.format(time.ctime(), n+1, nbatch))
-            self.net.run(dur, profile=profile)
-            
-            if profile:
-                print(profiling_summary(self.net))
-            
-            if plot_snapshots:  
-                viz.plot_firing_rates(sim=self, suffix='_'+self.state_str,)
-            
-            self.save_monitors()
+        # a new run makes the checkpoint of any previous one obsolete
+        self.clear_checkpoint()
+        
+        # the manifest describes the entire run, even if it is resumed later
+        manifest = {'key': self.get_warmup_key(),
+                    'duration': float(duration/b2.second),
+                    'batch_dur': float(batch_dur/b2.second),
+                    'nbatch': nbatch,
+                    'checkpoint_every': checkpoint_every,
+                    'first_state_id': self.state_id,
+                    'track_sync': track_sync,
+                    'track_bumps': track_bumps,
+                    'completed': [],
+                    }
+        self.run_batches(manifest, profile=profile, 
+                         plot_snapshots=plot_snapshots)
+    
+    def run_batches(self, manifest, profile=False, plot_snapshots=True):
+        """
+        Runs the batches of the given run manifest which are not completed yet.
+        The manifest is updated in-place as the batches are completed, and the
+        checkpoint is cleared once the run is complete. Use ``start`` or 
+        ``resume`` instead of calling this method directly.
+        """
+        duration = manifest['duration']*b2.second
+        batch_dur = manifest['batch_dur']*b2.second
+        nbatch = manifest['nbatch']
+        checkpoint_every = manifest['checkpoint_every']
+        
+        # compiling before the first batch, such that its timing is not
+        # contaminated and the cache hits/misses are reported
+        self.compile()
+        
+        # synchrony tracking starts over if the run is resumed. Intervals 
+        # longer than 1 s count as silence, to bound the memory of the 
+        # pending bins over long runs (c.f. ``utils.OrderParameter``).
+        if manifest.get('track_sync', False):
+            self.sync = {name: utils.OrderParameter(len(pop), float(self.dt/b2.second),
+                                                    max_isi=1.)
+                         for name, pop in self.pops.items()}
+            self.sync_trace = {name: [] for name in self.pops.keys()}
+        
+        if manifest.get('track_bumps', False):
+            from anisonet.analyze import BumpTracker
+            self.trackers = {name: BumpTracker(pop.gs) 
+                             for name, pop in self.pops.items()}
+        
+        for n in range(len(manifest['completed']), nbatch):
+            msg = 'Starting simulation part {}/{}'.format(n+1, nbatch)
+            with self.timer.phase('batch '+self.state_str, msg):
+                self.reset_monitors()
+                
+                dur = min(batch_dur, duration-n*batch_dur)
+                with self.timer.phase('run'):
+                    self.net.run(dur, profile=profile)
+                
+                if profile:
+                    print(profiling_summary(self.net))
+                    self.timer.add_brian_profile(self.net)
+                
+                if plot_snapshots:  
+                    from anisonet import viz
+                    viz.plot_firing_rates(sim=self, suffix='_'+self.state_str,)
+                
+                if manifest.get('track_sync', False):
+                    self.log_sync(float((self.net.t - dur)/b2.second))
+                
+                if manifest.get('track_bumps', False):
+                    self.log_bumps()
+                
+                manifest['completed'].append(self.state_str)
+                self.save_monitors()
+                
+                if checkpoint_every and ((n+1) % checkpoint_every==0) and (n+1 < nbatch):
+                    self.checkpoint(manifest)
+        
+        # the run is complete; there is nothing left to resume
+        self.clear_checkpoint()
+        
+        if manifest.get('track_bumps', False):
+            for name, tracker in self.trackers.items():
+                tracker.finalize().to_csv(
+                    osjoin(self.res_path, 'bump_trajectories_'+name+'.csv'), 
+                    index=False)
+        
+        self.save_timings()
                     
     
+    def log_sync(self, t_start):
+        """
+        Feeds the spikes of the last batch to the online order parameters, and
+        logs the mean order parameter since ``t_start`` (in seconds). Bins are
+        finalized only once no neuron can change its phase in them anymore; 
+        the logged value is the provisional one, as if the recording ended now.
+        """
+        for mon in self.get_pop_mons():
+            name = mon.source.name
+            self.sync_trace[name].append(self.sync[name].update(mon.i[:], mon.t_[:]))
+            
+            t, R, psi = self.sync[name].peek(t_start, float(self.net.t/b2.second))
+            print('\tOrder parameter of {}: {:.3f} (mean over {:.3f}-{:.3f} s)'.format(
+                  name, np.nanmean(R) if len(R) else np.nan, t_start, float(self.net.t/b2.second)))
+    
+    def log_bumps(self):
+        """
+        Feeds the spikes of the last batch to the bump trackers, and logs the
+        number of active bumps and their median speed.
+        """
+        for mon in self.get_pop_mons():
+            name = mon.source.name
+            tracker = self.trackers[name]
+            tracker.update(utils.idx2coords(mon.i[:], mon.source), mon.t_[:])
+            
+            traj = tracker.trajectories()
+            print('\t{} bumps active in {}, median speed {:.1f} grid/s'.format(
+                  len(tracker.active), name, traj.speed.median()))
+    
+    def get_checkpoint_path(self):
+        return osjoin(self.data_path, self.name+'_checkpoint.json')
+    
+    def clear_checkpoint(self):
+        """
+        Removes the checkpoint (manifest and stored state) of a previous run,
+        if any.
+        """
+        manifest_path = self.get_checkpoint_path()
+        if not os.path.exists(manifest_path):
+            return
+        
+        try:
+            with open(manifest_path, 'r') as f:
+                state_file = json.load(f).get('state_file', None)
+            if state_file!=None:
+                self.remove_state(osjoin(self.data_path, state_file))
+        except ValueError: # a corrupt manifest
+            pass
+        os.remove(manifest_path)
+    
+    def checkpoint(self, manifest):
+        """
+        Stores a rolling checkpoint of the network, including the state of the
+        random number generators and the stimulation protocol, together with 
+        a manifest of the run. The manifest lists the completed batch ids, the ``state_id`` of the next
+        batch and the file of the stored state. The manifest is replaced 
+        atomically and the previous state is only removed afterwards, so a 
+        preemption during checkpointing leaves the last checkpoint intact.
+        
+        :param manifest: run manifest (c.f. ``start``)
+        :type manifest: dict
+        """
+        msg = 'Checkpointing after part {}/{}'.format(len(manifest['completed']), 
+                                                      manifest['nbatch'])
+        with self.timer.phase('checkpoint', msg):
+            self._store_checkpoint(manifest)
+    
+    def _store_checkpoint(self, manifest):
+        manifest_path = self.get_checkpoint_path()
+        old_state = manifest.get('state_file', None)
+        
+        manifest['state_id'] = self.state_id
+        manifest['state_file'] = self.name+'_checkpoint_'+self.state_str+'.ckpt'
+        manifest['t'] = float(self.net.t/b2.second)
+        manifest['time'] = time.ctime()
+        
+        self.net.store(name='checkpoint', 
+                       filename=osjoin(self.data_path, manifest['state_file']))
+        self.save_protocol(osjoin(self.data_path, manifest['state_file']))
+        with open(manifest_path+'.tmp', 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(manifest_path+'.tmp', manifest_path)
+        
+        if old_state!=None and old_state!=manifest['state_file']:
+            self.remove_state(osjoin(self.data_path, old_state))
+    
+    def resume(self, profile=False, plot_snapshots=True):
+        """
+        Resumes an interrupted run from its latest checkpoint. The network 
+        must be set up (``setup_net``) beforehand exactly as for the original
+        run. Batches continue with the correct ``state_id`` so the saved 
+        monitors append seamlessly to the ones of the interrupted run. 
+        Checkpoints of another network (c.f. ``get_warmup_key``) or of a 
+        completed run are not resumed.
+        
+        :param profile: whether or not profile the simulation, defaults to False
+        :type profile: bool, optional
+        :param plot_snapshots: whether or not plot the firing rate at the end of 
+            each batch, defaults to True
+        :type plot_snapshots: bool, optional
+        :return: whether or not a checkpoint was found and resumed
+        :rtype: bool
+        """
+        manifest_path = self.get_checkpoint_path()
+        if not os.path.exists(manifest_path):
+            print('Warning: No checkpoint found for {}.'.format(self.name))
+            return False
+        
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        
+        if manifest.get('key', None)!=self.get_warmup_key():
+            print('Warning: The checkpoint of {} belongs to another network.'.format(self.name))
+            return False
+        
+        if len(manifest['completed']) >= manifest['nbatch']:
+            print('Warning: The run of {} is already complete.'.format(self.name))
+            return False
+        
+        state_path = osjoin(self.data_path, manifest['state_file'])
+        self.net.restore(name='checkpoint', filename=state_path)
+        self.load_protocol(state_path)
+        
+        # Brian's stored random state contains pointers to the random buffers
+        # of the process that stored it, and cannot be restored in a new one.
+        # So, we only restore numpy's state and let Brian refill its buffers.
+        with open(state_path, 'rb') as f:
+            rng_state = pickle.load(f)['checkpoint']['_random_generator_state']
+        np.random.set_state(rng_state['numpy_state'])
+        device = b2.get_device()
+        if hasattr(device, 'rand_buffer_index'):
+            device.rand_buffer_index[:] = 0
+            device.randn_buffer_index[:] = 0
+        self.state_id = manifest['state_id']
+        self.state_str = self.fmt.format(self.state_id)
+        
+        print('Resuming simulation from part {}/{} (t = {} s).'.format(
+            len(manifest['completed'])+1, manifest['nbatch'], manifest['t']))
+        self.run_batches(manifest, profile=profile, 
+                         plot_snapshots=plot_snapshots)
+        return True
+    
     def update_state(self):
         self.state_id += 1
         self.state_str = self.fmt.format(self.state_id)
@@ -940,6 +1346,47 @@ class Simulate(object):
             
             del txy, files_list
             
+    def compile(self):
+        """
+        Generates and compiles (or loads from the cache) the code of all 
+        objects of the network, without advancing the time. The numbers of 
+        extensions loaded from the cache (hits) and compiled anew (misses) are
+        logged and recorded in the timer. An extension of the network's code 
+        objects is a hit if its file was already in the cache before, so 
+        other processes sharing the cache do not distort the counts.
+        
+        :return: hits and misses, or Nones if the runtime does not compile 
+            extensions (e.g., the numpy target)
+        :rtype: tuple of ints
+        """
+        def get_extensions():
+            files = set()
+            for obj in self.net.sorted_objects:
+                for codeobj in obj.code_objects:
+                    for module in getattr(codeobj, 'compiled_code', {}).values():
+                        if getattr(module, '__file__', None)!=None:
+                            files.add(os.path.basename(module.__file__))
+            return files
+        
+        with self.timer.phase('compile', 'Compiling the network.') as record:
+            cached = set()
+            if os.path.isdir(self.cache_dir):
+                cached = set(os.listdir(self.cache_dir))
+            self.net.run(0*b2.ms)
+            extensions = get_extensions()
+            
+            hits = misses = None
+            if len(extensions):
+                misses = len(extensions - cached)
+                hits = len(extensions) - misses
+            record['codegen'] = {'hits': hits, 'misses': misses}
+        
+        if hits==None:
+            print('\tCode cache {}: hits and misses unknown'.format(self.cache_dir))
+        else:
+            print('\tCode cache {}: {} hit(s), {} miss(es)'.format(self.cache_dir, hits, misses))
+        return hits, misses
+    
     def reset_monitors(self):
         """
         Resets the monitors by removing them, redefining them, and adding them
@@ -951,43 +1398,97 @@ class Simulate(object):
         self.net.add(self.mons)
         
     
-    def post_process(self, overlay=True, ss_dur=10):
-        print('{} -- Starting postprocessing ...'.format(time.ctime()))
-        
-        logging.info('Visualizing landscape, degress, and connectivity.')
-        viz.plot_landscape(self, overlay=overlay)
-        viz.plot_in_out_deg(self)
-        viz.plot_connectivity(self)
-        
-        print('{} -- Visualizing realized landscape.'.format(time.ctime()))
-        viz.plot_realized_landscape(self)
-        print('{} -- realized landscape vized.'.format(time.ctime()))
-        
-        
-        print('{} -- Visualizing realized aniso weights.'.format(time.ctime()))
-        viz.plot_aniso_weights(self)
-        print('{} -- realized aniso weights vized.'.format(time.ctime()))
-        
-        logging.info('Visualizing firing rate distribution.')
-        viz.plot_firing_rates_dist(self)
+    def save_timings(self):
+        """
+        Saves the timings of all phases recorded so far (c.f. ``timing`` 
+        module) in the results folder, both as json and as a summary table.
+        """
+        self.timer.to_json(osjoin(self.res_path, 'timings.json'))
+        with open(osjoin(self.res_path, 'timings.txt'), 'w') as f:
+            f.write(self.timer.summary())
         
-        logging.info('Making activity animation.')
-        viz.plot_animation(self, overlay=overlay, ss_dur=ss_dur) 
-
-        logging.info('Computing synchrony order parameter.')
-        #viz.plot_R(self)
+    def get_post_tasks(self, overlay=True, ss_dur=10):
+        """
+        The post-processing tasks (c.f. ``postprocess`` module) of this 
+        simulation.
+        """
+        from anisonet import viz, analyze
+        from anisonet.postprocess import Task
+        
+        keys = sorted(self.syns.keys())
+        lscps = ['landscape_{}_{}.png'.format(key, param) 
+                 for key, params in self.lscp.items() 
+                 for param, lscp in params.items() if len(np.unique(lscp))>1]
+        stdps = [key for key in keys 
+                 if self.conn_cfg[key].get('training', {}).get('type')=='STDP']
+        
+        tasks = [
+            Task('landscape', viz.plot_landscape, ['landscape'], 
+                 dict(overlay=overlay), outputs=lscps),
+            Task('in_out_deg', viz.plot_in_out_deg, ['synapses'], 
+                 outputs=['degs_'+key+'.png' for key in keys]),
+            Task('connectivity', viz.plot_connectivity, ['connectivity'],
+                 outputs=['w_'+key+'.png' for key in keys]),
+            Task('realized_landscape', viz.plot_realized_landscape, ['realized'],
+                 outputs=[name+key+'.png' for key in keys 
+                          for name in ['realized_phi_', 'realized_phi_density_']]),
+            Task('aniso_weights', viz.plot_aniso_weights, ['synapses'],
+                 outputs=['aniso_weights_'+key+'.png' for key in keys]),
+            Task('firing_rates_dist', viz.plot_firing_rates_dist, ['monitors'],
+                 outputs=['rates_distribution.png']),
+            # renders its frames in several processes itself
+            Task('animation', viz.plot_animation, ['monitors', 'landscape'], 
+                 dict(overlay=overlay, ss_dur=ss_dur), parallel=False,
+                 outputs=['animation_rate.gif']),
+            Task('R', viz.plot_R, ['monitors'], outputs=['order_param.png']),
+            Task('LT_weights', viz.plot_LT_weights, ['synapses'],
+                 outputs=['LTW_'+key+'.png' for key in stdps]),
+            Task('bumps', analyze.find_bumps, ['monitors'], dict(plot=True)),
+            Task('manifold', viz.plot_manifold, ['connectivity'], dict(ncomp=2),
+                 outputs=['weight_manifold_'+key+'.png' for key in keys]),
+            ]
         
         # short-term weights
         if self.has_plastic:
-            viz.plot_relative_weights(self)
-            viz.plot_relative_weights_2d(self)
-        
-        # Long term weights
-        viz.plot_LT_weights(self)
+            tasks += [
+                Task('relative_weights', viz.plot_relative_weights, ['monitors'],
+                     outputs=['weight_modulation.png']),
+                Task('relative_weights_2d', viz.plot_relative_weights_2d, 
+                     ['monitors'], outputs=['weight_modulation_mat.png']),
+                ]
+        return tasks
+        
+    @timed('post_process', 'Starting postprocessing ...')
+    def post_process(self, overlay=True, ss_dur=10, tasks=None, n_jobs=None, 
+                     force=False):
+        """
+        Visualizes and analyzes the simulation. The steps are run as a task 
+        graph (c.f. ``postprocess`` module): the shared inputs are loaded 
+        once, independent tasks run concurrently, and only the tasks whose 
+        inputs changed since their last run are run again.
         
+        :param overlay: whether to overlay the landscape on the plots, 
+            defaults to True
+        :type overlay: bool, optional
+        :param ss_dur: duration of the animation frames in ms, defaults to 10
+        :type ss_dur: float, optional
+        :param tasks: names of the tasks to run (c.f. ``get_post_tasks``), 
+            defaults to None (all)
+        :type tasks: list of str, optional
+        :param n_jobs: number of worker processes, defaults to None (as many
+            as CPUs)
+        :type n_jobs: int, optional
+        :param force: reruns the tasks even if up to date, defaults to False
+        :type force: bool, optional
+        :return: names of the failed tasks
+        :rtype: list
+        """
+        from anisonet.postprocess import run_tasks
         
-        analyze.find_bumps(self, plot=True)
-        viz.plot_manifold(self, 2)
+        failed = run_tasks(self, self.get_post_tasks(overlay, ss_dur), 
+                           only=tasks, n_jobs=n_jobs, force=force)
+        self.save_timings()
+        return failed
         
         
     def get_syn_mons(self):
@@ -1016,12 +1517,120 @@ class Simulate(object):
     
         return has_plasticity 
     
-    def set_protocol(self):
-        stim_cfgs = utils.stimulator(self, self.stim_cfgs)
-        for stim_id, stim_cfg in stim_cfgs.items():
-            pop, id_ = stim_id.split('_')
-            
-            self.pops[pop].I_stim[ stim_cfg['idxs'] ] = stim_cfg['I_stim']#.values[0]
+    def get_null_stim(self):
+        return b2.TimedArray(np.zeros((1, 1))*b2.pA, dt=self.dt)
+    
+    def get_protocol_path(self, state_path):
+        return os.path.splitext(state_path)[0]+'.stim'
+    
+    def apply_protocol(self, protocol):
+        """
+        Installs a compiled stimulation protocol, i.e., the ``TimedArray`` of
+        every population, the time at which it starts (``stim_t0``) and the 
+        stimulus column of every neuron (``stim_idx``).
+        
+        :param protocol: compiled protocol keyed by population name; each 
+            holds the ``values`` (pA), ``cols``, ``dt`` (ms) and ``t_start`` 
+            (ms). Populations that are absent are not stimulated.
+        :type protocol: dict
+        """
+        self.protocol = protocol
+        for pop_name, pop in self.pops.items():
+            if pop_name in protocol:
+                stim = protocol[pop_name]
+                pop.namespace['stim_'+pop_name] = b2.TimedArray(
+                    stim['values']*b2.pA, dt=stim['dt']*b2.ms)
+                pop.stim_t0 = stim['t_start']*b2.ms
+                pop.stim_idx = stim['cols']
+            else:
+                pop.namespace['stim_'+pop_name] = self.get_null_stim()
+                pop.stim_t0 = 0*b2.ms
+                pop.stim_idx = 0
+    
+    def save_protocol(self, state_path):
+        """
+        Saves the current stimulation protocol next to a stored checkpoint, 
+        as the ``TimedArray`` is not a part of Brian's state.
+        """
+        with open(self.get_protocol_path(state_path), 'wb') as f:
+            pickle.dump(self.protocol, f)
+    
+    def load_protocol(self, state_path):
+        """
+        Re-applies the stimulation protocol that was saved with a stored 
+        checkpoint. Checkpoints without any protocol fall back to no stimulus.
+        """
+        path = self.get_protocol_path(state_path)
+        protocol = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                protocol = pickle.load(f)
+        else:
+            print('Warning: No stimulation protocol found for {}.'.format(
+                os.path.basename(state_path)))
+        self.apply_protocol(protocol)
+    
+    def remove_state(self, state_path):
+        for path in [state_path, self.get_protocol_path(state_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def set_protocol(self, stim_cfgs=None, t_start=None, dt=None):
+        """
+        Sets up a stimulation protocol. The whole schedule of every 
+        stimulation domain (on/off windows, ramps, pulse trains, ...; c.f. 
+        ``utils.get_stim_segments``) is compiled into a 2D ``TimedArray`` per
+        population that the neurons read during the run. Hence, a protocol 
+        runs within a single ``net.run`` (or ``start``) without any 
+        intervention in between. 
+        
+        Calling it again replaces the previous protocol. Populations without 
+        any stimulus in ``stim_cfgs`` are not stimulated. The protocol is 
+        kept when a warmed-up state is restored, and is checkpointed along 
+        with the network.
+        
+        .. code-block:: python
+            
+            stim_cfgs = {
+                'I_0': {'type': 'windows', 'I_stim': 400, 
+                        'windows': [(0, 200), (500, 700)],
+                        'domain': {'type': 'r', 'x0': 20, 'y0': 10, 'r': 2.5}},
+                'I_1': {'type': 'pulses', 'I_stim': 700, 'period': 50, 
+                        'width': 5, 'n': 10,
+                        'domain': {'type': 'ring', 'x0': 5, 'y0': 5, 
+                                   'r_in': 3, 'r_out': 5}},
+                }
+            sim.set_protocol(stim_cfgs)
+            sim.start(duration=1000*b2.ms, restore=False)
+        
+        :param stim_cfgs: stimulation configurations, defaults to None (the 
+            configurations of the network)
+        :type stim_cfgs: dict, optional
+        :param t_start: network time at which the protocol (its time 0) 
+            starts, defaults to None (the current time of the network)
+        :type t_start: Time quantity, optional
+        :param dt: temporal resolution of the protocol, defaults to None (the
+            simulation time step)
+        :type dt: Time quantity, optional
+        """
+        if stim_cfgs==None:
+            stim_cfgs = self.stim_cfgs
+        if t_start==None:
+            t_start = self.net.t
+        if dt==None:
+            dt = self.dt
+        
+        stims = utils.stimulator(self, stim_cfgs)
+        protocol = {}
+        for pop_name, pop in self.pops.items():
+            pop_stims = [stim for stim in stims.values() if stim['pop']==pop_name]
+            values, cols = utils.compile_protocol(pop_stims, len(pop), dt/b2.ms)
+            
+            if len(pop_stims):
+                protocol[pop_name] = {'values': values, 'cols': cols, 
+                                      'dt': float(dt/b2.ms),
+                                      't_start': float(t_start/b2.ms)}
+        self.apply_protocol(protocol)
         
     def train(self):
         assert self.training==True
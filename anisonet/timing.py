@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A light-weight hierarchical timer to measure the cost of the different phases
+of a simulation (setting up, warming up, running batches, post-processing,
+...). Phases can be nested arbitrarily and for each of them the following
+quantities are recorded:
+
+    #. ``wall``: the elapsed wall-clock time in seconds
+    #. ``cpu``: the CPU time of the process in seconds
+    #. ``peak_rss``: the peak resident memory of the process (in MB) by the end
+       of the phase. Note that this is the peak since the start of the process,
+       and not only within the phase. It is not available on Windows.
+
+Every ``Simulate`` object owns a timer (``sim.timer``) which can be exported
+to json or printed as a human-readable summary:
+
+.. code-block:: python
+
+    sim.setup_net()
+    sim.start(duration=2000*b2.ms, profile=True)
+    print(sim.timer.summary())
+    sim.timer.to_json('timings.json')
+
+If the simulation is profiled by Brian, the profiling information of each
+batch is merged into the timer as well.
+"""
+
+import sys
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the current process in MB, or
+    ``None`` if it cannot be determined on this platform.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin':
+        return peak/1024.**2 # in bytes
+    return peak/1024. # in kilobytes
+
+
+class Timer(object):
+    """
+    Records the wall time, CPU time and peak memory of nested phases.
+    """
+
+    def __init__(self, verbose=True):
+        """
+        :param verbose: whether or not to print a time-stamped message when a
+            phase with a message starts, defaults to True
+        :type verbose: bool, optional
+        """
+        self.verbose = verbose
+        self.root = {'name': 'total', 'children': []}
+        self._stack = [self.root]
+
+    def start(self, name, msg=None):
+        """
+        Starts a new phase nested within the currently running one.
+
+        :param name: name of the phase
+        :type name: str
+        :param msg: message to print, defaults to None
+        :type msg: str, optional
+        :return: the record of the phase
+        :rtype: dict
+        """
+        if self.verbose and msg!=None:
+            print('{} -- {}'.format(time.ctime(), msg))
+
+        record = {'name': name, 'wall': None, 'cpu': None, 'peak_rss': None,
+                  'children': [],
+                  '_start': (time.perf_counter(), time.process_time())}
+        self._stack[-1]['children'].append(record)
+        self._stack.append(record)
+        return record
+
+    def stop(self):
+        """
+        Stops the most recently started phase.
+        """
+        assert len(self._stack)>1, 'No phase is running.'
+
+        record = self._stack.pop()
+        wall0, cpu0 = record.pop('_start')
+        record['wall'] = time.perf_counter() - wall0
+        record['cpu'] = time.process_time() - cpu0
+        record['peak_rss'] = get_peak_rss()
+        return record
+
+    @contextmanager
+    def phase(self, name, msg=None):
+        """
+        Context manager version of ``start`` and ``stop``.
+        """
+        record = self.start(name, msg)
+        try:
+            yield record
+        finally:
+            self.stop()
+
+    def add(self, name, wall, cpu=None, peak_rss=None):
+        """
+        Adds an already measured phase (e.g., one that ran in another 
+        process) to the running phase.
+        """
+        record = {'name': name, 'wall': wall, 'cpu': cpu, 'peak_rss': peak_rss,
+                  'children': []}
+        self._stack[-1]['children'].append(record)
+        return record
+    
+    def add_brian_profile(self, net):
+        """
+        Attaches the profiling information of a Brian network (i.e., time
+        spent in each code object during the last run) to the running phase.
+        Only meaningful if the network is run with ``profile=True``.
+        """
+        self._stack[-1]['brian2'] = {name: float(t)
+                                     for name, t in net.profiling_info}
+
+    def to_dict(self):
+        return self.root
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def summary(self, min_wall=0.):
+        """
+        A human-readable table of the recorded phases. Nested phases are
+        indented.
+
+        :param min_wall: hides the phases shorter than this value (in
+            seconds), defaults to 0.
+        :type min_wall: float, optional
+        :return: summary table
+        :rtype: str
+        """
+        fmt = '{:<40} {:>10} {:>10} {:>12}'
+        lines = [fmt.format('phase', 'wall [s]', 'cpu [s]', 'peak RSS [MB]')]
+
+        def fmt_val(val, spec):
+            return '-' if val==None else spec.format(val)
+
+        def walk(record, depth):
+            for child in record['children']:
+                if (child['wall']!=None) and (child['wall']<min_wall):
+                    continue
+                lines.append(fmt.format('  '*depth + child['name'],
+                                        fmt_val(child['wall'], '{:.3f}'),
+                                        fmt_val(child['cpu'], '{:.3f}'),
+                                        fmt_val(child['peak_rss'], '{:.1f}')))
+                walk(child, depth+1)
+
+                for name, t in child.get('brian2', {}).items():
+                    if t>=min_wall:
+                        lines.append(fmt.format('  '*(depth+1) + '[brian2] '+name,
+                                                '{:.3f}'.format(t), '', ''))
+        walk(self.root, 0)
+        return '\n'.join(lines)
+
+
+def timed(name, msg=None):
+    """
+    Decorates a method of an object that has a ``timer`` attribute, such that
+    each call is recorded as a phase.
+
+    :param name: name of the phase
+    :type name: str
+    :param msg: message to print when the phase starts, defaults to None
+    :type msg: str, optional
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timer.phase(name, msg):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -9,8 +9,12 @@ import os
 osjoin = os.path.join # an alias for convenient
 
 import pickle
+import hashlib
+import functools
+import weakref
 import numpy as np
 from collections import defaultdict
+from contextlib import contextmanager
 
 import brian2 as b2
 from brian2 import mV, nS, pA, ms, second
@@ -55,20 +59,317 @@ def idx2coords(idxs, net):
     return coords
 
 
-def make_full_train(sim, mon_name):
-    mon_dict = aggregate_mons(sim, mon_name, SI=True)
-    idxs = mon_dict['i']
-    ts = mon_dict['t']
+def fingerprint(*items, length=12):
+    """
+    Computes a short, deterministic hash of the given items. Arrays are hashed
+    by their content and everything else (configs, quantities, numbers) by its
+    representation. Useful for keying cached states on disk.
+
+    :param items: arrays or objects with a deterministic ``repr``
+    :type items: any
+    :param length: number of hex characters to keep, defaults to 12
+    :type length: int, optional
+    :return: hexadecimal digest
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            h.update(np.ascontiguousarray(item).tobytes())
+        else:
+            h.update(repr(item).encode())
+    return h.hexdigest()[:length]
+
+
+def files_signature(paths):
+    """
+    A cheap fingerprint of files by their paths, sizes and modification 
+    times. It changes whenever any of them is rewritten, added or removed.
+    """
+    stats = []
+    for path in sorted(paths):
+        st = os.stat(path)
+        stats.append((path, st.st_size, st.st_mtime_ns))
+    return fingerprint(stats)
+
+
+_memo = weakref.WeakKeyDictionary()
+
+@contextmanager
+def memoizing(sim):
+    """
+    Within this context, the inputs shared by several analyses of ``sim``
+    (e.g., the aggregated monitors or the connectivity matrices, c.f. 
+    ``memoize``) are loaded only once and kept in memory. They are released 
+    when the context exits.
+    """
+    _memo[sim] = {}
+    try:
+        yield _memo[sim]
+    finally:
+        _memo.pop(sim, None)
+
+def get_memo(sim):
+    """Returns the memo of ``sim`` if it is being memoized, otherwise None."""
+    try:
+        return _memo.get(sim)
+    except TypeError: # not weak-referenceable
+        return None
+
+def memoize(sim, key, func):
+    """
+    Returns ``func()``, computed only once per ``key`` while ``sim`` is being
+    memoized (c.f. ``memoizing``). Otherwise, ``func`` is simply called.
+    """
+    memo = get_memo(sim)
+    if memo is None:
+        return func()
+    if key not in memo:
+        memo[key] = func()
+    return memo[key]
+
+def load_connectivity(sim, pathway):
+    """
+    Loads the stored connectivity matrix of a pathway (in COO format). The 
+    matrix is shared and should not be modified in place.
+    """
+    from scipy import sparse
+    
+    path = osjoin(sim.data_path, sim.name+'_w_'+pathway+'.npz')
+    return memoize(sim, ('w', pathway), lambda: sparse.load_npz(path).tocoo())
+
+
+def get_mon(sim, mon_name):
+    """Returns the monitor of ``sim`` called ``mon_name``."""
+    return [mon for mon in sim.mons if mon.name==mon_name][0]
+
+
+def iter_mons(sim, mon_name):
+    """
+    Iterates over the saved batches of the monitor ``mon_name`` on disk in 
+    chronological order, yielding the recorded data of one batch at a time.
+    Unlike ``aggregate_mons``, only one batch is held in memory, also while
+    ``sim`` is being memoized.
+    
+    :param mon_name: The name of monitor of interest
+    :type mon_name: str
+    :return: recorded variables of each batch (as by ``get_states``)
+    :rtype: generator of dict
+    """
+    name_pattern = sim.name+ '_'+ mon_name+'_*.dat'
+    files_list = sorted(glob.glob( osjoin(sim.data_path, name_pattern)))
+    for file in files_list:
+        with open(file, 'rb') as f:
+            yield pickle.load(f)
+
+
+def spike_summary(sim, mon_name):
+    """
+    Number of spikes, and the first and last spike times (in seconds) of the 
+    monitor ``mon_name``, streamed from its archive (c.f. ``iter_mons``).
     
-    tmin, tmax = ts.min(), ts.max()
-    idxs = sorted(np.unique(idxs))
+    :rtype: (int, float, float)
+    """
+    def summarize():
+        nspikes, t_min, t_max = 0, np.inf, -np.inf
+        for data in iter_mons(sim, mon_name):
+            t = np.asarray(data['t'], dtype=float)
+            if len(t):
+                nspikes += len(t)
+                t_min, t_max = min(t_min, t.min()), max(t_max, t.max())
+        if nspikes==0:
+            t_min = t_max = 0.
+        return nspikes, float(t_min), float(t_max)
+    return memoize(sim, ('spike_summary', mon_name), summarize)
+
+
+def spike_counts(sim, mon_name):
+    """
+    Number of spikes of each neuron of the monitor ``mon_name``, streamed 
+    from its archive (c.f. ``iter_mons``).
     
+    :rtype: array of ints
+    """
+    def count():
+        counts = np.zeros(len(get_mon(sim, mon_name).source), dtype=int)
+        for data in iter_mons(sim, mon_name):
+            counts += np.bincount(np.asarray(data['i'], dtype=int), 
+                                  minlength=len(counts))
+        return counts
+    return memoize(sim, ('spike_counts', mon_name), count)
+
+
+def frame_counts(sim, mon_name, bin_width, nbins=None, max_cells=2**24):
+    """
+    Counts the spikes of each neuron per time bin (e.g., animation frame) 
+    by streaming the archive of the monitor ``mon_name`` batch by batch. The 
+    counts of each batch are computed by ``np.bincount`` on the combined 
+    (bin, neuron) keys, over windows of at most ``max_cells`` cells, and 
+    stored sparsely. Hence, memory grows with the number of active 
+    (bin, neuron) pairs rather than the duration times the population size.
     
-    ts = np.zeros( (len(idxs), int((tmax-tmin)//sim.dt) + 1))
+    :param mon_name: name of the spike monitor
+    :type mon_name: str
+    :param bin_width: bin width in seconds
+    :type bin_width: float
+    :param nbins: number of bins from t=0, defaults to None (up to the last 
+        spike). Later spikes are dropped.
+    :type nbins: int, optional
+    :param max_cells: maximum size of the dense count windows, defaults to 
+        2**24
+    :type max_cells: int, optional
+    :return: spike counts with shape (number of bins, number of neurons)
+    :rtype: scipy.sparse.csr_matrix
+    """
+    from scipy import sparse
     
-    # for idx in idxs:
+    N = len(get_mon(sim, mon_name).source)
+    step = max(max_cells//N, 1) # bins per window
+    
+    rows, cols, vals = [], [], []
+    for data in iter_mons(sim, mon_name):
+        f = (np.asarray(data['t'], dtype=float)/bin_width).astype(np.int64)
+        i = np.asarray(data['i'], dtype=np.int64)
+        keep = f < nbins if nbins is not None else slice(None)
+        f, i = f[keep], i[keep]
+        del data
+        if len(f)==0:
+            continue
         
+        # spikes are chronological within a batch
+        order = np.argsort(f, kind='stable')
+        f, i = f[order], i[order]
+        starts = np.arange(f[0], f[-1]+1, step)
+        bounds = np.searchsorted(f, np.r_[starts, f[-1]+1])
+        for start, lo, hi in zip(starts, bounds[:-1], bounds[1:]):
+            if lo==hi:
+                continue
+            n = f[hi-1] - start + 1
+            counts = np.bincount((f[lo:hi]-start)*N + i[lo:hi], minlength=n*N)
+            nz = np.flatnonzero(counts)
+            rows.append(start + nz//N)
+            cols.append(nz % N)
+            vals.append(counts[nz].astype(np.float32))
     
+    if len(rows):
+        rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    else:
+        rows = cols = np.zeros(0, dtype=int)
+        vals = np.zeros(0, dtype=np.float32)
+    if nbins is None:
+        nbins = rows.max()+1 if len(rows) else 0
+    
+    # a bin split between two batches is summed up here
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(nbins, N))
+
+
+def make_full_train(sim, mon_name, bin_width=None, t_range=None, 
+                    neurons=None, sigma=None, smoothing='sparse', 
+                    chunk_size=1024):
+    """
+    Builds the binned spike-count raster of a population from the archive of 
+    the spike monitor ``mon_name`` as a sparse (CSR) matrix of shape 
+    (number of neurons, number of bins). The raster is never densified at the
+    resolution of the simulation.
+    
+    Optionally, the spike trains are smoothed with a Gaussian kernel of width
+    ``sigma`` along time, either:
+    
+        * ``'sparse'``: by multiplying with a banded (sparse) kernel matrix. 
+          The result stays sparse, but its number of non-zeros grows with the 
+          width of the kernel. Suited for narrow kernels.
+        * ``'fft'``: by FFT convolution of dense blocks of ``chunk_size`` 
+          neurons, which are sparsified again by dropping values below 1e-6 
+          of the kernel's peak. Suited for wide kernels.
+    
+    :param mon_name: name of the spike monitor
+    :type mon_name: str
+    :param bin_width: bin width in seconds (``np.inf`` gives a single bin), 
+        defaults to None (the time step of the simulation)
+    :type bin_width: float, optional
+    :param t_range: (tmin, tmax) of the raster in seconds, defaults to None 
+        (from the first to the last spike, which falls in the last bin)
+    :type t_range: tuple, optional
+    :param neurons: indices of the neurons to include (rows are in the given
+        order), defaults to None (all neurons of the population)
+    :type neurons: array of ints, optional
+    :param sigma: standard deviation of the Gaussian kernel in seconds, 
+        defaults to None (no smoothing)
+    :type sigma: float, optional
+    :param smoothing: ``'sparse'`` or ``'fft'``, defaults to 'sparse'
+    :type smoothing: str, optional
+    :param chunk_size: number of neurons per block in FFT smoothing, defaults
+        to 1024
+    :type chunk_size: int, optional
+    :return: raster and bin edges (in seconds)
+    :rtype: (scipy.sparse.csr_matrix, array)
+    """
+    from scipy import signal
+    from scipy import sparse
+    
+    N = len(get_mon(sim, mon_name).source)
+    if bin_width is None:
+        bin_width = float(sim.dt/second)
+    
+    # mapping the neuron indices to rows
+    if neurons is None:
+        neurons = np.arange(N)
+    neurons = np.asarray(neurons)
+    row_of = -np.ones(N, dtype=int)
+    row_of[neurons] = np.arange(len(neurons))
+    
+    rows, ts = [], []
+    for data in iter_mons(sim, mon_name):
+        t = np.asarray(data['t'], dtype=float)
+        r = row_of[np.asarray(data['i'], dtype=int)]
+        keep = r >= 0
+        if t_range is not None:
+            keep &= (t >= t_range[0]) & (t < t_range[1])
+        rows.append(r[keep])
+        ts.append(t[keep])
+        del data
+    rows, ts = np.concatenate(rows), np.concatenate(ts)
+    
+    if t_range is None:
+        t_range = (ts.min(), ts.max()) if len(ts) else (0., 0.)
+    span = t_range[1] - t_range[0]
+    if not np.isfinite(bin_width):
+        bin_width = max(span, 1e-12) # a single bin
+    nbins = max(int(np.ceil(span/bin_width - 1e-9)), 1)
+    edges = t_range[0] + np.arange(nbins + 1)*bin_width
+    
+    cols = np.minimum(((ts - t_range[0])/bin_width).astype(int), nbins - 1)
+    X = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), 
+                          shape=(len(neurons), nbins))
+    X.sum_duplicates()
+    
+    if sigma is not None:
+        s = sigma/bin_width # in bins
+        half = int(np.ceil(4*s))
+        kernel = np.exp(-0.5*(np.arange(-half, half+1)/s)**2)
+        kernel /= kernel.sum()
+        
+        if smoothing=='sparse':
+            K = sparse.diags(kernel, np.arange(-half, half+1), 
+                             shape=(nbins, nbins), format='csr', 
+                             dtype=np.float32)
+            X = X @ K
+        
+        elif smoothing=='fft':
+            blocks = []
+            for start in range(0, X.shape[0], chunk_size):
+                block = X[start:start+chunk_size].toarray()
+                block = signal.fftconvolve(block, kernel[None,:], mode='same', 
+                                           axes=1)
+                block[block < 1e-6*kernel.max()] = 0
+                blocks.append(sparse.csr_matrix(block.astype(np.float32)))
+            X = sparse.vstack(blocks, format='csr')
+        
+        else:
+            raise NotImplementedError('Smoothing {} is not recognized.'.format(smoothing))
+    
+    return X, edges
+
     
 def aggregate_mons(sim, mon_name, SI=False):
     """
@@ -80,7 +381,6 @@ def aggregate_mons(sim, mon_name, SI=False):
     :rtype: (array of ints, array of floats)
 
     """
-    
     data_path = sim.data_path
     name_pattern = sim.name+ '_'+ mon_name+'_*.dat'
     
@@ -113,47 +413,256 @@ def aggregate_mons(sim, mon_name, SI=False):
     return mon
 
 
+@functools.lru_cache(maxsize=8)
+def _grid_coords(gs):
+    """Coordinates of all grid points in index order (c.f. ``idx2coords``)."""
+    y, x = np.divmod(np.arange(gs**2), gs)
+    x.flags.writeable = False
+    y.flags.writeable = False
+    return x, y
+
+
+def _grid_offsets(gs, x0, y0):
+    """Periodic offsets of all grid points (in index order) from (x0, y0)."""
+    x, y = _grid_coords(gs)
+    dx = (x - x0 + gs/2) % gs - gs/2
+    dy = (y - y0 + gs/2) % gs - gs/2
+    return dx, dy
+
+
+def get_domain_mask(domain, gs, rng=None):
+    """
+    Computes the boolean mask of a stimulation domain over a periodic square
+    grid of size ``gs``, in the index order of the populations (c.f. 
+    ``coord2idx``). All distances are periodic. The following domains are 
+    supported:
+        
+    .. code-block:: python
+        
+        {'type': 'r', 'x0': ..., 'y0': ..., 'r': ...} # disk (or 'disk')
+        {'type': 'xy', 'x_min': ..., 'x_max': ..., 
+                       'y_min': ..., 'y_max': ...} # rectangle (or 'rect')
+        {'type': 'ring', 'x0': ..., 'y0': ..., 'r_in': ..., 'r_out': ...}
+        {'type': 'ellipse', 'x0': ..., 'y0': ..., 'a': ..., 'b': ..., 
+                            'phi': ...} # semi-axes a and b, rotated by phi
+        {'type': 'random', 'p': ...} # a random fraction p of the grid
+        {'type': 'union', 'domains': [...]} # also 'intersection'
+        {'type': 'difference', 'domains': [...]} # first minus the others
+        {'type': 'complement', 'domain': ...}
+    
+    Rectangles include their lower bounds and exclude the upper ones, and 
+    may wrap around the edges. Rings include their outer radius only.
+    
+    :param domain: domain configuration
+    :type domain: dict
+    :param gs: grid size
+    :type gs: int
+    :param rng: random generator of the random domains, defaults to None
+    :type rng: np.random.Generator, optional
+    :return: mask of size ``gs**2``
+    :rtype: array of bools
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    kind = domain['type']
+    
+    if kind in ['r', 'disk']:
+        dx, dy = _grid_offsets(gs, domain['x0'], domain['y0'])
+        mask = dx**2 + dy**2 <= domain['r']**2
+    
+    elif kind in ['xy', 'rect']:
+        x, y = _grid_coords(gs)
+        mask = ((x - domain['x_min']) % gs < domain['x_max'] - domain['x_min']) & \
+               ((y - domain['y_min']) % gs < domain['y_max'] - domain['y_min'])
+    
+    elif kind=='ring':
+        dx, dy = _grid_offsets(gs, domain['x0'], domain['y0'])
+        d2 = dx**2 + dy**2
+        mask = (d2 > domain['r_in']**2) & (d2 <= domain['r_out']**2)
+        
+    elif kind=='ellipse':
+        dx, dy = _grid_offsets(gs, domain['x0'], domain['y0'])
+        c, s = np.cos(domain.get('phi', 0)), np.sin(domain.get('phi', 0))
+        u = ( c*dx + s*dy)/domain['a']
+        v = (-s*dx + c*dy)/domain['b']
+        mask = u**2 + v**2 <= 1
+    
+    elif kind=='random':
+        mask = np.zeros(gs**2, dtype=bool)
+        mask[rng.choice(gs**2, int(round(gs**2 * domain['p'])), replace=False)] = True
+    
+    elif kind in ['union', 'intersection', 'difference']:
+        masks = [get_domain_mask(d, gs, rng) for d in domain['domains']]
+        mask = masks[0].copy()
+        for m in masks[1:]:
+            if kind=='union':
+                mask |= m
+            elif kind=='intersection':
+                mask &= m
+            else:
+                mask &= ~m
+    
+    elif kind=='complement':
+        mask = ~get_domain_mask(domain['domain'], gs, rng)
+    
+    else:
+        raise NotImplementedError('Unknown stimulation domain: {}'.format(kind))
+    
+    return mask
+
+
+def get_domain_idxs(domain, gs, rng=None):
+    """
+    Indices of the neurons within a stimulation domain (c.f. 
+    ``get_domain_mask``), sorted and without repetition.
+    """
+    return np.flatnonzero(get_domain_mask(domain, gs, rng))
+
+
+_stim_types = ['const', 'windows', 'ramp', 'pulses', 'schedule']
+
+def get_stim_segments(stim_cfg):
+    """
+    The list of stimulus segments of a stimulation configuration. A 
+    ``'schedule'`` is the sum of its ``'segments'``; any other type is a 
+    single segment. Times are in ms and currents in pA:
+        
+    .. code-block:: python
+        
+        {'type': 'const', 'I_stim': ..., 't_start': 0, 't_stop': inf}
+        {'type': 'windows', 'I_stim': ..., 'windows': [(t_on, t_off), ...]}
+        {'type': 'ramp', 'I_start': 0, 'I_stop': ..., 't_start': ..., 
+                         't_stop': ...} # zero outside [t_start, t_stop)
+        {'type': 'pulses', 'I_stim': ..., 'period': ..., 'width': ..., 
+                           't_start': 0, 'n': inf, 't_stop': inf}
+        {'type': 'schedule', 'segments': [...]}
+    """
+    if stim_cfg['type'] not in _stim_types:
+        raise NotImplementedError('Unknown stimulation type: {}'.format(stim_cfg['type']))
+    
+    if stim_cfg['type']=='schedule':
+        return [seg for cfg in stim_cfg['segments'] 
+                for seg in get_stim_segments(cfg)]
+    return [stim_cfg]
+
+
+def get_stim_horizon(segments):
+    """
+    The time (in ms) after which the stimulus of the segments stays constant.
+    """
+    horizon = 0.
+    for seg in segments:
+        t_start, t_stop = seg.get('t_start', 0), seg.get('t_stop', np.inf)
+        if seg['type']=='const':
+            end = t_stop if np.isfinite(t_stop) else t_start
+        elif seg['type']=='windows':
+            end = max([t_off for _, t_off in seg['windows']], default=0)
+        elif seg['type']=='ramp':
+            end = t_stop
+        elif seg['type']=='pulses':
+            end = min(t_stop, t_start + seg.get('n', np.inf)*seg['period'])
+        
+        if not np.isfinite(end):
+            raise ValueError('Stimulus segment {} never ends.'.format(seg))
+        horizon = max(horizon, end)
+    return horizon
+
+
+def get_stim_waveform(segments, ts):
+    """
+    The stimulus (in pA) of the segments at times ``ts`` (in ms), c.f.
+    ``get_stim_segments``.
+    """
+    ts = np.asarray(ts, dtype=float)
+    I = np.zeros_like(ts)
+    for seg in segments:
+        t_start, t_stop = seg.get('t_start', 0), seg.get('t_stop', np.inf)
+        
+        if seg['type']=='const':
+            I += seg['I_stim'] * ((ts>=t_start) & (ts<t_stop))
+        
+        elif seg['type']=='windows':
+            # number of open windows: those started minus those finished
+            t_ons, t_offs = np.asarray(seg['windows'], dtype=float).reshape(-1, 2).T
+            n_open = np.searchsorted(np.sort(t_ons), ts, side='right') - \
+                     np.searchsorted(np.sort(t_offs), ts, side='right')
+            I += seg['I_stim'] * n_open
+        
+        elif seg['type']=='ramp':
+            I_start = seg.get('I_start', 0)
+            frac = (ts - t_start)/(t_stop - t_start)
+            I += ((ts>=t_start) & (ts<t_stop)) * (I_start + (seg['I_stop'] - I_start)*frac)
+        
+        elif seg['type']=='pulses':
+            k, phase = np.divmod(ts - t_start, seg['period'])
+            on = (ts>=t_start) & (ts<t_stop) & (phase<seg['width']) & \
+                 (k<seg.get('n', np.inf))
+            I += seg['I_stim'] * on
+    return I
+
+
 def stimulator(sim, stim_cfgs):
+    """
+    Finds the stimulated neurons and the stimulus segments of every 
+    stimulation configuration. Stimulation ids are like 
+    ``<population>_<id>``, e.g., ``I_0``. Their domains are described in 
+    ``get_domain_mask`` and their stimulus in ``get_stim_segments``.
+    
+    :return: dictionary of stimulation ids to ``pop``, ``idxs`` and 
+        ``segments``
+    :rtype: dict
+    """
+    rng = np.random.default_rng(getattr(sim, 'seed', None))
+    
     stims = {}
     for stim_id, stim_cfg in stim_cfgs.items():
-        domain = stim_cfg['domain']
-        ampli = stim_cfg['domain'] 
-        pop = stim_id.strip('_')[0] # assuming ids like I_1, I_2
+        pop = stim_id.split('_')[0] # assuming ids like I_1, I_2
         gs = sim.pops[pop].gs 
         
-        # finding domain
-        if domain['type']=='random':
-            idxs = np.random.randint(0, gs**2, round(gs**2 * domain['p']))
-        else:
-            if domain['type']=='xy':
-                x = np.arange(domain['x_min'], domain['x_max'])
-                y = np.arange(domain['y_min'], domain['y_max'])
-                x,y = np.meshgrid(x,y)
-                coords = np.array(list(zip(x.ravel(),y.ravel())))
-            
-            elif domain['type']=='r':
-                coords = []
-                for x in range(-round(domain['r'])-1, round(domain['r'])+1):
-                    for y in range(-round(domain['r'])-1, round(domain['r'])+1):
-                        if x**2 + y**2 <= domain['r']**2:
-                            coords.append( [(x + domain['x0'])%gs, 
-                                            (y + domain['y0'])%gs] ) 
-                coords = np.array(coords).reshape(-1,2)
-            
-            idxs = coord2idx(coords, sim.pops[pop])
-            
+        stims[stim_id] = {'pop': pop,
+                          'idxs': get_domain_idxs(stim_cfg['domain'], gs, rng),
+                          'segments': get_stim_segments(stim_cfg)}
+    return stims
 
-        # finding amplitude
-        if stim_cfg['type']=='const':
-            I_stim = stim_cfg['I_stim']*pA
-            # b2.TimedArray([stim_cfg['I_stim']]*pA,
-            #                                dt=sim.pops[pop].clock.dt)
-        else:
-            raise NotImplementedError('Only constant stimulation is supported now.')
-        
-        stims[stim_id] = {'idxs': idxs, 'I_stim': I_stim}
+
+def compile_protocol(stims, N, dt):
+    """
+    Compiles the stimuli of a population into a table over time and distinct
+    stimulus patterns, as the values of a 2D ``TimedArray``. Neurons that 
+    belong to the same set of domains share a column, such that the table 
+    grows with the number of distinct overlaps rather than the number of 
+    neurons. Column 0 is reserved for the unstimulated neurons.
     
-    return stims
+    Row ``n`` holds the stimulus at ``n*dt`` after the start of the protocol.
+    The table does not cover the time before the start; it is up to the 
+    caller to offset it (c.f. ``stim_t0`` in ``equations.get_nrn_eqs``). The 
+    last row holds the (constant) stimulus after the protocol is over.
+    
+    :param stims: stimuli of the population (c.f. ``stimulator``)
+    :type stims: list of dict
+    :param N: size of the population
+    :type N: int
+    :param dt: temporal resolution in ms
+    :type dt: float
+    :return: table of stimuli in pA of shape (nt, ncols), and the column of 
+        every neuron
+    :rtype: (array, array of ints)
+    """
+    if len(stims)==0:
+        return np.zeros((1, 1)), np.zeros(N, dtype=int)
+    
+    # distinct patterns of membership; the all-false one comes first
+    member = np.zeros((N+1, len(stims)), dtype=bool)
+    for n, stim in enumerate(stims):
+        member[np.asarray(stim['idxs'])+1, n] = True
+    patterns, cols = np.unique(member, axis=0, return_inverse=True)
+    
+    horizon = max(get_stim_horizon(stim['segments']) for stim in stims)
+    ts = np.arange(int(np.ceil(horizon/dt)) + 1)*dt
+    waveforms = np.array([get_stim_waveform(stim['segments'], ts) for stim in stims])
+    
+    values = patterns.astype(float) @ waveforms
+    return values.T, cols.ravel()[1:]
 
 
 def get_line_idx(x0, y0, c, pop, eps=2):
@@ -170,27 +679,84 @@ def get_line_idx(x0, y0, c, pop, eps=2):
     return idxs, coords
     
     
-def phase_estimator(idxs, ts, dt):
-    t = np.linspace(0, ts.max(), int(ts.max()//dt) + 1)
-    phis = np.zeros(shape= (len(set(idxs)), len(t)))
+def phase_estimator(idxs, ts, dt, stride=1, dtype=np.float64, max_cells=2**20):
+    """
+    Estimates the phase of the spiking neurons on a regular time grid. The
+    phase of a neuron grows linearly from 0 to :math:`2\\pi` between two 
+    consecutive spikes, and is zero before its first and after its last spike.
     
-    for num, idx in enumerate(sorted(set(idxs))):
-        phi = np.zeros_like(t)
-        
-        t_spk = sorted(ts[idxs == idx])
-        
-        if len(t_spk)>1:
-            t_dif = np.diff(t_spk)
+    Spikes are sorted by (neuron, time) once, and the interval that contains 
+    each grid point is found by a binary search, so no Python loop over 
+    neurons or intervals is involved. The phases are computed in blocks of at
+    most ``max_cells`` (neuron, time) pairs, split over neurons and, for long
+    grids, over time as well. Hence, the temporary memory is bounded by about
+    60 bytes per cell regardless of the duration; only the returned phases 
+    grow with it.
+    
+    :param idxs: indices of the spiking neurons
+    :type idxs: array of ints
+    :param ts: spike times (in the same unit as ``dt``)
+    :type ts: array of floats
+    :param dt: temporal resolution
+    :type dt: float
+    :param stride: the output grid contains every ``stride``-th time step, 
+        defaults to 1
+    :type stride: int, optional
+    :param dtype: data type of the phases. Use ``np.float32`` to halve the 
+        memory, defaults to np.float64
+    :type dtype: numpy dtype, optional
+    :param max_cells: maximum number of (neuron, time) pairs computed at once,
+        defaults to 2**20
+    :type max_cells: int, optional
+    :return: time grid, and phases of the spiking neurons (sorted by their 
+        index) with shape (number of spiking neurons, len(t))
+    :rtype: (array of floats, 2D array of dtype)
+    """
+    idxs = np.asarray(idxs)
+    ts = np.asarray(ts, dtype=float)
+    
+    t = np.arange(0, int(ts.max()//dt) + 1, stride) * dt
+    
+    order = np.lexsort((ts, idxs))
+    idxs, ts = idxs[order], ts[order]
+    neurons, rank = np.unique(idxs, return_inverse=True)
+    
+    # shifting the spike trains of the neurons apart, such that all spikes
+    # form a single sorted array that can be searched at once
+    span = t[-1] + ts.max() + 1.
+    ts_shifted = ts + rank*span
+    
+    # blocks of (neurons, time steps) within the budget
+    ncols = max(1, min(len(t), max_cells))
+    nrows = max(1, max_cells // ncols)
+    
+    phis = np.zeros((len(neurons), len(t)), dtype=dtype)
+    for row0 in range(0, len(neurons), nrows):
+        rows = np.arange(row0, min(row0 + nrows, len(neurons)))
+        for col0 in range(0, len(t), ncols):
+            cols = slice(col0, col0 + ncols)
+            query = t[None, cols] + (rows*span)[:,None]
+            
+            nxt = np.searchsorted(ts_shifted, query, side='right')
+            prv = np.maximum(nxt - 1, 0)
+            valid = (nxt > 0) & (nxt < len(ts))
+            np.minimum(nxt, len(ts) - 1, out=nxt)
             
-            head = int(t_spk[0]//dt)
+            # inside an interval of the same neuron
+            valid &= (rank[prv] == rows[:,None]) 
+            valid &= (rank[nxt] == rows[:,None])
             
-            for chunk_id, dif in  enumerate(t_dif):
-                # set_trace()
-                chunk_len = int(dif//dt)
-                phi[ head: head + chunk_len] = np.linspace(0, 2*np.pi, chunk_len) 
-                head += chunk_len
+            t_prv = ts_shifted[prv]
+            query -= t_prv
+            t_nxt = ts_shifted[nxt]
+            t_nxt -= t_prv
+            del prv, nxt, t_prv
             
-            phis[num] = phi
+            with np.errstate(invalid='ignore', divide='ignore'):
+                phi = np.divide(query, t_nxt, dtype=dtype)
+            phi *= 2*np.pi
+            phi[~valid] = 0
+            phis[rows, cols] = phi
     
     return t, phis
 
@@ -205,6 +771,201 @@ def estimate_order_parameter(phis, k=None):
     return np.abs(R), np.angle(R)
 
 
+class OrderParameter(object):
+    """
+    Streaming estimation of the Kuramoto order parameter of a population of
+    ``N`` neurons. Spikes are fed chronologically in chunks (e.g., batch by 
+    batch, or file by file from the archive) via ``update``, and the order 
+    parameter of the time bins that cannot change anymore is returned. Phases
+    are defined as in ``phase_estimator``, but the phase matrix is never 
+    materialized: only the last spike of each neuron and the bins that are 
+    not yet finalized are kept. 
+    
+    A neuron takes part in the average from its first spike on, so neurons 
+    that have not spiked yet (or never do) do not bias the order parameter; 
+    bins before the first spike of the population are ``nan``. After its 
+    last spike, a neuron contributes with a zero phase, as in 
+    ``phase_estimator``.
+    
+    Bins are finalized once no open interval can reach back into them. A 
+    neuron that stops spiking would thus hold them back forever; with 
+    ``max_isi``, intervals longer than that are regarded as silence (zero 
+    phase) instead, and the bins older than ``max_isi`` before the latest 
+    spike are finalized. Memory is then O(N + chunk + max_isi/dt).
+    """
+    
+    def __init__(self, N, dt, stride=1, k=None, max_isi=None):
+        """
+        :param N: number of neurons
+        :type N: int
+        :param dt: temporal resolution (in the same unit as the spike times)
+        :type dt: float
+        :param stride: the time grid contains every ``stride``-th time step,
+            defaults to 1
+        :type stride: int, optional
+        :param k: weights of the neurons, defaults to None (equal weights)
+        :type k: array of floats, optional
+        :param max_isi: longest inter-spike interval over which the phase 
+            advances (in the same unit as the spike times), defaults to None
+            (no limit)
+        :type max_isi: float, optional
+        """
+        self.dt = dt
+        self.stride = stride
+        self.max_isi = max_isi
+        self.k = np.ones(N) if k is None else np.asarray(k, dtype=float)
+        assert len(self.k)==N
+        
+        self.last = np.full(N, np.nan) # last spike time of each neuron
+        self.j0 = 0 # first bin that is not finalized yet
+        self.corr = np.zeros(0, dtype=complex) # corrections from bin j0 on
+        self.w_new = np.zeros(0) # weights of neurons joining from bin j0 on
+        self.w_active = 0. # weights of neurons that joined before bin j0
+        self.t_max = 0.
+    
+    def get_t(self, j):
+        return (j*self.stride)*self.dt
+    
+    def first_bin(self, t):
+        """Index of the first bin at or after time ``t``."""
+        j = np.ceil(t/(self.stride*self.dt)).astype(int)
+        j -= (self.get_t(j-1) >= t)
+        j += (self.get_t(j) < t)
+        return j
+    
+    def update(self, idxs, ts):
+        """
+        Feeds a chunk of spikes. All spikes must be later than (or at the same
+        time as) the spikes of the previous chunks.
+        
+        :return: time, magnitude and angle of the order parameter of the bins
+            finalized by this chunk
+        :rtype: tuple of arrays
+        """
+        idxs = np.asarray(idxs, dtype=int)
+        ts = np.asarray(ts, dtype=float)
+        if len(ts):
+            order = np.lexsort((ts, idxs))
+            idxs, ts = idxs[order], ts[order]
+            
+            # previous spike of each spike; either within the chunk or before
+            same = np.r_[False, idxs[1:]==idxs[:-1]]
+            t0 = np.where(same, np.r_[np.nan, ts[:-1]], self.last[idxs])
+            
+            # neurons joining with their first spike
+            first = np.isnan(t0)
+            j_first = self.first_bin(ts[first])
+            self.grow(j_first.max()+1 if len(j_first) else 0)
+            self.w_new += np.bincount(j_first - self.j0, weights=self.k[idxs[first]],
+                                      minlength=len(self.w_new))
+            
+            # intervals [t0, t1) and the bins they cover
+            has_prv = ~first
+            if self.max_isi!=None:
+                has_prv[has_prv] = (ts - t0)[has_prv] <= self.max_isi
+            t0, t1, k = t0[has_prv], ts[has_prv], self.k[idxs[has_prv]]
+            j_start, j_stop = self.first_bin(t0), self.first_bin(t1)
+            nbins = j_stop - j_start
+            
+            self.grow(j_stop.max() if len(j_stop) else 0)
+            j = np.repeat(j_start, nbins) + (np.arange(nbins.sum()) - 
+                                             np.repeat(np.cumsum(nbins)-nbins, nbins))
+            t = self.get_t(j)
+            t0, t1, k = [np.repeat(v, nbins) for v in [t0, t1, k]]
+            phi = 2*np.pi*(t - t0)/(t1 - t0)
+            
+            # the phase of the bin was accounted as zero (contributing 1)
+            self.corr += np.bincount(j - self.j0, weights=k*(np.cos(phi)-1), 
+                                     minlength=len(self.corr))
+            self.corr += 1j*np.bincount(j - self.j0, weights=k*np.sin(phi), 
+                                        minlength=len(self.corr))
+            
+            self.last[idxs] = ts # the latest spike of each neuron wins
+            self.t_max = max(self.t_max, ts.max())
+        
+        # only intervals starting at the last spikes may still be closed
+        t_safe = np.nanmin(self.last) if np.any(~np.isnan(self.last)) else 0.
+        if self.max_isi!=None:
+            t_safe = max(t_safe, self.t_max - self.max_isi)
+        return self.flush(self.first_bin(t_safe))
+    
+    def finalize(self, t_end=None):
+        """
+        Returns the order parameter of all remaining bins up to ``t_end`` 
+        (defaults to the last spike).
+        """
+        if t_end is None:
+            t_end = self.t_max
+        return self.flush(int(t_end//self.dt)//self.stride + 1)
+    
+    def get_R(self, j_start, j_stop):
+        """Order parameter of the (not finalized) bins in [j_start, j_stop)."""
+        W = self.w_active + np.cumsum(self.w_new[:j_stop-self.j0])[j_start-self.j0:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            R = (W + self.corr[j_start-self.j0 : j_stop-self.j0])/W
+        return np.abs(R), np.angle(R)
+    
+    def peek(self, t_start, t_end):
+        """
+        Order parameter of the bins between ``t_start`` and ``t_end`` as if 
+        the recording ended at ``t_end``, i.e., open intervals are taken to 
+        never close. The bins are not finalized.
+        """
+        j_start = max(self.first_bin(t_start), self.j0)
+        j_stop = max(int(t_end//self.dt)//self.stride + 1, j_start)
+        self.grow(j_stop)
+        
+        t = self.get_t(np.arange(j_start, j_stop))
+        return (t,) + self.get_R(j_start, j_stop)
+    
+    def grow(self, j_stop):
+        n = j_stop - self.j0 - len(self.corr)
+        if n > 0:
+            self.corr = np.r_[self.corr, np.zeros(n, dtype=complex)]
+            self.w_new = np.r_[self.w_new, np.zeros(n)]
+    
+    def flush(self, j_stop):
+        j_stop = max(j_stop, self.j0)
+        self.grow(j_stop)
+        n = j_stop - self.j0
+        
+        R, psi = self.get_R(self.j0, j_stop)
+        t = self.get_t(np.arange(self.j0, j_stop))
+        
+        self.w_active += self.w_new[:n].sum()
+        self.corr = self.corr[n:]
+        self.w_new = self.w_new[n:]
+        self.j0 = j_stop
+        return t, R, psi
+    
+
+def stream_order_parameter(sim, mon_name, dt, stride=1, k=None, max_isi=None):
+    """
+    Computes the order parameter of the population recorded by the monitor 
+    ``mon_name`` by walking through its archive on disk file by file (c.f. 
+    ``OrderParameter``).
+    
+    :param dt: temporal resolution in seconds
+    :type dt: float
+    :param max_isi: longest inter-spike interval in seconds, defaults to None
+        (no limit, as in ``phase_estimator``)
+    :type max_isi: float, optional
+    :return: time (in seconds), magnitude and angle of the order parameter
+    :rtype: tuple of arrays
+    """
+    mon = get_mon(sim, mon_name)
+    order_param = OrderParameter(len(mon.source), dt, stride=stride, k=k, 
+                                 max_isi=max_isi)
+    
+    res = []
+    for data in iter_mons(sim, mon_name):
+        res.append(order_param.update(data['i'], data['t']))
+        del data
+    res.append(order_param.finalize())
+    
+    return tuple(np.concatenate(v) for v in zip(*res))
+
+
 def make_circular(r, r_max):
     return 2*np.pi*r/r_max
 
@@ -308,27 +1069,165 @@ def balance_dist(t0, t_min=0, t_max=1):
     # phis *= 2*np.pi/(np.max(phis)+1e-12)
     # phis -= np.pi
 
-def get_anisotropic_U(sim, syn_name, Umax):
+def sample_syn_param(syn, dist, params, on='pre', rng=None):
+    """
+    Draws a per-synapse variable whose distribution depends on the pre- or 
+    post-synaptic neuron, e.g., on a landscape value. The parameters of the 
+    distribution are given per neuron and are spread over the synapses via 
+    ``syn.i`` (or ``syn.j``), such that all samples are drawn in one call:
+    
+    .. code-block:: python
+        
+        # U ~ Beta(2, b) with a different b for each presynapse
+        b = 2*(1./U_mean - 1) # array of length of the source population
+        Us = sample_syn_param(syn, 'beta', {'a': 2, 'b': b})
+    
+    :param syn: synapse object
+    :type syn: Brian's Synapses object
+    :param dist: name of a distribution of ``numpy.random.Generator``
+    :type dist: str
+    :param params: keyword arguments of the distribution. Arrays are taken as
+        values per neuron (of the source or target, c.f. ``on``), while 
+        scalars are shared by all synapses.
+    :type params: dict
+    :param on: whether parameters are given per pre- (``'pre'``) or 
+        post-synapse (``'post'``), defaults to 'pre'
+    :type on: str, optional
+    :param rng: a generator or a seed, defaults to None
+    :type rng: numpy.random.Generator or int, optional
+    :return: one sample per synapse
+    :rtype: array
+    """
+    if on=='pre':
+        idxs = syn.i.__array__()
+    elif on=='post':
+        idxs = syn.j.__array__()
+    else:
+        raise NotImplementedError('Side {} is not recognized.'.format(on))
+    
+    rng = np.random.default_rng(rng)
+    kws = {k: np.asarray(v)[idxs] if np.ndim(v) else v 
+           for k, v in params.items()}
+    return getattr(rng, dist)(size=len(idxs), **kws)
+    
+def get_anisotropic_U(sim, syn_name, Umax, alpha=2, rng=None):
+    """
+    Heterogeneous release probability ``U`` of a Tsodyks-Markram synapse. 
+    The mean of ``U`` of each presynapse is its (normalized) :math:`\\phi` 
+    landscape value scaled to ``[0, Umax]``, and ``U`` is drawn from a Beta 
+    distribution with that mean.
+    
+    :param sim: ``simulate`` object
+    :type sim: object
+    :param syn_name: name of the pathway
+    :type syn_name: str
+    :param Umax: maximum of the mean release probabilities
+    :type Umax: float
+    :param alpha: first shape parameter of the Beta distribution, defaults 
+        to 2
+    :type alpha: float, optional
+    :param rng: a generator or a seed, defaults to None (``sim.seed``)
+    :type rng: numpy.random.Generator or int, optional
+    :return: ``U`` of each synapse
+    :rtype: array
+    """
     syn = sim.syns[syn_name]
-    conn_cfg = sim.conn_cfg[syn_name]
     lscp = sim.lscp[syn_name]['phi']
     lscp = Umax*(lscp- lscp.min())/(lscp.max()-lscp.min())
     
-    Us = np.zeros(len(syn))
-    for idx_pre in sorted(set(sim.syns[syn_name].i)):
-        syn_idx = syn["i=={}".format(idx_pre)]._indices()
-        U_mean = lscp[idx_pre]
-        alpha = 2
-        beta = alpha*(1./(U_mean+1e-12) - 1)
-        Us[syn_idx] = np.random.beta(alpha, beta, size= len(syn_idx))
-    return Us
+    beta = alpha*(1./(lscp+1e-12) - 1)
+    if rng is None:
+        rng = sim.seed
+    return sample_syn_param(syn, 'beta', {'a': alpha, 'b': beta}, rng=rng)
+
+
+class SynapseIndex(object):
+    """
+    Adjacency index of a set of synapses over their ids: synapses sorted by 
+    their pre-synapse (CSR-like) and by their post-synapse (CSC-like). Unlike 
+    Brian's string queries (e.g., ``syn["i=={}".format(idx)]``), which 
+    evaluate an expression over all synapses, lookups cost O(degree).
+    
+    Use ``get_syn_index`` to get the cached index of a ``Synapses`` object.
+    """
+    
+    def __init__(self, i, j, N_pre, N_post):
+        """
+        :param i: pre-synaptic indices of the synapses
+        :type i: array of ints
+        :param j: post-synaptic indices of the synapses
+        :type j: array of ints
+        :param N_pre: size of the source population
+        :type N_pre: int
+        :param N_post: size of the target population
+        :type N_post: int
+        """
+        self.i = np.asarray(i)
+        self.j = np.asarray(j)
+        self.nsyn = len(self.i)
+        
+        self.pre_order = np.argsort(self.i, kind='stable')
+        self.pre_ptr = np.r_[0, np.cumsum(np.bincount(self.i, minlength=N_pre))]
+        self.post_order = np.argsort(self.j, kind='stable')
+        self.post_ptr = np.r_[0, np.cumsum(np.bincount(self.j, minlength=N_post))]
+    
+    @classmethod
+    def from_syn(cls, syn):
+        return cls(syn.i.__array__(), syn.j.__array__(), 
+                   len(syn.source), len(syn.target))
+    
+    def out_degree(self):
+        return np.diff(self.pre_ptr)
+    
+    def in_degree(self):
+        return np.diff(self.post_ptr)
+    
+    def pre_syns(self, pre_idx):
+        """ids of the synapses whose pre-synapse is ``pre_idx``."""
+        return self.pre_order[self.pre_ptr[pre_idx]:self.pre_ptr[pre_idx+1]]
+    
+    def post_syns(self, post_idx):
+        """ids of the synapses whose post-synapse is ``post_idx``."""
+        return self.post_order[self.post_ptr[post_idx]:self.post_ptr[post_idx+1]]
+    
+    def posts(self, pre_idx):
+        """post-synapse indices of the pre-synapse ``pre_idx``."""
+        return self.j[self.pre_syns(pre_idx)]
+    
+    def pres(self, post_idx):
+        """pre-synapse indices of the post-synapse ``post_idx``."""
+        return self.i[self.post_syns(post_idx)]
+
 
+_syn_indices = weakref.WeakKeyDictionary()
+
+def get_syn_index(syn):
+    """
+    Returns the adjacency index (``SynapseIndex``) of a ``Synapses`` object. 
+    It is built on the first call and cached afterwards. Since synapses can 
+    only be added, the cache is rebuilt whenever the number of synapses 
+    changes, i.e., after a (re)connection. Use ``invalidate_syn_index`` if the
+    synapses are changed otherwise.
+    """
+    index = _syn_indices.get(syn)
+    if (index is None) or (index.nsyn!=len(syn)):
+        index = SynapseIndex.from_syn(syn)
+        _syn_indices[syn] = index
+    return index
+
+def invalidate_syn_index(syn):
+    """Drops the cached adjacency index of a ``Synapses`` object."""
+    _syn_indices.pop(syn, None)
 
 def get_post_idxs(syn, pre_idx):
     """returns the postsynapse indices of a presynapse with the given index."""
 
-    syns_pre = syn["i=={}".format(pre_idx)]._indices()
-    return syn.j[syns_pre]
+    return get_syn_index(syn).posts(pre_idx)
+
+def get_pre_idxs(syn, post_idx):
+    """returns the presynapse indices of a postsynapse with the given index."""
+
+    return get_syn_index(syn).pres(post_idx)
 
 
 def get_post_locs(syn, pre_idx):
@@ -10,7 +10,6 @@ name (inherited from the simulation object).
 """
 
 import matplotlib.pyplot as plt
-from matplotlib import animation
 from matplotlib.colors import Normalize, LogNorm
 from matplotlib.cm import ScalarMappable
 #import seaborn as sns
@@ -25,7 +24,8 @@ import os
 osjoin = os.path.join # an alias for convenient
 
 import anisonet.utils as utils 
-from anisonet.analyze import connectivity_manifold
+from anisonet.analyze import (connectivity_manifold, realized_landscape, 
+                              aniso_weights)
 
 from pdb import set_trace
 
@@ -230,7 +230,7 @@ def plot_field(field, figpath, vmin=None, vmax=None, phis=None):
     
     
 def plot_periodicity(sim, N=10):
-    for id_, key in enumerate(sim.conn_cfg.keys()):
+    for key in sim.conn_cfg.keys():
         src, trg = key
         spop = sim.pops[src]
         tpop = sim.pops[trg]
@@ -238,10 +238,8 @@ def plot_periodicity(sim, N=10):
         gs = tpop.gs
         periodicity_idxs = np.random.choice(spop.N, N)
         
-        posts = sim.syns[id_].j.__array__()
-        pres = sim.syns[id_].i.__array__()
         for plot_id, s_idx in enumerate(periodicity_idxs):
-            t_idxs = posts[pres==s_idx]
+            t_idxs = utils.get_post_idxs(sim.syns[key], s_idx)
             t_coords = utils.idx2coords(t_idxs, tpop)
             s_coord = utils.idx2coords(s_idx, spop)
             
@@ -294,7 +292,7 @@ def plot_periodicity(sim, N=10):
             plt.savefig(path, bbox_inches='tight', dpi=200)
             plt.close()
             plot_id += 1
-        del post_cntr, pres, posts
+        del post_cntr
         
 def plot_landscape(sim, overlay=True):
     """
@@ -333,31 +331,15 @@ def plot_realized_landscape(sim):
     :param sim: ``simulate`` object
     :type sim: object
     """
-    # for id_, key in enumerate(sim.conn_cfg.keys()):
     for syn in sim.syns.values():
-        spop = syn.source
-        tpop = syn.target
-        gs_s = spop.gs # source pop grid size
-        gs_t = tpop.gs # target pop grid size
+        gs_s = syn.source.gs # source pop grid size
+        gs_t = syn.target.gs # target pop grid size
         key = syn.name.split('_')[-1]
         
-        phis = np.zeros(spop.N) # containts realized phi        
-        posts = syn.j.__array__()
-        pres = syn.i.__array__()
+        phis, _ = utils.memoize(sim, ('realized', key), 
+            lambda: realized_landscape(syn.i.__array__(), syn.j.__array__(), 
+                                       gs_s, gs_t))
         
-        for _, s_idx in enumerate(sorted(set(pres))):
-            t_idxs = posts[pres==s_idx]
-            
-            # t_coords = utils.idx2coords(t_idxs, tpop)
-            # s_coord = utils.idx2coords(s_idx, spop)*gs_t/gs_s
-            
-            # post_cntr = t_coords-s_coord # centers
-            # post_cntr = (post_cntr + gs_t/2) % gs_t- gs_t/2 # make periodic
-            
-            post_cntr = utils.get_post_rel_locs(syn, s_idx)
-            phis[s_idx] = np.arctan2(post_cntr[:,1].mean(), post_cntr[:,0].mean())
-            #phis[s_idx] = np.arctan2(post_cntr[:,1], post_cntr[:,0]).mean()
-
         figpath = osjoin(sim.res_path, 'realized_phi_'+ key+'.png')
         plot_field(phis.reshape(gs_s, gs_s), figpath=figpath, vmin=-np.pi, vmax=np.pi)
         
@@ -372,24 +354,36 @@ def plot_realized_landscape(sim):
         figpath = osjoin(sim.res_path, 'realized_phi_density_'+ key+'.png')
         plt.savefig(figpath, bbox_inches='tight', dpi=200)
         plt.close()
-        del post_cntr, pres, posts
         
-def plot_connectivity(sim):
+def plot_connectivity(sim, resolution=1024):
     """
     Plots connectivity matrix of a given connectivity file and saves the figure
-    in the ``results`` folder.
+    in the ``results`` folder. The sparse matrix is never densified: synapses 
+    are binned into at most ``resolution`` x ``resolution`` blocks, and the
+    number of synapses per block is shown as an image. Thus, memory and time
+    do not grow with the size of the network.
     
     :param sim: ``simulate`` object
     :type sim: object
+    :param resolution: maximum number of blocks along each axis, defaults to 
+        1024
+    :type resolution: int, optional
     """
-    from scipy import sparse
-    
     for pathway in sim.conn_cfg.keys():
-        path = osjoin(sim.data_path, sim.name+'_w_'+pathway+'.npz')
-        w = sparse.load_npz(path).toarray()
-    
+        w = utils.load_connectivity(sim, pathway)
+        nrows, ncols = w.shape
+        res_r = min(resolution, nrows)
+        res_c = min(resolution, ncols)
+        
+        blocks = (w.row.astype(np.int64)*res_r//nrows)*res_c 
+        blocks += w.col.astype(np.int64)*res_c//ncols
+        density = np.bincount(blocks, minlength=res_r*res_c).reshape(res_r, res_c)
+        
         plt.figure()
-        plt.spy(w, origin='lower', rasterized=True,)
+        plt.imshow(np.ma.masked_equal(density, 0), origin='lower', 
+                   cmap='Greys', interpolation='nearest', aspect='auto',
+                   extent=(0, ncols, 0, nrows), vmin=0)
+        plt.colorbar(label='synapses per block')
         plt.xlabel('targets (post-synapse)')
         plt.ylabel('sources (pre-synapse)')
         plt.title(' '.join(sim.name.split('_')[:2]))
@@ -397,6 +391,7 @@ def plot_connectivity(sim):
         figpath = osjoin(sim.res_path, 'w_'+pathway+'.png')
         plt.savefig(figpath, bbox_inches='tight', dpi=200)
         plt.close()
+        del w, blocks, density
 
 def overlay_phis(phis, ax, size=5, color='k', scale=0.3, **kwargs):
     gs = len(phis)
@@ -451,12 +446,11 @@ def plot_firing_rates_dist(sim):
     # we only need population SpikeMonitors
     pop_mons = sim.get_pop_mons()
     for id_, mon in enumerate(pop_mons):
-        mon_dict = utils.aggregate_mons(sim, mon.name)
-        idxs, ts = mon_dict['i'], mon_dict['t']
+        counts = utils.spike_counts(sim, mon.name)
+        _, t_min, t_max = utils.spike_summary(sim, mon.name)
         
-        T = np.max(ts) - np.min(ts)
-        _, rates = np.unique(idxs, return_counts=True)
-        rates = rates*1./T
+        T = max(t_max - t_min, 1e-12)
+        rates = counts[counts>0]*1./T
         axs[id_].hist(rates, bins=50, density=True,)
         axs[id_].set_xlabel('Firing rate [Hz]')
         axs[id_].set_title('Population '+mon.name[-1])
@@ -475,6 +469,8 @@ def animator(fig, axs, imgs, vals, ts_bins=[]):
     """
     Makes the firing rate animation.
     """
+    from matplotlib import animation
+    
     n_frames = len(vals[0]) # total number of frames
     
     def animate(frame_id):
@@ -496,59 +492,201 @@ def animator(fig, axs, imgs, vals, ts_bins=[]):
 
     return anim
 
-def plot_animation(sim, ss_dur=25, fps=10, overlay=True):
+_render_cfg = {} # layout of the animation frames, set in each worker
+
+def _init_render(cfg):
+    _render_cfg.clear()
+    _render_cfg.update(cfg)
+    
+def _render_chunk(chunk):
+    """
+    Renders a chunk of consecutive frames into RGB arrays with the colormap 
+    LUT of ``_render_cfg``, without any matplotlib figure.
+    """
+    start, counts = chunk
+    cfg = _render_cfg
+    n = counts[0].shape[0]
+    img = np.full((n, cfg['H'], cfg['W'], 3), 255, dtype=np.uint8)
+    
+    for panel, count in zip(cfg['panels'], counts):
+        gs, scale = panel['gs'], panel['scale']
+        val = count.toarray()*(255./panel['vmax'])
+        idx = np.clip(val, 0, 255).astype(np.uint8).reshape(n, gs, gs)
+        rgb = cfg['lut'][idx[:, ::-1]] # origin='lower'
+        rgb = rgb.repeat(scale, axis=1).repeat(scale, axis=2)
+        
+        if panel['overlay'] is not None:
+            alpha = panel['overlay'][..., 3:]/255.
+            rgb = (rgb*(1-alpha) + panel['overlay'][..., :3]*alpha).astype(np.uint8)
+        
+        x0 = panel['x0']
+        img[:, :gs*scale, x0:x0+gs*scale] = rgb
+    
+    # progress bar in place of a time stamp
+    ends = (cfg['W']*(start + np.arange(1, n+1))/cfg['n_frames']).astype(int)
+    for k, end in enumerate(ends):
+        img[k, -cfg['bar']:, :end] = 0
+    return img
+
+def _render_frames(cfg, chunks, n_jobs):
+    """
+    Renders the chunks of frames in ``n_jobs`` worker processes and yields the
+    frames in order. Only a few chunks are in flight at a time, so the counts
+    are never fully densified.
+    """
+    from collections import deque
+    from multiprocessing import Pool
+    
+    if n_jobs==1:
+        _init_render(cfg)
+        for chunk in chunks:
+            yield from _render_chunk(chunk)
+        return
+    
+    with Pool(n_jobs, initializer=_init_render, initargs=(cfg,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+            if len(pending) >= 2*(n_jobs or os.cpu_count()):
+                yield from pending.popleft().get()
+        while len(pending):
+            yield from pending.popleft().get()
+
+def _phis_layer(phis, gs, scale):
+    """Rasterizes the overlay of the landscape once, as an RGBA image."""
+    size = gs*scale
+    fig = plt.figure(figsize=(size/100., size/100.), dpi=100)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.patch.set_alpha(0)
+    overlay_phis(phis, ax)
+    ax.set_xlim(-0.5, gs-0.5)
+    ax.set_ylim(-0.5, gs-0.5)
+    fig.canvas.draw()
+    layer = np.asarray(fig.canvas.buffer_rgba())[:size, :size].copy()
+    plt.close(fig)
+    return layer
+
+def _write_gif(path, frames, fps):
+    """
+    Encodes the frames into a GIF one at a time. Pillow's ``save_all`` keeps
+    every appended frame until the end, so the frames are quantized and 
+    written to the file as they arrive instead.
+    """
+    from PIL import Image, GifImagePlugin
+    
+    duration = int(round(1000./fps))
+    with open(path, 'wb') as f:
+        for n, frame in enumerate(frames):
+            img = Image.fromarray(frame).convert('P', palette=Image.Palette.ADAPTIVE)
+            if n==0:
+                header, _ = GifImagePlugin.getheader(img, info={'loop': 0})
+                f.write(b''.join(header))
+            f.write(b''.join(GifImagePlugin.getdata(
+                img, duration=duration, include_color_table=True)))
+        f.write(b';') # trailer
+
+def _write_mp4(path, frames, fps, W, H):
+    import shutil
+    import subprocess
+    from matplotlib import rcParams
+    
+    ffmpeg = shutil.which(rcParams['animation.ffmpeg_path'])
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg is required for MP4 animations.')
+    
+    cmd = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', 
+           '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(W, H), '-r', str(fps),
+           '-i', '-', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', path]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for frame in frames:
+            proc.stdin.write(frame.tobytes())
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    if proc.returncode:
+        raise RuntimeError('ffmpeg exited with code {}.'.format(proc.returncode))
+
+def plot_animation(sim, ss_dur=25, fps=10, overlay=True, fmt='gif', 
+                   n_jobs=None, chunk_size=64, size=256, cmap='viridis'):
     """
     Aggregates the firing rate from disk and make an animation.
     
+    Spike counts per frame are streamed from the archive (c.f. 
+    ``utils.frame_counts``) and stored sparsely. Frames are rendered in 
+    chunks by worker processes directly to RGB arrays through a colormap 
+    look-up table, and encoded at the end. The overlay of the landscape is 
+    rasterized only once. Frames are encoded as they are rendered, so long 
+    recordings can be animated with a bounded memory in both formats.
+    
     .. note:: 
         This function is inspired by the GitHub repo of `[1]`_.
     
     :param sim: ``simulate`` object
     :type sim: object
     :param ss_dur: duration of each snapshot (frame) in animation in ms; 
-        defaults to 50 (corresponding to 50 ms)
+        defaults to 25 
     :type ss_dur: int, optional
+    :param fps: frames per second, defaults to 10
+    :type fps: int, optional
+    :param overlay: whether to overlay the :math:`\\phi` landscape, defaults to
+        True
+    :type overlay: bool, optional
+    :param fmt: ``'gif'`` or ``'mp4'`` (needs ffmpeg), defaults to 'gif'
+    :type fmt: str, optional
+    :param n_jobs: number of rendering processes, defaults to None (all CPUs)
+    :type n_jobs: int, optional
+    :param chunk_size: number of frames rendered at once by each process, 
+        defaults to 64
+    :type chunk_size: int, optional
+    :param size: approximate size of each population's panel in pixels, 
+        defaults to 256
+    :type size: int, optional
+    :param cmap: colormap, defaults to 'viridis'
+    :type cmap: str, optional
     """
-    fig, axs = plt.subplots(1, len(sim.pops))
-    if  len(sim.pops)==1:
-        axs = [axs]
-    
-    ts_bins = np.arange(0, sim.net.t/ms + 1, ss_dur) * ms
-    
-    field_imgs = []
-    field_vals = []
-    
-    pop_mons = sim.get_pop_mons()        
-    for id_, mon in enumerate(pop_mons):
-        # idxs, ts = utils.aggregate_mons(sim, mon.name)
-        mon_dict = utils.aggregate_mons(sim, mon.name)
-        idxs, ts = mon_dict['i'], mon_dict['t']
-        
-        gs = int(np.sqrt(sim.pops[mon.name[-1]].N))
-        
-        h = np.histogram2d(ts, idxs, bins=[ts_bins, range(gs**2 + 1)])[0]
-        field_val = h.reshape(-1, gs, gs)
-        field_img = axs[id_].imshow(field_val[0], 
-                                    vmin=0, vmax=np.max(field_val), 
-                                    # norm = LogNorm(vmin=1e0, vmax=np.max(field_val)), 
-                                    origin='lower' # to match snapshots 
-                                    )
-        axs[id_].set_title('Population '+mon.name[-1])
-        
-        if overlay:
-            if 'phi' in sim.lscp[2*mon.name[-1]]:
-                phis = sim.lscp[2*mon.name[-1]]['phi']
-                overlay_phis(phis, axs[id_])
-        
-        field_vals.append(field_val)
-        field_imgs.append(field_img)
-        
-    anim = animator(fig, axs, field_imgs, field_vals, ts_bins)
-    
-    writergif = animation.PillowWriter(fps=fps) 
-    path = osjoin(sim.res_path, 'animation_rate.gif')
-    anim.save(path , writer=writergif)
-    plt.close()
+    if fmt not in ['gif', 'mp4']:
+        raise NotImplementedError('Format {} is not recognized.'.format(fmt))
+    
+    frame_dur = ss_dur*1e-3 # in seconds
+    n_frames = max(int(np.ceil(float(sim.net.t/second)/frame_dur - 1e-9)), 1)
+    
+    counts = []
+    panels = []
+    x0 = 0
+    for mon in sim.get_pop_mons():
+        count = utils.frame_counts(sim, mon.name, frame_dur, n_frames)
+        gs = int(np.sqrt(count.shape[1]))
+        scale = max(size//gs, 1)
+        
+        layer = None
+        if overlay and ('phi' in sim.lscp.get(2*mon.name[-1], {})):
+            layer = _phis_layer(sim.lscp[2*mon.name[-1]]['phi'], gs, scale)
+        
+        counts.append(count)
+        panels.append({'gs': gs, 'scale': scale, 'x0': x0, 'overlay': layer,
+                       'vmax': max(count.max(), 1)})
+        x0 += gs*scale + 8 # a gap between the populations
+    
+    bar = 4
+    W = x0 - 8
+    H = max(p['gs']*p['scale'] for p in panels) + 2*bar
+    W, H = W + W%2, H + H%2 # even sizes for the video codecs
+    lut = plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:, :3]
+    cfg = {'panels': panels, 'W': W, 'H': H, 'bar': bar, 'n_frames': n_frames,
+           'lut': (255*lut).astype(np.uint8)}
+    
+    chunks = ((start, [count[start:start+chunk_size] for count in counts])
+              for start in range(0, n_frames, chunk_size))
+    frames = _render_frames(cfg, chunks, n_jobs)
+    
+    path = osjoin(sim.res_path, 'animation_rate.'+fmt)
+    if fmt=='gif':
+        _write_gif(path, frames, fps)
+    else:
+        _write_mp4(path, frames, fps, W, H)
     
 def plot_R(sim):
     dt = sim.mons[0].clock.dt_ # in SI
@@ -560,11 +698,7 @@ def plot_R(sim):
     
     pop_mons = sim.get_pop_mons()
     for id_, mon in enumerate(pop_mons):
-        mon_dict = utils.aggregate_mons(sim, mon.name)
-        idxs, ts = mon_dict['i'], mon_dict['t']
-    
-        t, phis = utils.phase_estimator(idxs, ts, dt) # TODO: fix this!
-        R_rad, R_arg = utils.estimate_order_parameter(phis)  # TODO: fix this!
+        t, R_rad, R_arg = utils.stream_order_parameter(sim, mon.name, dt)
         
         axs[id_].plot(t, R_rad,)
         axs[id_].set_title('Population '+mon.name[-1])
@@ -635,15 +769,16 @@ def plot_spline_trace(sim, spls, ts, t_range, name):
         
     
     
-def plot_bump_speed(sim, disp, name):
+def plot_bump_speed(sim, traj, name):
     """
     Only the distribution of velocities matter, not the one of a specific 
-    cluster. So, I do not plot the legend.
+    cluster. So, I do not plot the legend. ``traj`` is a trajectory table as
+    given by ``analyze.BumpTracker``.
     """
     plt.figure()
     ax = plt.gca()
-    for bump_id, group in disp.groupby('label'):
-        ax.hist(group.v, bins=50, histtype='step', label=bump_id, 
+    for bump_id, group in traj.dropna().groupby('track'):
+        ax.hist(group.speed, bins=50, histtype='step', label=bump_id, 
                 alpha=0.4, density = True, color='k')
     
     ax.set_xscale('log')
@@ -773,10 +908,9 @@ def plot_manifold(sim, ncomp = 2):
     
     """
     for syn_name in sim.conn_cfg.keys():
-        w = sparse.load_npz(osjoin(sim.data_path, 
-                                   sim.name + '_w_'+ syn_name +'.npz'))
+        w = utils.load_connectivity(sim, syn_name)
         
-        manifold = connectivity_manifold(w, ncomp)
+        manifold = connectivity_manifold(w, ncomp, cache_dir=sim.data_path)
     
         gs = np.sqrt(manifold.shape[0])
         color = np.repeat(np.sin(np.pi*np.arange(gs)), gs)
@@ -808,6 +942,28 @@ def plot_manifold(sim, ncomp = 2):
         plt.savefig(figpath,dpi=200, bbox_inches='tight', )
         #plt.close()
         
+def plot_activity_manifold(sim, Y, labels, name):
+    """
+    Plots the neurons in the first two dimensions of the activity manifold
+    (c.f. ``analyze.find_manifold``), color-coded by their cluster, next to 
+    the clusters on the grid.
+    """
+    gs = int(np.sqrt(len(labels)))
+    fig, axs = plt.subplots(1, 2, figsize=(10, 4.5))
+    
+    axs[0].scatter(Y[:,0], Y[:,1], s=2, c=labels, cmap='tab10')
+    axs[0].set_xlabel('component 1')
+    axs[0].set_ylabel('component 2')
+    
+    axs[1].pcolormesh(labels.reshape(gs, gs), cmap='tab10', shading='flat')
+    axs[1].set_aspect('equal')
+    
+    fig.suptitle(name)
+    figpath = osjoin(sim.res_path, 'activity_manifold_'+name+'.png')
+    plt.savefig(figpath, dpi=200, bbox_inches='tight')
+    plt.close()
+    
+
 def plot_LT_weights(sim):
     """
     plots the long-term weight distribution if training is done.
@@ -827,36 +983,22 @@ def plot_LT_weights(sim):
             plt.savefig(figpath,dpi=200, bbox_inches='tight', )
             plt.close()
 
-def plot_aniso_weights(sim):
+def plot_aniso_weights(sim, weight='J'):
     """
     Plots the effective direction of the connectivity for each neuron based on
-    the modified synaptic weights.
-    """
-    
-    from brian2 import mV
+    the modified synaptic weights (c.f. ``analyze.aniso_weights``).
     
-    # for id_, key in enumerate(sim.conn_cfg.keys()):
+    :param sim: ``simulate`` object
+    :type sim: object
+    :param weight: synaptic weights (c.f. ``analyze.aniso_weights``), 
+        defaults to 'J'
+    :type weight: str or callable, optional
+    """
     for syn in sim.syns.values():
-        spop = syn.source
-        gs_s = spop.gs # source pop grid size
+        gs_s = syn.source.gs # source pop grid size
         key = syn.name.split('_')[-1]
         
-        phis = np.zeros(spop.N) # containts realized phi        
-        posts = syn.j.__array__()
-        pres = syn.i.__array__()
+        phis, _ = aniso_weights(syn, weight)
         
-        Js = syn.J/mV
-        Nconn = syn.N_outgoing_pre[0] # assuming all have the same
-        
-        for _, s_idx in enumerate(sorted(set(pres))):
-            post_cntr = utils.get_post_rel_locs(syn, s_idx)
-            
-            phis[s_idx] = np.arctan2(
-                np.average(post_cntr[:,1]*Js[s_idx*Nconn:(s_idx+1)*Nconn]),
-                np.average(post_cntr[:,0]*Js[s_idx*Nconn:(s_idx+1)*Nconn])
-            )
-        #    set_trace()                
         figpath = osjoin(sim.res_path, 'aniso_weights_'+ key+'.png')
-        plot_field(phis.reshape(gs_s, gs_s), figpath=figpath, vmin=-np.pi, vmax=np.pi)
-        
-        del post_cntr, pres, posts
\ No newline at end of file
+        plot_field(phis.reshape(gs_s, gs_s), figpath=figpath, vmin=-np.pi, vmax=np.pi)
\ No newline at end of file
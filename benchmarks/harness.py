@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A minimal benchmark harness. Benchmarks are registered with the ``benchmark``
+decorator, optionally parametrized over a grid of parameters. A benchmark
+function receives one combination of parameters, does all its (untimed)
+preparations, and returns a callable with no arguments which is then timed:
+
+.. code-block:: python
+
+    @benchmark(params={'gs': [50, 100]})
+    def make_perlin(gs):
+        cfg = {'type': 'perlin', 'args': {'scale': 3}}
+        return lambda: make_landscape(gs, cfg)
+
+Results of every session are appended to a json history, together with some
+information about the environment (commit, python and library versions).
+Each session is compared against the latest recorded one, and cases which got
+slower than a tolerance are reported as regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import subprocess
+import traceback
+from collections import OrderedDict
+
+from anisonet.timing import get_peak_rss
+
+_registry = OrderedDict()
+
+
+def benchmark(params=None, repeat=3, number=1):
+    """
+    Registers a benchmark.
+
+    :param params: a dictionary of parameter names to the list of values to
+        be benchmarked. The cartesian product of all values is used, defaults
+        to None
+    :type params: dict, optional
+    :param repeat: number of timing repetitions, defaults to 3
+    :type repeat: int, optional
+    :param number: number of calls within each repetition, defaults to 1
+    :type number: int, optional
+    """
+    def decorator(func):
+        _registry[func.__name__] = dict(func=func, params=params or {},
+                                        repeat=repeat, number=number)
+        return func
+    return decorator
+
+
+def get_cases(pattern=None):
+    """
+    Lists all the registered cases as (case_id, benchmark name, params) where
+    the ``case_id`` is a unique string like ``name[gs=50,ncons=100]``.
+    """
+    cases = []
+    for name, bench in _registry.items():
+        keys = list(bench['params'].keys())
+        for values in itertools.product(*[bench['params'][k] for k in keys]):
+            params = dict(zip(keys, values))
+            case_id = name
+            if len(params):
+                case_id += '[' + ','.join('{}={}'.format(k, v)
+                                          for k, v in params.items()) + ']'
+            if (pattern==None) or (pattern in case_id):
+                cases.append((case_id, name, params))
+    return cases
+
+
+def run_case(name, params):
+    """
+    Prepares and times a single case. Errors are caught and reported, such
+    that one broken case does not stop the whole session.
+    """
+    bench = _registry[name]
+    result = {}
+    try:
+        t0 = time.perf_counter()
+        func = bench['func'](**params)
+        result['setup'] = time.perf_counter() - t0
+
+        times = []
+        for _ in range(bench['repeat']):
+            t0 = time.perf_counter()
+            for _ in range(bench['number']):
+                func()
+            times.append((time.perf_counter() - t0)/bench['number'])
+
+        times = sorted(times)
+        result['min'] = times[0]
+        result['median'] = times[len(times)//2]
+        result['max'] = times[-1]
+        result['peak_rss'] = get_peak_rss()
+
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc()
+
+    return result
+
+
+def get_environment():
+    env = {'time': time.ctime(),
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           }
+    try:
+        env['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        env['commit'] = None
+
+    for lib in ['numpy', 'scipy', 'brian2', 'sklearn', 'matplotlib']:
+        if lib in sys.modules:
+            env[lib] = getattr(sys.modules[lib], '__version__', None)
+    return env
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(results, previous, tol=0.2, min_time=1e-3):
+    """
+    Compares the minimum times of the results to a previous session. Cases
+    faster than ``min_time`` seconds are too noisy and are not compared.
+
+    :return: list of (case_id, previous time, current time) of the cases
+        which got slower by more than the fraction ``tol``.
+    :rtype: list
+    """
+    regressions = []
+    for case_id, res in results.items():
+        prev = previous.get(case_id, {})
+        if ('min' in res) and ('min' in prev):
+            if res['min'] < min_time:
+                continue
+            if res['min'] > (1+tol) * prev['min']:
+                regressions.append((case_id, prev['min'], res['min']))
+    return regressions
+
+
+def run(pattern=None, history_path=None, tol=0.2):
+    """
+    Runs all the registered (and matching) cases, prints a summary, and
+    appends the session to the history.
+
+    :param pattern: only cases whose id contain this string are run,
+        defaults to None
+    :type pattern: str, optional
+    :param history_path: path to the json history, defaults to None (no
+        history is read or written)
+    :type history_path: str, optional
+    :param tol: relative slowdown regarded as regression, defaults to 0.2
+    :type tol: float, optional
+    :return: the regressions (c.f. ``compare``)
+    :rtype: list
+    """
+    results = OrderedDict()
+    for case_id, name, params in get_cases(pattern):
+        print('{} -- Benchmarking {}'.format(time.ctime(), case_id))
+        results[case_id] = run_case(name, params)
+
+    fmt = '{:<60} {:>10} {:>10} {:>12}'
+    print('\n' + fmt.format('case', 'min [s]', 'median [s]', 'peak RSS [MB]'))
+    for case_id, res in results.items():
+        if 'error' in res:
+            print(fmt.format(case_id, 'ERROR', '', ''))
+        else:
+            rss = '-' if res['peak_rss']==None else '{:.1f}'.format(res['peak_rss'])
+            print(fmt.format(case_id, '{:.4f}'.format(res['min']),
+                             '{:.4f}'.format(res['median']), rss))
+
+    regressions = []
+    if history_path!=None:
+        history = load_history(history_path)
+        if len(history):
+            regressions = compare(results, history[-1]['results'], tol)
+            for case_id, prev, curr in regressions:
+                print('REGRESSION {}: {:.4f} s -> {:.4f} s'.format(case_id, prev, curr))
+
+        history.append({'env': get_environment(), 'results': results})
+        with open(history_path, 'w') as f:
+            json.dump(history, f, indent=2)
+
+    return regressions
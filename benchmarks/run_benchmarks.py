@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of ``anisonet``: drawing the connectivity, making
+landscapes, running the simulation, reading the monitors back from disk, and
+the post-processing (analysis and visualization).
+
+Usage::
+
+    python benchmarks/run_benchmarks.py                    # all cases
+    python benchmarks/run_benchmarks.py -k draw_posts      # matching cases
+    python benchmarks/run_benchmarks.py --list             # list the cases
+    python benchmarks/run_benchmarks.py --fail-on-regression
+
+Results are appended to ``benchmarks/history.json`` (change it with
+``--history``) and compared with the previous session. Simulations are run in a
+temporary folder which is removed afterwards.
+"""
+
+import os
+import sys
+import pickle
+import shutil
+import argparse
+import subprocess
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+import brian2 as b2
+
+from harness import benchmark, get_cases, run
+
+from anisonet.simulate import Simulate
+from anisonet.anisofy import draw_posts
+from anisonet.landscape import make_landscape
+from anisonet import utils, analyze, viz
+
+_root = tempfile.mkdtemp(prefix='anisonet_bench_')
+_sims = {}
+
+
+def get_sim(net_name='I_net', scalar=4, duration=200*b2.ms):
+    """
+    A simulated network shared among the post-processing benchmarks. It is
+    simulated only once per session.
+    """
+    key = (net_name, scalar, float(duration))
+    if key not in _sims:
+        sim = Simulate(net_name, scalar=scalar, load_connectivity=False,
+                       result_path=_root)
+        sim.timer.verbose = False
+        sim.setup_net()
+        sim.start(duration=duration, batch_dur=duration, restore=False,
+                  plot_snapshots=False)
+        _sims[key] = sim
+    return _sims[key]
+
+
+# ----------------------------------------------------------------------------
+# Start-up
+# ----------------------------------------------------------------------------
+@benchmark(params={'module': ['anisonet.simulate', 'anisonet.analyze', 
+                              'anisonet.viz']})
+def import_time(module):
+    """Importing a module in a fresh interpreter, as a worker process does."""
+    cmd = [sys.executable, '-c', 'import '+module]
+    return lambda: subprocess.run(cmd, check=True)
+
+
+# ----------------------------------------------------------------------------
+# Connectivity
+# ----------------------------------------------------------------------------
+@benchmark(params={'gs': [20, 50, 100], 'ncons': [100, 1000]})
+def draw_posts_per_neuron(gs, ncons):
+    profile = {'type': 'Gamma', 'params': {'theta': 3, 'kappa': 4}, 'gap': 2}
+    anisotropy = {'r': 1, 'phi': np.pi/6, 'vars': {}}
+    aniso_methods = {'connectivity': 'shift', 'synaptic': None}
+
+    def func():
+        for s_idx in range(100):
+            draw_posts((s_idx % gs, s_idx // gs % gs), ncons, gs, gs, gs, gs,
+                       profile, anisotropy, aniso_methods)
+    return func
+
+
+@benchmark(params={'scalar': [4, 2]}, repeat=1)
+def setup_syns(scalar):
+    sim = Simulate('I_net', scalar=scalar, load_connectivity=False,
+                   result_path=_root)
+    sim.timer.verbose = False
+    b2.start_scope()
+    sim.setup_pops()
+    sim.setup_landscape()
+    return sim.setup_syns
+
+
+@benchmark()
+def anisotropic_U():
+    sim = get_sim()
+    return lambda: utils.get_anisotropic_U(sim, 'II', 0.5)
+
+
+# ----------------------------------------------------------------------------
+# Landscapes
+# ----------------------------------------------------------------------------
+_lscp_cfgs = {
+    'constant': np.pi/6,
+    'random': {'type': 'random', 'args': None},
+    'perlin': {'type': 'perlin', 'args': {'scale': 3}},
+    }
+
+@benchmark(params={'kind': list(_lscp_cfgs.keys()), 'gs': [50, 100, 200]})
+def landscape(kind, gs):
+    return lambda: make_landscape(gs, _lscp_cfgs[kind])
+
+
+# ----------------------------------------------------------------------------
+# Simulation
+# ----------------------------------------------------------------------------
+@benchmark(params={'scalar': [4, 2]}, repeat=2)
+def simulate_start(scalar):
+    sim = Simulate('I_net', scalar=scalar, load_connectivity=False,
+                   result_path=_root)
+    sim.timer.verbose = False
+    sim.setup_net()
+    # compile once, such that the timing reflects the run itself
+    sim.net.run(0*b2.ms)
+    return lambda: sim.start(duration=200*b2.ms, batch_dur=100*b2.ms,
+                             restore=False, plot_snapshots=False)
+
+
+# ----------------------------------------------------------------------------
+# I/O
+# ----------------------------------------------------------------------------
+@benchmark(params={'nfiles': [10, 100], 'nspikes': [10000, 100000]})
+def aggregate_mons(nfiles, nspikes):
+    sim = SimpleNamespace(name='synthetic',
+                          data_path=tempfile.mkdtemp(dir=_root))
+    rng = np.random.default_rng(0)
+    for n in range(nfiles):
+        data = {'i': rng.integers(0, 2500, nspikes//nfiles),
+                't': np.sort(rng.uniform(n, n+1, nspikes//nfiles)),
+                'N': nspikes//nfiles}
+        path = os.path.join(sim.data_path,
+                            'synthetic_mon_I_{:0>3}.dat'.format(n))
+        with open(path, 'wb') as f:
+            pickle.dump(data, f)
+    return lambda: utils.aggregate_mons(sim, 'mon_I')
+
+
+# ----------------------------------------------------------------------------
+# Post-processing
+# ----------------------------------------------------------------------------
+@benchmark(repeat=1)
+def find_bumps():
+    sim = get_sim()
+    return lambda: analyze.find_bumps(sim, plot=False)
+
+
+_viz_funcs = ['plot_landscape', 'plot_in_out_deg', 'plot_connectivity',
+              'plot_realized_landscape', 'plot_aniso_weights',
+              'plot_firing_rates', 'plot_firing_rates_dist', 'plot_animation',
+              'plot_R', 'plot_LT_weights', 'plot_manifold']
+
+@benchmark(params={'func': _viz_funcs}, repeat=1)
+def viz_post_process(func):
+    sim = get_sim()
+    return lambda: getattr(viz, func)(sim)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Runs the benchmarks.')
+    parser.add_argument('-k', dest='pattern', default=None,
+                        help='only runs cases whose id contain this string')
+    parser.add_argument('--history', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'history.json'),
+        help='path to the json history of results')
+    parser.add_argument('--tol', type=float, default=0.2,
+                        help='relative slowdown regarded as regression')
+    parser.add_argument('--list', action='store_true',
+                        help='lists the cases and exits')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='exits with non-zero status on regressions')
+    args = parser.parse_args()
+
+    regressions = []
+    try:
+        if args.list:
+            for case_id, _, _ in get_cases(args.pattern):
+                print(case_id)
+        else:
+            regressions = run(args.pattern, args.history, args.tol)
+    finally:
+        shutil.rmtree(_root, ignore_errors=True)
+
+    if args.fail_on_regression and len(regressions):
+        sys.exit(1)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scaling-law benchmark over the ``scalar`` parameter of the configurations.
+
+Networks are downsized by ``scalar`` (c.f. ``configs.get_config``), which
+shrinks the grid size by ``scalar`` and the number of connections by
+``scalar**2``. This driver sweeps ``scalar`` for each of the given
+configurations, and measures for each network:
+
+    #. ``connectivity``: wall time of drawing the connectivity (``setup_syns``)
+    #. ``setup``: wall time of setting up the whole network (``setup_net``)
+    #. ``compile``: wall time of Brian's code generation and compilation,
+       i.e., the first (empty) run of the network
+    #. ``run``: wall time of simulating ``duration``, and derived from that
+       ``steps_per_s`` and ``spikes_per_s``
+    #. ``peak_rss``: peak resident memory of the process in MB
+
+Every network is simulated in a fresh process such that the peak memory is not
+contaminated by the other ones. For each quantity ``y``, an empirical scaling
+law ``y ~ N**a`` is fitted against the total number of neurons ``N``, and the
+cost of the full-size network (``scalar=1``) is extrapolated from it.
+
+Usage::
+
+    python benchmarks/scaling.py --configs I_net EI_net --scalars 8 4 2
+
+Use ``--cold`` to compile the code in an empty cache, otherwise Brian's cache
+is reused and ``compile`` mostly reflects the code generation.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+
+_quantities = ['connectivity', 'setup', 'compile', 'run', 'peak_rss']
+
+
+def find_phase(record, name):
+    """Finds a phase by its name in the (nested) records of a timer."""
+    if record.get('name')==name:
+        return record
+    for child in record['children']:
+        found = find_phase(child, name)
+        if found!=None:
+            return found
+    return None
+
+
+def measure(net_name, scalar, duration, cold=False):
+    """
+    Sets up, compiles and runs a network, and returns the measurements.
+    Should be called in a fresh process (c.f. ``run_worker``).
+    """
+    import brian2 as b2
+    from anisonet.simulate import Simulate
+    from anisonet.timing import get_peak_rss
+
+    root = tempfile.mkdtemp(prefix='anisonet_scaling_')
+    try:
+        cache_dir = os.path.join(root, 'cache') if cold else None
+        sim = Simulate(net_name, scalar=scalar, load_connectivity=False,
+                       result_path=root, cache_dir=cache_dir)
+        sim.timer.verbose = False
+        sim.setup_net()
+        sim.compile()
+
+        t0 = time.perf_counter()
+        sim.net.run(duration*b2.ms)
+        t_run = time.perf_counter() - t0
+
+        nsteps = int(round(duration*b2.ms/sim.dt))
+        nspikes = sum(mon.num_spikes for mon in sim.get_pop_mons())
+        timings = sim.timer.to_dict()
+        res = {'net_name': net_name,
+               'scalar': scalar,
+               'N': int(sum(len(pop) for pop in sim.pops.values())),
+               'nsyn': int(sum(len(syn) for syn in sim.syns.values())),
+               'duration': duration,
+               'connectivity': find_phase(timings, 'setup_syns')['wall'],
+               'setup': find_phase(timings, 'setup_net')['wall'],
+               'compile': find_phase(timings, 'compile')['wall'],
+               'codegen': find_phase(timings, 'compile')['codegen'],
+               'run': t_run,
+               'steps_per_s': nsteps/t_run,
+               'spikes_per_s': nspikes/t_run,
+               'nspikes': int(nspikes),
+               'peak_rss': get_peak_rss(),
+               }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return res
+
+
+def run_worker(net_name, scalar, duration, cold=False):
+    """Runs ``measure`` in a separate process and returns its results."""
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        out = f.name
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker',
+               '--configs', net_name, '--scalars', str(scalar),
+               '--duration', str(duration), '--output', out]
+        if cold:
+            cmd.append('--cold')
+        subprocess.run(cmd, check=True)
+        with open(out, 'r') as f:
+            return json.load(f)
+    finally:
+        os.remove(out)
+
+
+def get_full_size(net_name):
+    """Number of neurons of the full-size (``scalar=1``) network."""
+    from anisonet import configs
+    pops_cfg, _, _ = configs.get_config(net_name, scalar=1)
+    return sum(cfg['gs']**2 for cfg in pops_cfg.values())
+
+
+def fit_scaling(results, quantities=_quantities):
+    """
+    Fits ``y = c * N**a`` to each quantity by a least-square fit in log-log
+    scale.
+
+    :param results: measurements of the same network at different scalars
+    :type results: list of dict
+    :return: dictionary of quantity to ``(a, c)``. Quantities with less than
+        two valid measurements are left out.
+    :rtype: dict
+    """
+    fits = {}
+    for q in quantities:
+        pts = [(res['N'], res[q]) for res in results
+               if (res.get(q)!=None) and (res[q]>0)]
+        if len(set(n for n, _ in pts))<2:
+            continue
+        logN, logy = np.log(np.array(pts, dtype=float)).T
+        a, logc = np.polyfit(logN, logy, 1)
+        fits[q] = (float(a), float(np.exp(logc)))
+    return fits
+
+
+def report(net_name, results, fits):
+    lines = ['', 'Network: {}'.format(net_name)]
+    fmt = '{:>6} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12} {:>10}'
+    lines.append(fmt.format('scalar', 'N', 'nsyn', 'conn [s]', 'setup [s]',
+                            'compile [s]', 'run [s]', 'steps/s', 'spikes/s',
+                            'RSS [MB]'))
+    for res in sorted(results, key=lambda r: r['N']):
+        lines.append(fmt.format(res['scalar'], res['N'], res['nsyn'],
+                                '{:.2f}'.format(res['connectivity']),
+                                '{:.2f}'.format(res['setup']),
+                                '{:.2f}'.format(res['compile']),
+                                '{:.2f}'.format(res['run']),
+                                '{:.1f}'.format(res['steps_per_s']),
+                                '{:.0f}'.format(res['spikes_per_s']),
+                                '-' if res['peak_rss']==None else '{:.1f}'.format(res['peak_rss'])))
+
+    N_full = get_full_size(net_name)
+    lines.append('Scaling exponents (y ~ N**a) and forecast for N={}:'.format(N_full))
+    for q, (a, c) in fits.items():
+        lines.append('\t{:<14} a = {:5.2f}\tforecast: {:.3g}'.format(q, a, c*N_full**a))
+    return '\n'.join(lines)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Scaling-law benchmark.')
+    parser.add_argument('--configs', nargs='+', default=['I_net'],
+                        help='network configuration names')
+    parser.add_argument('--scalars', nargs='+', type=float, default=[8, 4, 2],
+                        help='scalars to sweep')
+    parser.add_argument('--duration', type=float, default=200.,
+                        help='simulated duration in ms')
+    parser.add_argument('--output', default='scaling.json',
+                        help='path to the json file of results')
+    parser.add_argument('--cold', action='store_true',
+                        help='compiles in an empty cache')
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        res = measure(args.configs[0], args.scalars[0], args.duration, args.cold)
+        with open(args.output, 'w') as f:
+            json.dump(res, f)
+        sys.exit(0)
+
+    summary = {}
+    for net_name in args.configs:
+        results = []
+        for scalar in args.scalars:
+            print('{} -- Measuring {} at scalar {}'.format(time.ctime(), net_name, scalar))
+            try:
+                results.append(run_worker(net_name, scalar, args.duration, args.cold))
+            except subprocess.CalledProcessError as e:
+                print('\tWarning: {} at scalar {} failed: {}'.format(net_name, scalar, e))
+
+        fits = fit_scaling(results)
+        summary[net_name] = {'results': results,
+                             'exponents': {q: a for q, (a, _) in fits.items()},
+                             'prefactors': {q: c for q, (_, c) in fits.items()},
+                             'full_size': get_full_size(net_name),
+                             }
+        print(report(net_name, results, fits))
+
+    with open(args.output, 'w') as f:
+        json.dump(summary, f, indent=2)
@@ -24,7 +24,6 @@ setup(
         'scipy',
         'pandas',
         'scikit-learn',
-	'noise',             
     ],
 
     # classifiers=[
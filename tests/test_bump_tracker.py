@@ -0,0 +1,39 @@
+import numpy as np
+
+from anisonet.analyze import BumpTracker
+
+
+def moving_bumps(gs=60, T=0.2, rate=20):
+    # two bumps crossing the edges of the grid: one along x, one along y
+    rng = np.random.default_rng(0)
+    xy0 = np.array([[50., 30.], [20., 5.]])
+    v = np.array([[200., 0.], [0., -100.]]) # grid units per second
+    t = np.repeat(np.arange(0, T, 1e-3), rate)
+    bump = rng.integers(0, 2, len(t))
+    xy = xy0[bump] + v[bump]*t[:, None] + rng.normal(0, 1, (len(t), 2))
+    return np.round(xy) % gs, t, v
+
+
+def test_linking_and_wraparound():
+    gs = 60
+    xy, t, v = moving_bumps(gs)
+
+    tracker = BumpTracker(gs)
+    for chunk in np.array_split(np.arange(len(t)), [1000, 1100, 2500]):
+        tracker.update(xy[chunk], t[chunk])
+    df = tracker.finalize()
+
+    # each bump is one track across all windows, despite crossing the edges
+    long_tracks = df.groupby('track').size()
+    long_tracks = long_tracks[long_tracks > 3].index
+    assert len(long_tracks) == 2
+    assert ((df.x >= 0) & (df.x < gs) & (df.y >= 0) & (df.y < gs)).all()
+
+    vs = sorted(tuple(df[df.track==track][['vx', 'vy']].median())
+                for track in long_tracks)
+    assert np.allclose(vs, sorted(map(tuple, v)), atol=20)
+
+    # chunking does not change the windows
+    tracker = BumpTracker(gs)
+    tracker.update(xy, t)
+    assert np.allclose(tracker.finalize()[['t', 'x', 'y']], df[['t', 'x', 'y']])
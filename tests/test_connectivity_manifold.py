@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+from anisonet.analyze import connectivity_manifold
+
+
+def ring(N=100, k=3):
+    # each neuron projects to its k nearest neighbours on either side
+    pres = np.repeat(np.arange(N), 2*k)
+    posts = (pres + np.tile(np.r_[-k:0, 1:k+1], N)) % N
+    return sparse.coo_matrix((np.ones(len(pres)), (pres, posts)), shape=(N, N))
+
+
+def test_ring_embedding():
+    w = ring()
+    for solver in ['arpack', 'lobpcg']:
+        Y = connectivity_manifold(w, solver=solver)
+        assert Y.shape == (100, 2)
+        radius = np.hypot(*Y.T)
+        assert np.std(radius) < 1e-3*np.mean(radius) # a circle
+
+
+def test_cache(tmp_path, capsys):
+    w = ring()
+    Y = connectivity_manifold(w, cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 1
+    assert 'Loading' not in capsys.readouterr().out
+
+    # the same connectivity is loaded from the cache
+    assert np.array_equal(connectivity_manifold(w.tocsr(), cache_dir=str(tmp_path)), Y)
+    assert 'Loading' in capsys.readouterr().out
+
+    # any change of the connectivity or the embedding is a miss
+    w2 = w.tocsr()
+    w2[0, 1] = 5.
+    Y2 = connectivity_manifold(w2, cache_dir=str(tmp_path))
+    connectivity_manifold(w, ncomp=3, cache_dir=str(tmp_path))
+    assert 'Loading' not in capsys.readouterr().out
+    assert len(os.listdir(tmp_path)) == 3
+    assert not np.allclose(Y2, Y)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+import anisonet.utils as utils
+from anisonet.analyze import find_manifold
+from anisonet.timing import Timer
+
+from test_full_train import ArchiveSim, get_spikes
+
+
+class ManifoldSim(ArchiveSim):
+
+    def __init__(self, path, N=30):
+        idxs, ts = get_spikes(N, nspikes=5000, T=10.)
+        super().__init__(path, idxs, ts, N)
+        self.seed = 0
+        self.timer = Timer(verbose=False)
+
+        rng = np.random.default_rng(1)
+        w = sparse.random(N, N, density=.3, random_state=rng, format='coo')
+        sparse.save_npz(str(path / 'sim_w_II.npz'), w)
+
+    def get_pop_mons(self):
+        return self.mons
+
+
+def test_bin_widening(tmp_path, monkeypatch):
+    sim = ManifoldSim(tmp_path)
+
+    bin_widths = []
+    make_full_train = utils.make_full_train
+    def spy(sim, mon_name, bin_width, **kwargs):
+        bin_widths.append(bin_width)
+        return make_full_train(sim, mon_name, bin_width=bin_width, **kwargs)
+    monkeypatch.setattr(utils, 'make_full_train', spy)
+
+    kw = dict(plot=False, bin_width=1e-3, ncomp=3, n_clusters=2)
+    Y, labels = find_manifold(sim, **kw)['I']
+    assert bin_widths == [1e-3]
+    assert Y.shape == (30, 3) and len(set(labels)) == 2
+
+    # ~10k bins do not fit in 0.5 MB; the bins are doubled until they do
+    find_manifold(sim, mem_budget=.5, **kw)
+    assert bin_widths[-1] > 1e-3
+    assert np.log2(bin_widths[-1]/1e-3) % 1 == 0
+
+    # the widest bins are not widened more than needed
+    find_manifold(sim, mem_budget=.5, **dict(kw, bin_width=bin_widths[-1]/2))
+    assert bin_widths[-1] == bin_widths[-2]
+
+    # not even a single bin fits
+    with pytest.raises(MemoryError):
+        find_manifold(sim, mem_budget=1e-3, **kw)
@@ -0,0 +1,70 @@
+import pickle
+
+import numpy as np
+import brian2 as b2
+
+from anisonet.utils import make_full_train, frame_counts
+
+
+class ArchiveSim(object):
+    """A stand-in for ``Simulate`` whose spikes are archived in batches."""
+
+    def __init__(self, path, idxs, ts, N, nbatch=3):
+        self.name = 'sim'
+        self.data_path = str(path)
+        pop = b2.NeuronGroup(N, 'v: 1', threshold='False', name='I')
+        self.mons = [b2.SpikeMonitor(pop, name='mon_I')]
+        for n, sel in enumerate(np.array_split(np.argsort(ts), nbatch)):
+            with open(path / 'sim_mon_I_{:03d}.dat'.format(n), 'wb') as f:
+                pickle.dump({'i': idxs[sel], 't': ts[sel]}, f)
+
+
+def get_spikes(N=30, nspikes=2000, T=1.):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, N, nspikes), np.sort(rng.uniform(0, T, nspikes))
+
+
+def test_make_full_train(tmp_path):
+    N, bw = 30, 7e-3
+    idxs, ts = get_spikes(N)
+    sim = ArchiveSim(tmp_path, idxs, ts, N)
+
+    X, edges = make_full_train(sim, 'mon_I', bin_width=bw)
+    ref, _, _ = np.histogram2d(idxs, ts, bins=[np.arange(N+1), edges])
+    assert np.allclose(edges[[0, 1]], [ts.min(), ts.min() + bw])
+    assert edges[-1] >= ts.max()
+    assert np.array_equal(X.toarray(), ref)
+
+    # a subset of the neurons in the given order, within a time range
+    neurons = [7, 3, 20]
+    X, edges = make_full_train(sim, 'mon_I', bin_width=bw, t_range=(.2, .6),
+                               neurons=neurons)
+    sel = (ts >= .2) & (ts < .6)
+    ref, _, _ = np.histogram2d(idxs[sel], ts[sel], bins=[np.arange(N+1), edges])
+    assert np.array_equal(X.toarray(), ref[neurons])
+
+    # smoothing preserves the number of spikes away from the edges
+    X_s, _ = make_full_train(sim, 'mon_I', bin_width=bw, sigma=2*bw)
+    X_f, _ = make_full_train(sim, 'mon_I', bin_width=bw, sigma=2*bw,
+                             smoothing='fft', chunk_size=7)
+    assert np.allclose(X_s.toarray(), X_f.toarray(), atol=1e-4)
+    assert np.isclose(X_s.sum(), len(ts), rtol=2e-2)
+
+
+def test_frame_counts(tmp_path):
+    N, bw, nbins = 30, 25e-3, 30
+    idxs, ts = get_spikes(N)
+    sim = ArchiveSim(tmp_path, idxs, ts, N)
+
+    edges = np.arange(nbins + 1)*bw
+    ref, _, _ = np.histogram2d(ts, idxs, bins=[edges, np.arange(N+1)])
+
+    # windows smaller than a bin, a few bins, and the whole duration
+    for max_cells in [1, 3*N, 2**24]:
+        counts = frame_counts(sim, 'mon_I', bw, nbins, max_cells=max_cells)
+        assert counts.shape == (nbins, N)
+        assert np.array_equal(counts.toarray(), ref)
+
+    counts = frame_counts(sim, 'mon_I', bw)
+    assert counts.shape[0] == int(ts.max()/bw) + 1
+    assert counts.sum() == len(ts)
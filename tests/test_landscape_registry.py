@@ -0,0 +1,46 @@
+import numpy as np
+
+from anisonet.landscape import LandscapeRegistry
+
+
+def test_shared_and_persisted(tmp_path):
+    cfg = {'type': 'random', 'args': None}
+    reg = LandscapeRegistry(seed=1)
+    phi = reg.get('I', 20, 'phi', cfg)
+    
+    # same request is shared, others are independent
+    assert reg.get('I', 20, 'phi', dict(cfg)) is phi
+    assert not np.allclose(reg.get('I', 20, 'r', cfg), phi)
+    assert not np.allclose(reg.get('E', 20, 'phi', cfg), phi)
+    assert not np.allclose(reg.get('I', 20, 'phi', dict(cfg, seed=2)), phi)
+    
+    # deterministic given the seed, regardless of the order of requests
+    assert np.array_equal(LandscapeRegistry(seed=1).get('I', 20, 'phi', cfg), phi)
+    
+    path = str(tmp_path / 'lscp.npz')
+    reg.save(path)
+    loaded = LandscapeRegistry(seed=1)
+    assert loaded.load(path)
+    assert len(loaded.fields) == len(reg.fields)
+    assert np.array_equal(loaded.get('I', 20, 'phi', cfg), phi)
+    
+    # only the fields in use are saved again
+    loaded.save(path)
+    assert loaded.load(path) and len(np.load(path).files) == 1
+
+
+def test_perlin_seed():
+    cfg = {'type': 'perlin', 'args': {'scale': 2}}
+    reg = LandscapeRegistry(seed=1)
+    ref = reg.get('I', 20, 'phi', cfg)
+    assert np.array_equal(LandscapeRegistry(seed=1).get('I', 20, 'phi', cfg), ref)
+    assert not np.allclose(reg.get('I', 20, 'r', cfg), ref)
+    assert not np.allclose(LandscapeRegistry(seed=2).get('I', 20, 'phi', cfg), ref)
+    assert not np.allclose(reg.get('I', 20, 'phi', dict(cfg, seed=2)), ref)
+    assert not np.allclose(reg.get('I', 20, 'phi', dict(cfg, seed=3)),
+                           reg.get('I', 20, 'phi', dict(cfg, seed=2)))
+
+    # an explicit seed of the Perlin arguments wins
+    args = {'scale': 2, 'seed': 5}
+    assert np.array_equal(reg.get('I', 20, 'phi', {'type': 'perlin', 'args': args}),
+                          reg.get('E', 20, 'r', {'type': 'perlin', 'args': args}))
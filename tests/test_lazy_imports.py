@@ -0,0 +1,11 @@
+import sys
+import subprocess
+
+
+def test_simulate_does_not_import_analysis_stack():
+    code = ('import sys, anisonet.simulate; '
+            'print(" ".join(m for m in ["sklearn", "pandas", "anisonet.viz", '
+            '"anisonet.analyze"] if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    assert out.strip() == ''
@@ -0,0 +1,32 @@
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from anisonet.analyze import periodic_dbscan
+
+
+def test_periodic_dbscan():
+    rng = np.random.default_rng(0)
+    gs, n, nbumps = 60, 3000, 8
+    t = rng.uniform(0, n/4e3, n)
+    bump = rng.integers(0, nbumps, n)
+    x0, y0 = rng.uniform(0, gs, (2, nbumps))
+    x = np.round(x0[bump] + 30*t + rng.normal(0, 3, n)) % gs
+    y = np.round(y0[bump] + 10*t + rng.normal(0, 3, n)) % gs
+    xyt = np.stack((x, y, t)).T
+
+    nclusters, labels = periodic_dbscan(xyt, gs, chunk_size=500)
+
+    # brute-force periodic distances
+    d = np.abs(xyt[:,None,:2] - xyt[None,:,:2])
+    d = np.minimum(d, gs - d)
+    dt = np.abs(xyt[:,None,2] - xyt[None,:,2]) * 1e2
+    dist = np.sqrt((d**2).sum(-1) + dt**2)
+    ref = DBSCAN(eps=3., min_samples=10, metric='precomputed').fit(dist).labels_
+
+    assert nclusters == len(set(ref) - {-1})
+    assert np.array_equal(labels==-1, ref==-1)
+
+    # core points must be partitioned identically
+    core = (dist <= 3.).sum(1) >= 10
+    pairs = np.unique(np.stack((labels[core], ref[core])).T, axis=0)
+    assert len(pairs) == nclusters
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from anisonet.landscape import perlin
+
+
+def test_perlin_reference():
+    noise = pytest.importorskip('noise')
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-10, 10, (2, 500))
+    for kw in [dict(), dict(repeatx=3, repeaty=3),
+               dict(repeatx=4, repeaty=2, octaves=3, persistence=0.7, lacunarity=1.7)]:
+        ref = [noise.pnoise2(a, b, **kw) for a, b in zip(x, y)]
+        assert np.allclose(perlin(x, y, **kw), ref, atol=1e-5)
+
+
+def test_perlin_tileable():
+    s = 3
+    x, y = np.meshgrid(*2*[np.linspace(0, s, 41)], indexing='ij')
+    lscp = perlin(x, y, repeatx=s, repeaty=s, octaves=2, seed=4)
+    assert np.allclose(lscp[0], lscp[-1], atol=1e-5)
+    assert np.allclose(lscp[:, 0], lscp[:, -1], atol=1e-5)
+    assert not np.allclose(lscp, perlin(x, y, repeatx=s, repeaty=s, octaves=2))
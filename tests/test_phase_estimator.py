@@ -0,0 +1,107 @@
+import numpy as np
+
+from anisonet.utils import phase_estimator, estimate_order_parameter, OrderParameter
+
+
+def reference_phases(idxs, ts, t):
+    phis = np.zeros((len(set(idxs)), len(t)))
+    for row, idx in enumerate(sorted(set(idxs))):
+        t_spk = np.sort(ts[idxs==idx])
+        for t0, t1 in zip(t_spk[:-1], t_spk[1:]):
+            inside = (t >= t0) & (t < t1)
+            phis[row, inside] = 2*np.pi*(t[inside]-t0)/(t1-t0)
+    return phis
+
+
+def test_phase_estimator():
+    rng = np.random.default_rng(0)
+    idxs = rng.integers(0, 20, 500)
+    ts = np.round(rng.uniform(0, 1, 500), 4)
+    dt = 1e-3
+
+    t, phis = phase_estimator(idxs, ts, dt)
+    assert phis.shape == (len(set(idxs)), len(t))
+    assert np.allclose(phis, reference_phases(idxs, ts, t))
+
+    # blocks over neurons only, and over time as well
+    for max_cells in [7*len(t), 300]:
+        _, phis_ = phase_estimator(idxs, ts, dt, max_cells=max_cells)
+        assert np.array_equal(phis_, phis)
+
+    t2, phis2 = phase_estimator(idxs, ts, dt, stride=10, dtype=np.float32)
+    assert phis2.dtype == np.float32
+    assert np.allclose(t2, t[::10])
+    assert np.allclose(phis2, phis[:, ::10], atol=1e-5)
+
+
+def reference_order_parameter(idxs, ts, t, max_isi=np.inf):
+    # averaged over the neurons that have spiked already
+    R = np.zeros(len(t), dtype=complex)
+    W = np.zeros(len(t))
+    for idx in set(idxs):
+        t_spk = np.sort(ts[idxs==idx])
+        phi = np.zeros(len(t))
+        for t0, t1 in zip(t_spk[:-1], t_spk[1:]):
+            inside = (t >= t0) & (t < t1)
+            if t1 - t0 <= max_isi:
+                phi[inside] = 2*np.pi*(t[inside]-t0)/(t1-t0)
+        active = t >= t_spk[0]
+        R += active*np.exp(1j*phi)
+        W += active
+    with np.errstate(invalid='ignore'):
+        return np.abs(R/W)
+
+
+def stream(order_param, idxs, ts, size=97):
+    res = [order_param.update(idxs[i:i+size], ts[i:i+size])
+           for i in range(0, len(ts), size)]
+    res.append(order_param.finalize())
+    return [np.concatenate(v) for v in zip(*res)]
+
+
+def test_streaming_order_parameter():
+    rng = np.random.default_rng(1)
+    N, dt = 30, 1e-3
+    idxs = np.r_[np.arange(N), rng.integers(0, N, 600)]
+    ts = np.r_[rng.uniform(0, 0.05, N), rng.uniform(0.05, 2, 600)]
+    order = np.argsort(ts)
+    idxs, ts = idxs[order], ts[order]
+
+    t, phis = phase_estimator(idxs, ts, dt, stride=2)
+    R, psi = estimate_order_parameter(phis)
+
+    t_s, R_s, psi_s = stream(OrderParameter(N, dt, stride=2), idxs, ts)
+    assert np.allclose(t_s, t)
+    assert np.isnan(R_s[t < ts[0]]).all()
+    
+    # identical once all neurons have spiked
+    late = t >= 0.05
+    assert np.allclose(R_s[late], R[late])
+    assert np.allclose(R_s, reference_order_parameter(idxs, ts, t), equal_nan=True)
+
+
+def test_silent_and_stopping_neurons():
+    rng = np.random.default_rng(2)
+    N, dt, max_isi = 40, 1e-3, 0.1
+    # 10 neurons never spike, 10 stop early, and 10 start late
+    idxs = np.r_[rng.integers(10, 20, 100), rng.integers(20, 40, 1500)]
+    ts = np.r_[rng.uniform(0, 0.3, 100), rng.uniform(0, 3, 1500)]
+    ts[idxs >= 30] += 0.5
+    order = np.argsort(ts)
+    idxs, ts = idxs[order], ts[order]
+    t = np.arange(0, int(ts.max()//dt) + 1) * dt
+
+    order_param = OrderParameter(N, dt)
+    t_s, R_s, _ = stream(order_param, idxs, ts)
+    assert np.allclose(R_s, reference_order_parameter(idxs, ts, t), equal_nan=True)
+    
+    order_param = OrderParameter(N, dt, max_isi=max_isi)
+    res = []
+    for i in range(0, len(ts), 50):
+        res.append(order_param.update(idxs[i:i+50], ts[i:i+50]))
+        # the pending bins are bounded by max_isi and the chunk
+        assert len(order_param.corr)*dt <= max_isi + np.ptp(ts[i:i+50]) + 2*dt
+    res.append(order_param.finalize())
+    t_s, R_s, _ = [np.concatenate(v) for v in zip(*res)]
+    assert np.allclose(R_s, reference_order_parameter(idxs, ts, t, max_isi), 
+                       equal_nan=True)
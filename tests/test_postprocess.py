@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+from anisonet.postprocess import Task, run_tasks
+from anisonet.timing import Timer
+from anisonet.utils import load_connectivity
+
+calls = []
+
+
+class PostSim(object):
+    """A stand-in for ``Simulate`` with a stored connectivity."""
+
+    def __init__(self, path):
+        self.name = 'sim'
+        self.data_path = self.res_path = str(path)
+        self.conn_cfg = {'II': {}}
+        self.timer = Timer(verbose=False)
+        self.save_w(1.)
+
+    def save_w(self, value):
+        w = sparse.coo_matrix(np.full((4, 4), value))
+        sparse.save_npz(os.path.join(self.data_path, 'sim_w_II.npz'), w)
+
+
+def plot_w(sim, name='w'):
+    calls.append(name)
+    w = load_connectivity(sim, 'II')
+    np.save(os.path.join(sim.res_path, name+'.npy'), w.toarray())
+
+def plot_none(sim):
+    calls.append('none')
+    open(os.path.join(sim.res_path, 'none.txt'), 'w').close()
+
+
+def get_tasks(name='w'):
+    return [Task('w', plot_w, ['connectivity'], params={'name': name},
+                 outputs=[name+'.npy']),
+            Task('none', plot_none, outputs=['none.txt'])]
+
+
+def run(sim, tasks):
+    del calls[:]
+    assert run_tasks(sim, tasks, n_jobs=1) == []
+    return sorted(calls)
+
+
+def test_run_tasks(tmp_path):
+    sim = PostSim(tmp_path)
+    assert run(sim, get_tasks()) == ['none', 'w']
+    assert run(sim, get_tasks()) == [] # up to date
+
+    # only the task whose input changed is run again
+    sim.save_w(2.)
+    os.utime(os.path.join(sim.data_path, 'sim_w_II.npz'), ns=(0, 0))
+    assert run(sim, get_tasks()) == ['w']
+    assert np.load(os.path.join(sim.res_path, 'w.npy')).max() == 2.
+
+    # missing outputs and changed parameters
+    os.remove(os.path.join(sim.res_path, 'none.txt'))
+    assert run(sim, get_tasks()) == ['none']
+    assert run(sim, get_tasks('w2')) == ['w2']
+    assert run(sim, get_tasks('w2')) == []
+
+    # a failed task is reported, and run again the next time
+    tasks = get_tasks() + [Task('fail', lambda sim: 1/0)]
+    assert run_tasks(sim, tasks, n_jobs=1) == ['fail']
+    assert run_tasks(sim, tasks, n_jobs=1, only=['fail']) == ['fail']
@@ -0,0 +1,49 @@
+import numpy as np
+
+from anisonet.analyze import realized_landscape
+
+
+def test_realized_landscape():
+    rng = np.random.default_rng(0)
+    gs_s, gs_t, nsyn = 10, 20, 5000
+    pres = rng.integers(0, gs_s**2 - 1, nsyn) # the last one stays silent
+    posts = rng.integers(0, gs_t**2, nsyn)
+
+    phi, r = realized_landscape(pres, posts, gs_s, gs_t)
+
+    # per-presynapse loop, as in utils.get_post_rel_locs
+    for s_idx in range(gs_s**2):
+        t_idxs = posts[pres==s_idx]
+        if len(t_idxs)==0:
+            assert phi[s_idx]==0 and r[s_idx]==0
+            continue
+        s_loc = np.round(np.array([s_idx % gs_s, s_idx // gs_s])*gs_t/gs_s)
+        t_locs = np.array([t_idxs % gs_t, t_idxs // gs_t]).T - s_loc
+        t_locs = (t_locs + gs_t/2) % gs_t - gs_t/2
+        mean = t_locs.mean(axis=0)
+        assert np.isclose(phi[s_idx], np.arctan2(mean[1], mean[0]))
+        assert np.isclose(r[s_idx], np.hypot(*mean))
+
+
+def test_weighted_chunks():
+    rng = np.random.default_rng(1)
+    gs, nsyn = 20, 20000
+    pres = rng.integers(0, gs**2, nsyn)
+    posts = rng.integers(0, gs**2, nsyn)
+    weights = rng.uniform(0, 2, nsyn)
+
+    phi, r = realized_landscape(pres, posts, gs, gs, weights)
+    phi_c, r_c = realized_landscape(pres, posts, gs, gs, weights, chunk_size=999)
+    assert np.allclose(phi, phi_c) and np.allclose(r, r_c)
+
+    # a constant weight scales r, but keeps phi
+    phi1, r1 = realized_landscape(pres, posts, gs, gs)
+    phi2, r2 = realized_landscape(pres, posts, gs, gs, 2.)
+    assert np.allclose(phi1, phi2) and np.allclose(2*r1, r2)
+
+    s_idx = pres[0]
+    dx = (posts % gs - s_idx % gs + gs/2) % gs - gs/2
+    dy = (posts // gs - s_idx // gs + gs/2) % gs - gs/2
+    sel = pres==s_idx
+    assert np.isclose(phi[s_idx], np.arctan2(np.mean(dy[sel]*weights[sel]),
+                                             np.mean(dx[sel]*weights[sel])))
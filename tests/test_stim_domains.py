@@ -0,0 +1,36 @@
+import numpy as np
+
+from anisonet.utils import get_domain_idxs
+
+
+def test_disk_matches_loop():
+    # the former loop over the bounding box, wrapped around the edges
+    gs = 30
+    for x0, y0, r in [(15, 20, 2), (0, 29, 2.5), (3, 1, 7)]:
+        coords = set()
+        for x in range(-round(r)-1, round(r)+2):
+            for y in range(-round(r)-1, round(r)+2):
+                if x**2 + y**2 <= r**2:
+                    coords.add(((y + y0) % gs)*gs + (x + x0) % gs)
+        idxs = get_domain_idxs({'type': 'r', 'x0': x0, 'y0': y0, 'r': r}, gs)
+        assert np.array_equal(idxs, sorted(coords))
+
+
+def test_composition():
+    gs = 40
+    disk = {'type': 'disk', 'x0': 5, 'y0': 5, 'r': 6}
+    ring = {'type': 'ring', 'x0': 5, 'y0': 5, 'r_in': 3, 'r_out': 6}
+    inner = {'type': 'disk', 'x0': 5, 'y0': 5, 'r': 3}
+    diff = get_domain_idxs({'type': 'difference', 'domains': [disk, inner]}, gs)
+    assert np.array_equal(diff, get_domain_idxs(ring, gs))
+
+    circle = {'type': 'ellipse', 'x0': 5, 'y0': 5, 'a': 6, 'b': 6, 'phi': 1.}
+    assert np.array_equal(get_domain_idxs(circle, gs), get_domain_idxs(disk, gs))
+
+    rect = {'type': 'rect', 'x_min': 38, 'x_max': 42, 'y_min': 0, 'y_max': 2}
+    assert len(get_domain_idxs(rect, gs)) == 8 # wraps around
+    both = {'type': 'union', 'domains': [disk, {'type': 'complement', 'domain': disk}]}
+    assert len(get_domain_idxs(both, gs)) == gs**2
+
+    rnd = get_domain_idxs({'type': 'random', 'p': 0.1}, gs, np.random.default_rng(0))
+    assert len(np.unique(rnd)) == 160
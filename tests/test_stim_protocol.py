@@ -0,0 +1,28 @@
+import numpy as np
+
+from anisonet.utils import compile_protocol, get_stim_segments
+
+
+def test_compile_protocol():
+    N, dt = 10, 0.5
+    windows = {'type': 'windows', 'I_stim': 100, 'windows': [(0, 2), (1, 3)]}
+    pulses = {'type': 'pulses', 'I_stim': 10, 'period': 2, 'width': 1, 'n': 2}
+    ramp = {'type': 'ramp', 'I_stop': 4, 't_start': 0, 't_stop': 4}
+    stims = [{'idxs': [1, 2, 3], 'segments': get_stim_segments(windows)},
+             {'idxs': [3, 4], 'segments': get_stim_segments(
+                 {'type': 'schedule', 'segments': [pulses, ramp]})}]
+
+    values, cols = compile_protocol(stims, N, dt)
+    assert values.shape == (int(4/dt) + 1, 4)
+    assert np.array_equal(cols, [0, 2, 2, 3, 1, 0, 0, 0, 0, 0])
+    assert not values[:, 0].any()
+
+    # starts at the protocol's start, and is zero afterwards
+    t = np.arange(len(values))*dt
+    I_w = 100*(t<2) + 100*((t>=1) & (t<3))
+    I_p = 10*((t<1) | ((t>=2) & (t<3)))
+    I_r = (t<4)*t
+    assert np.allclose(values[:, 1], I_p + I_r)
+    assert np.allclose(values[:, 2], I_w)
+    assert np.allclose(values[:, 3], I_w + I_p + I_r)
+    assert not values[-1].any()
@@ -0,0 +1,33 @@
+import numpy as np
+import brian2 as b2
+
+from anisonet.utils import (get_syn_index, get_post_idxs, get_pre_idxs,
+                            invalidate_syn_index)
+
+
+def test_matches_string_queries():
+    b2.seed(0)
+    src = b2.NeuronGroup(20, 'v: 1')
+    tgt = b2.NeuronGroup(30, 'v: 1')
+    syn = b2.Synapses(src, tgt)
+    syn.connect(p=0.3)
+    syn.connect(i=[0, 0], j=[5, 5]) # multapses
+
+    index = get_syn_index(syn)
+    assert get_syn_index(syn) is index
+    for k in [0, 7, 19]:
+        posts = syn.j['i=={}'.format(k)]
+        assert np.array_equal(np.sort(get_post_idxs(syn, k)), np.sort(posts))
+    for k in [0, 5, 29]:
+        pres = syn.i['j=={}'.format(k)]
+        assert np.array_equal(np.sort(get_pre_idxs(syn, k)), np.sort(pres))
+    assert np.array_equal(index.out_degree(), np.bincount(syn.i[:], minlength=20))
+    assert np.array_equal(index.in_degree(), np.bincount(syn.j[:], minlength=30))
+
+    # rebuilt after a reconnection
+    syn.connect(i=19, j=0)
+    assert get_syn_index(syn) is not index
+    assert 0 in get_post_idxs(syn, 19)
+
+    invalidate_syn_index(syn)
+    assert get_syn_index(syn).nsyn == len(syn)